@@ -1,5 +1,6 @@
 from flask import Blueprint
-from flask_umongorest.methods import Create, BulkUpdate, List
+from flask_umongorest import response_cache
+from flask_umongorest.methods import Create, BulkUpdate, BulkDelete, List
 
 
 class UMongoRest(object):
@@ -8,6 +9,15 @@ class UMongoRest(object):
         self.url_prefix = kwargs.pop('url_prefix', '')
         app.register_blueprint(Blueprint(self.url_prefix, __name__, template_folder='templates'))
 
+        # Backend running bulk jobs (see jobs.py), and the view reporting
+        # their status (which can be subclassed to add authentication)
+        self.job_backend = kwargs.pop('job_backend', None)
+        if self.job_backend is not None:
+            from flask_umongorest.views import JobView, JOB_ENDPOINT
+            job_view = kwargs.pop('job_view', JobView)
+            app.add_url_rule('%s/jobs/<job_id>/' % self.url_prefix, methods=['GET'],
+                             view_func=job_view.as_view(JOB_ENDPOINT, job_backend=self.job_backend))
+
     def register(self, **kwargs):
         def decorator(klass):
             # Construct a url based on a 'name' kwarg with a fallback to the
@@ -22,14 +32,26 @@ class UMongoRest(object):
             if self.url_prefix:
                 url = '%s%s' % (self.url_prefix, url)
 
+            if klass.job_backend is None:
+                klass.job_backend = self.job_backend
+
+            # Writes of other resources to the collection invalidate the
+            # cached responses, even before this one serves any
+            if klass.resource.response_cache is not None:
+                response_cache.register(klass.resource.document.collection.full_name,
+                                        klass.resource.response_cache)
+
             # Add url rules
             pk_type = kwargs.pop('pk_type', 'string')
             view_func = klass.as_view(name)
             if List in klass.methods:
                 self.app.add_url_rule(url, defaults={'pk': None}, view_func=view_func, methods=[List.method], **kwargs)
-            if Create in klass.methods or BulkUpdate in klass.methods:
-                self.app.add_url_rule(url, view_func=view_func, methods=[x.method for x in klass.methods if x in (Create, BulkUpdate)], **kwargs)
-            self.app.add_url_rule('%s<%s:%s>/' % (url, pk_type, 'pk'), view_func=view_func, methods=[x.method for x in klass.methods if x not in (List, BulkUpdate)], **kwargs)
+            if Create in klass.methods or BulkUpdate in klass.methods or BulkDelete in klass.methods:
+                self.app.add_url_rule(url, view_func=view_func, methods=[x.method for x in klass.methods if x in (Create, BulkUpdate, BulkDelete)], **kwargs)
+            for method in klass.methods:
+                if getattr(method, 'action', None):
+                    self.app.add_url_rule('%s%s/' % (url, method.action), defaults={'action': method.action}, view_func=view_func, methods=[method.method], **kwargs)
+            self.app.add_url_rule('%s<%s:%s>/' % (url, pk_type, 'pk'), view_func=view_func, methods=[x.method for x in klass.methods if x not in (List, BulkUpdate, BulkDelete) and not getattr(x, 'action', None)], **kwargs)
             return klass
 
         return decorator
@@ -0,0 +1,232 @@
+"""
+Helpers for writing to large sets of documents in bounded chunks, without
+loading the documents themselves.
+"""
+import threading
+
+try:
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+except ImportError: # Python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+from pymongo import DeleteOne, UpdateOne
+
+from flask_umongorest.exceptions import BulkWriteInterrupted
+from flask_umongorest.partitions import get_boundaries, partition_queries
+
+# Number of documents written by a single bulk_write unless configured
+# otherwise
+DEFAULT_CHUNK_SIZE = 500
+
+
+class BulkProgress(object):
+    """
+    Progress of a chunked bulk write. All the matching documents up to (and
+    including) `last_id` have been processed, so an interrupted write can be
+    resumed after it.
+    """
+    def __init__(self):
+        self.count = 0
+        self.modified = 0
+        self.chunks = 0
+        self.last_id = None
+
+    def add(self, ids, result):
+        self.count += len(ids)
+        self.chunks += 1
+        self.last_id = ids[-1]
+        # Unacknowledged writes don't report any counts
+        if result is not None and result.acknowledged:
+            self.modified += result.modified_count + result.deleted_count
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'modified': self.modified,
+            'chunks': self.chunks,
+            'last_id': self.last_id,
+        }
+
+
+def iter_id_chunks(collection, query, chunk_size, after=None, collation=None, max_time_ms=None):
+    """
+    Yield lists of up to `chunk_size` _ids of the documents matching
+    `query` (in _id order, starting after the `after` _id, with the given
+    `collation`), streamed from a single batched cursor which can run for
+    `max_time_ms` milliseconds.
+    """
+    if after is not None:
+        after_query = {'_id': {'$gt': after}}
+        query = {'$and': [query, after_query]} if query else after_query
+    cursor = collection.find(query, projection={'_id': 1}, collation=collation)
+    cursor = cursor.sort('_id', 1).batch_size(chunk_size)
+    if max_time_ms:
+        cursor = cursor.max_time_ms(max_time_ms)
+    chunk = []
+    for doc in cursor:
+        chunk.append(doc['_id'])
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_in_chunks(collection, query, make_requests, chunk_size=DEFAULT_CHUNK_SIZE, workers=1,
+                  after=None, on_progress=None, collation=None, max_time_ms=None):
+    """
+    Apply `make_requests(ids)` (which returns a list of pymongo write
+    operations) to the documents matching `query`, one unordered bulk_write
+    per chunk of `chunk_size` _ids. Up to `workers` chunks are written in
+    parallel; at most twice as many chunks are held in memory at a time.
+
+    `on_progress` is called with the BulkProgress after each chunk. Return
+    the final BulkProgress, or raise BulkWriteInterrupted with the progress
+    made before a chunk failed.
+    """
+    progress = BulkProgress()
+
+    def write(ids):
+        requests = make_requests(ids)
+        return collection.bulk_write(requests, ordered=False) if requests else None
+
+    def done(ids, result):
+        progress.add(ids, result)
+        if on_progress:
+            on_progress(progress)
+
+    chunks = iter_id_chunks(collection, query, chunk_size, after=after, collation=collation,
+                            max_time_ms=max_time_ms)
+    if workers <= 1 or ThreadPoolExecutor is None:
+        for ids in chunks:
+            try:
+                result = write(ids)
+            except Exception as e:
+                raise BulkWriteInterrupted(progress, e)
+            done(ids, result)
+        return progress
+
+    # Chunks may complete out of order. Only account for a chunk once all
+    # the chunks before it are done, so that `last_id` is always safe to
+    # resume from.
+    pending = {}
+    completed = {}
+    next_index = 0
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for index, ids in enumerate(chunks):
+            pending[executor.submit(write, ids)] = (index, ids)
+            if len(pending) < workers * 2:
+                continue
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index, ids = pending.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                else:
+                    completed[index] = (ids, future.result())
+            while next_index in completed:
+                done(*completed.pop(next_index))
+                next_index += 1
+            if error is not None:
+                break
+        for future in wait(pending)[0]:
+            index, ids = pending.pop(future)
+            if future.exception() is not None:
+                error = error or future.exception()
+            else:
+                completed[index] = (ids, future.result())
+    while next_index in completed:
+        done(*completed.pop(next_index))
+        next_index += 1
+    if error is not None:
+        raise BulkWriteInterrupted(progress, error)
+    return progress
+
+
+def run_partitioned(collection, query, make_requests, partitions, method='minmax',
+                    chunk_size=DEFAULT_CHUNK_SIZE, on_progress=None, collation=None, max_time_ms=None):
+    """
+    Like run_in_chunks, but split the documents matching `query` into
+    `partitions` _id ranges (see partitions.get_boundaries) which are
+    scanned and written in parallel, one thread per range.
+
+    The reported progress sums up the counts of all the ranges. Its
+    `last_id` is always None since the ranges advance independently, so a
+    partitioned write can't be resumed.
+    """
+    if ThreadPoolExecutor is None:
+        return run_in_chunks(collection, query, make_requests, chunk_size=chunk_size,
+                             on_progress=on_progress, collation=collation, max_time_ms=max_time_ms)
+    queries = partition_queries(query, get_boundaries(collection, query, partitions, method))
+    progresses = [BulkProgress() for _ in queries]
+    total = BulkProgress()
+    lock = threading.Lock()
+
+    def report(index, progress):
+        with lock:
+            progresses[index] = progress
+            total.count = sum(p.count for p in progresses)
+            total.modified = sum(p.modified for p in progresses)
+            total.chunks = sum(p.chunks for p in progresses)
+            if on_progress:
+                on_progress(total)
+
+    def run(index, query):
+        return run_in_chunks(collection, query, make_requests, chunk_size=chunk_size,
+                             on_progress=lambda progress: report(index, progress),
+                             collation=collation, max_time_ms=max_time_ms)
+
+    error = None
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        futures = [executor.submit(run, index, q) for index, q in enumerate(queries)]
+        for index, future in enumerate(futures):
+            try:
+                report(index, future.result())
+            except BulkWriteInterrupted as e:
+                report(index, e.progress)
+                error = error or e.error
+    if error is not None:
+        raise BulkWriteInterrupted(total, error)
+    return total
+
+
+def run_spec(collection, spec, on_progress=None):
+    """
+    Run the bulk write described by `spec` on `collection`. A spec is a
+    dict with:
+    - kind: 'update' (requires an `update` document) or 'delete'
+    - query: the raw MongoDB filter of the documents to write, which each
+      write checks again
+    - chunk_size, workers and after (optional): see run_in_chunks
+    - partitions and partition_method (optional): see run_partitioned.
+      Ignored when resuming a write (`after` is set).
+    - collation (optional): the collation of `query`, as a dict
+    - max_time_ms (optional): the time budget of the scan of `query`
+    Return the final BulkProgress.
+    """
+    query = spec['query']
+    collation = spec.get('collation')
+
+    def get_filter(_id):
+        # Skip the documents which stopped matching since they were scanned
+        return {'$and': [query, {'_id': _id}]} if query else {'_id': _id}
+
+    if spec['kind'] == 'update':
+        update = spec['update']
+        make_requests = lambda ids: [UpdateOne(get_filter(_id), update, collation=collation) for _id in ids]
+    elif spec['kind'] == 'delete':
+        make_requests = lambda ids: [DeleteOne(get_filter(_id), collation=collation) for _id in ids]
+    else:
+        raise ValueError('Unknown bulk write kind: %r' % spec['kind'])
+    if spec.get('partitions', 1) > 1 and spec.get('after') is None:
+        return run_partitioned(collection, query, make_requests, spec['partitions'],
+                               method=spec.get('partition_method', 'minmax'),
+                               chunk_size=spec.get('chunk_size') or DEFAULT_CHUNK_SIZE,
+                               on_progress=on_progress, collation=collation,
+                               max_time_ms=spec.get('max_time_ms'))
+    return run_in_chunks(collection, query, make_requests,
+                         chunk_size=spec.get('chunk_size') or DEFAULT_CHUNK_SIZE,
+                         workers=spec.get('workers', 1),
+                         after=spec.get('after'), on_progress=on_progress,
+                         collation=collation, max_time_ms=spec.get('max_time_ms'))
@@ -0,0 +1,73 @@
+"""
+In-process caching of query results.
+
+Cached results are keyed by the generation of the collection they were read
+from. Resources bump the generation of their collection after every write
+(see Resource.after_write), so that the results read before the write are
+never served again.
+"""
+import collections
+import threading
+import time
+
+_generations = collections.defaultdict(int)
+_generations_lock = threading.Lock()
+
+
+def get_generation(namespace):
+    """Return the current generation of `namespace` (e.g. a collection name)."""
+    with _generations_lock:
+        return _generations[namespace]
+
+
+def bump_generation(namespace):
+    """Invalidate everything cached for `namespace` and return its new generation."""
+    with _generations_lock:
+        _generations[namespace] += 1
+        return _generations[namespace]
+
+
+def bump_all_generations():
+    """Invalidate everything cached for all the namespaces."""
+    with _generations_lock:
+        for namespace in _generations:
+            _generations[namespace] += 1
+
+
+class TTLCache(object):
+    """
+    Thread-safe cache of up to `max_entries` values, each of which expires
+    after its own TTL. The least recently used entries are evicted first.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value cached for `key`, or None if it's missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            # Mark as recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        """Cache `value` for `ttl` seconds."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,193 @@
+"""
+Helpers for coalescing work done by concurrent requests.
+"""
+import threading
+import time
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, WriteError
+
+
+class _Batch(object):
+    def __init__(self):
+        self.payloads = []
+        self.errors = {}
+        self.full = threading.Event()
+        self.flushed = threading.Event()
+
+
+class GroupCommitter(object):
+    """
+    Coalesce concurrent inserts into a collection into batches written with
+    a single unordered insert_many.
+
+    The first document of a batch waits at most `window` seconds for other
+    documents to join it (or until the batch holds `max_size` documents) and
+    then flushes the batch. It doesn't wait if no other insert is in
+    progress. Every caller gets back the _id of its own document, or the
+    exception raised for it.
+    """
+
+    def __init__(self, collection, window=0.005, max_size=100):
+        self.collection = collection
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._batch = None
+        # Number of inserts in progress
+        self._pending = 0
+
+        self.started = time.time()
+        self.batches = 0
+        self.documents = 0
+        self.errors = 0
+        self.max_batch_size = 0
+
+    def insert(self, payload):
+        """Insert `payload` as part of a batch and return its _id."""
+        if payload.get('_id') is None:
+            payload['_id'] = ObjectId()
+        with self._lock:
+            self._pending += 1
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+                # A lone writer doesn't wait for company
+                alone = self._pending == 1
+            index = len(batch.payloads)
+            batch.payloads.append(payload)
+            if len(batch.payloads) >= self.max_size:
+                # Don't let anyone else join, and wake the leader up
+                self._batch = None
+                batch.full.set()
+
+        try:
+            if leader:
+                if not alone:
+                    batch.full.wait(self.window)
+                with self._lock:
+                    if self._batch is batch:
+                        self._batch = None
+                self._flush(batch)
+            else:
+                batch.flushed.wait()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+        if index in batch.errors:
+            raise batch.errors[index]
+        return payload['_id']
+
+    def _flush(self, batch):
+        try:
+            self.collection.insert_many(batch.payloads, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                batch.errors[error['index']] = WriteError(error.get('errmsg'), error.get('code'), error)
+        except Exception as e:
+            batch.errors = dict((index, e) for index in range(len(batch.payloads)))
+        finally:
+            with self._lock:
+                self.batches += 1
+                self.documents += len(batch.payloads)
+                self.errors += len(batch.errors)
+                self.max_batch_size = max(self.max_batch_size, len(batch.payloads))
+            batch.flushed.set()
+
+    def stats(self):
+        """Return throughput and batch size metrics."""
+        with self._lock:
+            elapsed = time.time() - self.started
+            return {
+                'batches': self.batches,
+                'documents': self.documents,
+                'errors': self.errors,
+                'max_batch_size': self.max_batch_size,
+                'mean_batch_size': float(self.documents) / self.batches if self.batches else 0.0,
+                'documents_per_second': self.documents / elapsed if elapsed else 0.0,
+            }
+
+
+class _Call(object):
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent identical calls: while a call with a given key is
+    running, other calls with the same key wait for it and share its
+    result (or exception) instead of running again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        """Return the result of `fn()`, shared with concurrent calls with the same `key`."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """Return the number of calls run and of calls which shared their result."""
+        with self._lock:
+            return {'calls': self.calls, 'shared': self.shared}
+
+
+_group_committers = {}
+_group_committers_lock = threading.Lock()
+
+def get_group_committer(collection, window, max_size, on_create=None):
+    """
+    Return the GroupCommitter shared by all the inserts into `collection`
+    (with the same write concern) in this process. `on_create` is called
+    once, when the committer is first created.
+    """
+    key = (collection.full_name, tuple(sorted(collection.write_concern.document.items())))
+    with _group_committers_lock:
+        committer = _group_committers.get(key)
+        if committer is None:
+            if on_create:
+                on_create()
+            committer = _group_committers[key] = GroupCommitter(collection, window=window, max_size=max_size)
+    return committer
+
+def group_commit_stats():
+    """Return the metrics of all the GroupCommitters, keyed by collection name."""
+    with _group_committers_lock:
+        committers = list(_group_committers.items())
+    stats = {}
+    for (name, write_concern), committer in committers:
+        stats.setdefault(name, []).append(dict(committer.stats(), write_concern=dict(write_concern)))
+    return stats
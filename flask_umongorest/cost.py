@@ -0,0 +1,102 @@
+"""
+Estimation of the cost of queries, so that resources can reject expensive
+queries before running them (see Resource.max_query_cost).
+"""
+import re
+
+try:
+    string_types = basestring # Python 2
+except NameError:
+    string_types = str # Python 3
+
+# Default weights of the features of a query
+DEFAULT_WEIGHTS = {
+    # Per field condition
+    'clause': 1,
+    # Per negated condition ($ne, $nin, $not, $nor), which can't use
+    # indexes efficiently
+    'negation': 5,
+    # Per value of an $in or $nin list
+    'in_value': 0.01,
+    # Per regex which isn't an anchored prefix
+    'regex': 10,
+    # Per skipped document
+    'skip': 0.01,
+    # If no index starts with one of the filtered fields (only when the
+    # indexes are known)
+    'unindexed': 50,
+}
+
+NEGATIONS = ('$ne', '$nin', '$not', '$nor')
+
+_regex_type = type(re.compile(''))
+
+
+def _is_prefix_regex(pattern):
+    return isinstance(pattern, string_types) and pattern.startswith('^') and not pattern.startswith('^.')
+
+
+class QueryCost(object):
+    """Counts of the features of a query (see get_query_cost)."""
+
+    def __init__(self):
+        self.clauses = 0
+        self.negations = 0
+        self.in_values = 0
+        self.regexes = 0
+        self.fields = set()
+
+    def add_condition(self, field, condition):
+        self.fields.add(field)
+        self.clauses += 1
+        if isinstance(condition, _regex_type):
+            self.regexes += 1
+        if not isinstance(condition, dict):
+            return
+        for op, value in condition.items():
+            if op in NEGATIONS:
+                self.negations += 1
+            if op in ('$in', '$nin', '$all') and isinstance(value, (list, tuple)):
+                self.in_values += len(value)
+            if op == '$regex' and not _is_prefix_regex(value):
+                self.regexes += 1
+            if op in ('$not', '$elemMatch') and isinstance(value, dict):
+                self.add_condition(field, value)
+                self.clauses -= 1
+
+    def add_query(self, query):
+        for key, value in query.items():
+            if key in ('$and', '$or', '$nor'):
+                if key == '$nor':
+                    self.negations += 1
+                for clause in value:
+                    self.add_query(clause)
+            elif key.startswith('$'):
+                # e.g. $text, $where
+                self.clauses += 1
+            else:
+                self.add_condition(key, value)
+
+
+def get_query_cost(query, skip=0, index_keys=None, weights=None):
+    """
+    Return the estimated cost of a raw MongoDB filter `query` run with the
+    given `skip`, using the `weights` of its features (see
+    DEFAULT_WEIGHTS). `index_keys` are the key lists of the collection's
+    indexes, if known.
+    """
+    weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+    cost = QueryCost()
+    cost.add_query(query)
+    total = sum([
+        cost.clauses * weights['clause'],
+        cost.negations * weights['negation'],
+        cost.in_values * weights['in_value'],
+        cost.regexes * weights['regex'],
+        skip * weights['skip'],
+    ])
+    if index_keys is not None and cost.fields:
+        first_keys = set(keys[0][0] for keys in index_keys if keys)
+        if not first_keys & cost.fields:
+            total += weights['unindexed']
+    return total
@@ -24,6 +24,27 @@ class InvalidFilter(UMongoRestException):
 class ValidationError(UMongoRestException):
     pass
 
+class PreconditionFailed(UMongoRestException):
+    pass
+
+class Conflict(UMongoRestException):
+    pass
+
 class UnknownFieldError(Exception):
     pass
 
+class BulkWriteInterrupted(Exception):
+    """A chunked bulk write failed after making `progress`."""
+    def __init__(self, progress, error):
+        super(BulkWriteInterrupted, self).__init__(str(error))
+        self.progress = progress
+        self.error = error
+
+
+class CacheBackendError(Exception):
+    """A response cache backend (see response_cache.py) failed."""
+    pass
+
+class UnsupportedQuery(Exception):
+    """A query can't be run by a hot replica (see replica.py)."""
+    pass
@@ -0,0 +1,119 @@
+"""
+Inspection of the indexes of collections, so that resources can tell
+whether a query can be served by an index.
+"""
+import threading
+import time
+
+
+class IndexAdvisor(object):
+    """
+    Answer questions about the indexes of `collection`. The index
+    information is read with index_information() and cached for `ttl`
+    seconds.
+    """
+
+    def __init__(self, collection, ttl=300):
+        self.collection = collection
+        self.ttl = ttl
+        self._indexes = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def get_indexes(self):
+        """Return the index_information() of the collection."""
+        with self._lock:
+            if self._indexes is None or time.time() - self._loaded_at > self.ttl:
+                self._indexes = self.collection.index_information()
+                self._loaded_at = time.time()
+            return self._indexes
+
+    def refresh(self):
+        with self._lock:
+            self._indexes = None
+
+    def has_text_index(self, fields=None):
+        """
+        Return whether the collection has a text index (covering all the
+        given `fields`, if any).
+        """
+        for index in self.get_indexes().values():
+            if ('_fts', 'text') not in [tuple(key) for key in index['key']]:
+                continue
+            weights = index.get('weights', {})
+            if not fields or '$**' in weights or all(field in weights for field in fields):
+                return True
+        return False
+
+    def has_collation_index(self, field, collation):
+        """
+        Return whether the collection has an index starting with `field`
+        whose collation has the locale and strength of `collation` (a dict).
+        """
+        for index in self.get_indexes().values():
+            keys = [key for key, _ in index['key']]
+            if not keys or keys[0] != field:
+                continue
+            index_collation = index.get('collation') or {}
+            if all(index_collation.get(k) == collation.get(k) for k in ('locale', 'strength')):
+                return True
+        return False
+
+
+def get_equality_fields(query):
+    """
+    Return the set of the fields a raw MongoDB filter matches with an
+    equality (at its top level or in its top-level $and).
+    """
+    fields = set()
+    clauses = [query] + list(query.get('$and', []))
+    for clause in clauses:
+        for field, value in clause.items():
+            if field.startswith('$'):
+                continue
+            if isinstance(value, dict) and any(key.startswith('$') for key in value):
+                continue
+            fields.add(field)
+    return fields
+
+def can_sort(index_keys, sort, equality_fields=()):
+    """
+    Return whether one of the indexes (given as lists of (field, direction)
+    tuples) can return documents in the `sort` order without sorting them
+    in memory, given the fields the query matches with an equality.
+
+    An index can serve a sort if the sort keys follow each other in the
+    index, in the same (or all in the opposite) directions, and all the
+    index keys before them are matched with an equality.
+    """
+    sort = [(field, direction) for field, direction in sort]
+    if sort == [('_id', 1)] or sort == [('_id', -1)]:
+        return True
+    for keys in index_keys:
+        keys = [(field, direction) for field, direction in keys]
+        for start in range(len(keys) - len(sort) + 1):
+            if any(field not in equality_fields for field, _ in keys[:start]):
+                break
+            candidate = keys[start:start + len(sort)]
+            if [field for field, _ in candidate] != [field for field, _ in sort]:
+                continue
+            # Skip special indexes (text, geo, hashed...)
+            if any(not isinstance(direction, (int, float)) for _, direction in candidate):
+                continue
+            same = all(a == b for (_, a), (_, b) in zip(candidate, sort))
+            opposite = all(a == -b for (_, a), (_, b) in zip(candidate, sort))
+            if same or opposite:
+                return True
+    return False
+
+
+_advisors = {}
+_advisors_lock = threading.Lock()
+
+def get_index_advisor(collection, ttl=300):
+    """Return the IndexAdvisor shared by all the users of `collection` in this process."""
+    with _advisors_lock:
+        advisor = _advisors.get(collection.full_name)
+        if advisor is None:
+            advisor = _advisors[collection.full_name] = IndexAdvisor(collection, ttl=ttl)
+        return advisor
@@ -0,0 +1,185 @@
+"""
+Invalidation of the caches of all the processes serving a resource (see
+Resource.invalidation_bus).
+
+Every write of a resource publishes an event to a capped MongoDB collection:
+
+    {
+        'ns': '<db>.<collection>',
+        'id': <_id of the written document, or None if any may have changed>,
+        'generation': <generation of the collection in the writing process>,
+        'origin': '<id of the writing process>',
+    }
+
+Every process tails the collection (or watches it with a change stream) and
+hands the events of other processes to its subscribers, which by default
+bump the local generation of the collection (see cache.py) and its
+generation in the registered response caches (see response_cache.py), so
+that the results cached before the write are never served again.
+
+If the bus may have missed events (e.g. when it can't resume tailing where
+it left off), it hands its subscribers an event with a None 'ns', meaning
+that any collection may have been written.
+"""
+import os
+import threading
+import uuid
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+from flask_umongorest import cache, response_cache
+
+
+class InvalidationBus(object):
+    """
+    Publish and receive write events through the capped `collection`
+    (created with `size` bytes if it doesn't exist yet). Events are received
+    by a background thread started by start(), which tails the collection
+    (or uses a change stream if `change_stream`, which requires a replica
+    set) and retries every `poll_interval` seconds after errors.
+    """
+
+    def __init__(self, collection, size=16 * 1024 * 1024, poll_interval=1.0, change_stream=False):
+        self.collection = collection
+        self.size = size
+        self.poll_interval = poll_interval
+        self.change_stream = change_stream
+        self.token = uuid.uuid4().hex
+        self._subscribers = [self.bump_generation]
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    @property
+    def origin(self):
+        # Forked workers get a different origin than their parent
+        return '%s-%d' % (self.token, os.getpid())
+
+    def ensure_collection(self):
+        """Create the capped collection of the events if it doesn't exist."""
+        try:
+            self.collection.database.create_collection(self.collection.name, capped=True, size=self.size)
+        except CollectionInvalid:
+            pass
+
+    def publish(self, namespace, obj_id=None, generation=None):
+        """
+        Publish a write to `namespace` (e.g. a collection name) to the other
+        processes. Return whether the event could be published.
+        """
+        try:
+            self.collection.insert_one({
+                'ns': namespace,
+                'id': obj_id,
+                'generation': generation,
+                'origin': self.origin,
+            })
+        except PyMongoError:
+            # The write succeeded: the other processes' caches expire with
+            # their TTLs
+            return False
+        return True
+
+    def subscribe(self, callback):
+        """
+        Call `callback(event)` for every event published by other processes
+        (once, even if it's subscribed several times).
+        """
+        with self._lock:
+            if callback not in self._subscribers:
+                self._subscribers.append(callback)
+
+    def bump_generation(self, event):
+        if event['ns'] is None:
+            cache.bump_all_generations()
+            response_cache.bump_all_generations()
+        else:
+            cache.bump_generation(event['ns'])
+            response_cache.bump_generation(event['ns'])
+
+    def resync(self):
+        """Notify the subscribers that events may have been missed."""
+        self.dispatch({'ns': None, 'id': None, 'generation': None, 'origin': None})
+
+    def dispatch(self, event):
+        """Hand `event` to the subscribers, unless it was published by this process."""
+        if event.get('origin') == self.origin:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                # A failing subscriber mustn't keep the others from being
+                # notified
+                pass
+
+    def start(self):
+        """Start receiving the events published from now on."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch if self.change_stream else self._tail)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _get_last_id(self):
+        last = self.collection.find_one(sort=[('$natural', -1)], projection={'_id': 1})
+        return last['_id'] if last is not None else None
+
+    def _tail(self):
+        last_id = None
+        started = False
+        while not self._stop.is_set():
+            try:
+                if not started:
+                    # Skip the events published before the bus started
+                    self.ensure_collection()
+                    last_id = self._get_last_id()
+                    started = True
+                # The _ids of the events are generated by the publishing
+                # processes, so they aren't ordered: the cursor reads the
+                # events in insertion order and skips up to the last one
+                # received
+                skipping = last_id is not None
+                newest_id = None
+                cursor = self.collection.find(cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive and not self._stop.is_set():
+                    for event in cursor:
+                        if skipping:
+                            skipping = event['_id'] != last_id
+                            newest_id = event['_id']
+                            continue
+                        last_id = event['_id']
+                        self.dispatch(event)
+                    if skipping:
+                        # The last event received was overwritten before the
+                        # bus could resume, so the events in between are lost
+                        skipping = False
+                        last_id = newest_id
+                        self.resync()
+            except PyMongoError:
+                pass
+            # The cursor of an empty collection dies right away
+            self._stop.wait(self.poll_interval)
+
+    def _watch(self):
+        resume_token = None
+        pipeline = [{'$match': {'operationType': 'insert'}}]
+        while not self._stop.is_set():
+            try:
+                with self.collection.watch(pipeline, resume_after=resume_token,
+                                           max_await_time_ms=int(self.poll_interval * 1000)) as stream:
+                    while stream.alive and not self._stop.is_set():
+                        change = stream.try_next()
+                        if change is not None:
+                            resume_token = change['_id']
+                            self.dispatch(change['fullDocument'])
+            except PyMongoError:
+                self._stop.wait(self.poll_interval)
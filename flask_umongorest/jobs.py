@@ -0,0 +1,258 @@
+"""
+Background execution of bulk writes (see Resource.bulk_jobs).
+
+A job backend accepts bulk write specs (see bulk.run_spec), runs them in the
+background and reports their status as a dict:
+
+    {
+        'id': '<job id>',
+        'kind': 'update' or 'delete',
+        'status': 'queued', 'running', 'done' or 'failed',
+        'progress': { 'count': ..., 'modified': ..., 'chunks': ..., 'last_id': ... },
+        'errors': [...],
+        'owner': <owner passed to submit()>,
+        'created_at': datetime,
+        'updated_at': datetime,
+    }
+"""
+import datetime
+import threading
+import time
+
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from pymongo.write_concern import WriteConcern
+
+from flask_umongorest import bulk
+from flask_umongorest.exceptions import BulkWriteInterrupted
+from flask_umongorest.resources import get_resource_class
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError: # Python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobBackend(object):
+    """Interface of the job backends."""
+
+    def submit(self, collection, spec, owner=None):
+        """
+        Enqueue a bulk write `spec` to be run on `collection` and return the
+        job's status dict. `owner` (any JSON value) is stored with the job,
+        e.g. to restrict who can read its status.
+        """
+        raise NotImplementedError
+
+    def get(self, job_id):
+        """Return the status dict of a job, or None if it doesn't exist."""
+        raise NotImplementedError
+
+
+def _get_after_write(spec):
+    """
+    Return a function calling the after_write hook of the resource which
+    built `spec` (see Resource.get_bulk_write_spec), so that what's cached
+    from its collection is invalidated. Raise a ValueError if the resource
+    class isn't known to this process (see get_resource_class).
+    """
+    if not spec.get('resource'):
+        return lambda: None
+    resource_class = get_resource_class(spec['resource'])
+    if resource_class is None:
+        raise ValueError('Unknown resource class: %s (the worker must import its module).' % spec['resource'])
+    resource = resource_class()
+    return lambda: resource.after_write(None)
+
+def _run(collection, spec, report):
+    """
+    Run a bulk write spec, calling `report(**changes)` whenever the job's
+    status changes.
+    """
+    try:
+        after_write = _get_after_write(spec)
+    except ValueError as e:
+        report(status=FAILED, errors=[str(e)])
+        return
+
+    def on_progress(progress):
+        after_write()
+        report(progress=progress.to_dict())
+
+    report(status=RUNNING)
+    try:
+        try:
+            progress = bulk.run_spec(collection, spec, on_progress=on_progress)
+        finally:
+            # A failed chunk may have written some documents too
+            after_write()
+    except BulkWriteInterrupted as e:
+        report(status=FAILED, progress=e.progress.to_dict(), errors=[str(e.error)])
+    except Exception as e:
+        report(status=FAILED, errors=[str(e)])
+    else:
+        report(status=DONE, progress=progress.to_dict())
+
+
+def _new_job(spec, owner=None):
+    now = datetime.datetime.utcnow()
+    return {
+        'id': str(ObjectId()),
+        'kind': spec['kind'],
+        'status': QUEUED,
+        'progress': bulk.BulkProgress().to_dict(),
+        'errors': [],
+        'owner': owner,
+        'created_at': now,
+        'updated_at': now,
+    }
+
+
+class ThreadPoolJobBackend(JobBackend):
+    """
+    Run jobs in a thread pool of the current process. The status of the
+    last `max_jobs` jobs is kept in memory, so it's only visible to the
+    process which runs them.
+    """
+
+    def __init__(self, workers=2, max_jobs=1000):
+        assert ThreadPoolExecutor is not None, 'ThreadPoolJobBackend requires concurrent.futures'
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, collection, spec, owner=None):
+        job = _new_job(spec, owner)
+        with self._lock:
+            self._jobs[job['id']] = job
+            # Forget the oldest finished jobs
+            finished = sorted((j['created_at'], j['id']) for j in self._jobs.values()
+                              if j['status'] in (DONE, FAILED))
+            for _, job_id in finished[:max(0, len(self._jobs) - self.max_jobs)]:
+                del self._jobs[job_id]
+
+        def report(**changes):
+            with self._lock:
+                job.update(changes, updated_at=datetime.datetime.utcnow())
+
+        self._executor.submit(_run, collection, spec, report)
+        return self.get(job['id'])
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+
+class MongoJobBackend(JobBackend):
+    """
+    Queue jobs in a MongoDB collection, so that they can be run and polled
+    by any process. Each process runs `workers` threads claiming queued
+    jobs, which start with the first submitted job (or by calling start()
+    in dedicated worker processes).
+
+    Jobs whose status hasn't been updated for `stale_after` seconds (e.g.
+    because their worker died) are claimed again and resumed after the
+    last _id they processed.
+    """
+
+    def __init__(self, collection, workers=2, poll_interval=1.0, stale_after=300):
+        self.collection = collection
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, collection, spec, owner=None):
+        doc = _new_job(spec, owner)
+        doc['_id'] = ObjectId(doc.pop('id'))
+        doc.update({
+            'db': collection.database.name,
+            'collection': collection.name,
+            'write_concern': collection.write_concern.document,
+            # Specs contain operators ("$set"), which can't be stored as
+            # field names
+            'spec': json_util.dumps(spec),
+        })
+        self.collection.insert_one(doc)
+        self.start()
+        return self._to_job(doc)
+
+    def get(self, job_id):
+        try:
+            job_id = ObjectId(job_id)
+        except (InvalidId, TypeError):
+            return None
+        doc = self.collection.find_one({'_id': job_id})
+        return self._to_job(doc) if doc is not None else None
+
+    def _to_job(self, doc):
+        job = dict((k, v) for k, v in doc.items()
+                   if k not in ('_id', 'db', 'collection', 'write_concern', 'spec'))
+        job['id'] = str(doc['_id'])
+        return job
+
+    def _claim(self):
+        now = datetime.datetime.utcnow()
+        stale = now - datetime.timedelta(seconds=self.stale_after)
+        return self.collection.find_one_and_update(
+            {'$or': [
+                {'status': QUEUED},
+                {'status': RUNNING, 'updated_at': {'$lt': stale}},
+            ]},
+            {'$set': {'status': RUNNING, 'updated_at': now}},
+            sort=[('_id', 1)], return_document=ReturnDocument.AFTER)
+
+    def _work(self):
+        while True:
+            try:
+                doc = self._claim()
+            except Exception:
+                doc = None
+            if doc is None:
+                time.sleep(self.poll_interval)
+                continue
+
+            spec = json_util.loads(doc['spec'])
+            # Resume jobs which have been interrupted
+            if doc['progress'].get('last_id') is not None:
+                spec['after'] = doc['progress']['last_id']
+            collection = self.collection.database.client[doc['db']][doc['collection']]
+            collection = collection.with_options(write_concern=WriteConcern(**doc['write_concern']))
+
+            def report(**changes):
+                changes['updated_at'] = datetime.datetime.utcnow()
+                if 'progress' in changes:
+                    # Progress counts are cumulative across resumed runs
+                    changes['progress'] = self._add_progress(doc['progress'], changes['progress'])
+                self.collection.update_one({'_id': doc['_id']}, {'$set': changes})
+
+            _run(collection, spec, report)
+
+    def _add_progress(self, previous, progress):
+        if previous.get('last_id') is None:
+            return progress
+        return dict(progress,
+                    count=previous['count'] + progress['count'],
+                    modified=previous['modified'] + progress['modified'],
+                    chunks=previous['chunks'] + progress['chunks'],
+                    last_id=progress['last_id'] or previous['last_id'])
@@ -7,6 +7,9 @@ class Update:
 class BulkUpdate:
     method = 'PUT'
 
+class BulkDelete:
+    method = 'DELETE'
+
 class Fetch:
     method = 'GET'
 
@@ -15,3 +18,29 @@ class List:
 
 class Delete:
     method = 'DELETE'
+
+class Patch:
+    method = 'PATCH'
+
+# Methods with an `action` are served by a `<resource url><action>/` URL and
+# dispatched to the view's `handler` method.
+
+class Import:
+    method = 'POST'
+    action = 'import'
+    handler = 'import_objects'
+
+class Export:
+    method = 'GET'
+    action = 'export'
+    handler = 'export_objects'
+
+class Aggregate:
+    method = 'GET'
+    action = 'aggregate'
+    handler = 'aggregate_objects'
+
+class Distinct:
+    method = 'GET'
+    action = 'distinct'
+    handler = 'distinct_values'
@@ -1,12 +1,40 @@
+import re
+
+try:
+    string_types = basestring # Python 2
+except NameError:
+    string_types = str # Python 3
+
 class Operator(object):
     op = 'exact'
 
     # Can be overridden via constructor.
     allow_negation = False
 
+    # Whether the value is converted to the type of the filtered field (see
+    # Resource.coerce_filter_values). Operators which parse their values
+    # themselves don't need it.
+    coerce_value = True
+
+    # Whether queries using the operator need the resource's collation (see
+    # Resource.collation)
+    uses_collation = False
+
+    # Whether the operator's results change with the collation of the query
+    # (string comparisons do; regexes, text searches and comparisons with
+    # booleans, ints or ObjectIds don't)
+    collation_sensitive = True
+
     def __init__(self, allow_negation=False):
         self.allow_negation = allow_negation
 
+    def clean_value(self, value, convert):
+        """
+        Return the query string `value` converted by `convert` (a function
+        converting a single value to the type of the filtered field).
+        """
+        return convert(value)
+
     # Lets us specify filters as an instance if we want to override the
     # default arguments (in addition to specifying them as a class).
     def __call__(self):
@@ -22,6 +50,13 @@ class Operator(object):
         kwargs = self.prepare_queryset_kwargs(field, value, negate)
         return kwargs
 
+    def apply_without_collation(self, field, value, negate=False):
+        """
+        Return the filter of an operator which uses the collation, in a
+        query which doesn't (see Resource.get_collation).
+        """
+        return self.apply(field, value, negate)
+
 
 class Ne(Operator):
     op = 'ne'
@@ -57,10 +92,16 @@ class Exact(Operator):
 class In(Operator):
     op = 'in'
 
+    def clean_value(self, value, convert):
+        if ',' in value:
+            return [convert(v) for v in value.split(',')]
+        return convert(value)
+
     def prepare_queryset_kwargs(self, field, value, negate):
         # only use 'in' or 'nin' if multiple values are specified
-        if ',' in value:
+        if isinstance(value, string_types) and ',' in value:
             value = value.split(',')
+        if isinstance(value, list):
             op = negate and 'nin' or self.op
             op = '${}'.format(op)
         else:
@@ -69,6 +110,8 @@ class In(Operator):
 
 class Boolean(Operator):
     op = 'exact'
+    coerce_value = False
+    collation_sensitive = False
 
     def prepare_queryset_kwargs(self, field, value, negate):
         if value == 'false':
@@ -84,9 +127,13 @@ class Boolean(Operator):
 		
 class Startswith(Operator):
     op = 'startswith'
+    coerce_value = False
+    collation_sensitive = False
 
     def prepare_queryset_kwargs(self, field, value, negate):
-        return {field: {'$regex' : '^{}'.format(value)}}
+        # Escape the value so that the prefix stays anchored and the regex
+        # can use the field's index
+        return {field: {'$regex' : '^{}'.format(re.escape(value))}}
 
     def apply(self, field, value, negate=False):
         kwargs = self.prepare_queryset_kwargs(field, value, negate)
@@ -95,6 +142,8 @@ class Startswith(Operator):
 
 class InRef(Operator):
     op = 'inref'
+    coerce_value = False
+    collation_sensitive = False
 
     def prepare_queryset_kwargs(self, field, value, negate):
         from bson import ObjectId
@@ -113,6 +162,8 @@ class InRef(Operator):
 
 class Ref(Operator):
     op = 'ref'
+    coerce_value = False
+    collation_sensitive = False
 
     def prepare_queryset_kwargs(self, field, value, negate):
         from bson import ObjectId
@@ -124,6 +175,8 @@ class Ref(Operator):
     
 class ExactInt(Operator):
     op = 'exact_int'
+    coerce_value = False
+    collation_sensitive = False
     
     def prepare_queryset_kwargs(self, field, value, negate):
         # Using <field>__exact causes mongoengine to generate a regular
@@ -132,3 +185,59 @@ class ExactInt(Operator):
             return {field: {'$ne': int(value)}}
         else:
             return {field: int(value)}
+
+
+class Text(Operator):
+    """
+    Full-text search with the collection's text index. The search covers
+    all the fields of the text index, regardless of the filtered field.
+    Requires a text index (see indexes.IndexAdvisor.has_text_index).
+    """
+    op = 'text'
+    coerce_value = False
+    collation_sensitive = False
+
+    def prepare_queryset_kwargs(self, field, value, negate):
+        return {'$text': {'$search': value}}
+
+
+class IExact(Operator):
+    """
+    Case-insensitive equality, using the resource's collation (see
+    Resource.collation) rather than a regex, so that it can be served by an
+    index with the same collation.
+    """
+    op = 'iexact'
+    uses_collation = True
+
+    def prepare_queryset_kwargs(self, field, value, negate):
+        if negate:
+            return {field: {'$ne': value}}
+        else:
+            return {field: value}
+
+    def apply_without_collation(self, field, value, negate=False):
+        if value is None:
+            return self.apply(field, value, negate)
+        regex = re.compile(u'^%s$' % re.escape(value), re.IGNORECASE | re.UNICODE)
+        return {field: {'$not': regex} if negate else regex}
+
+
+class IStartswith(Operator):
+    """
+    Case-insensitive prefix match, expressed as a range using the resource's
+    collation (see Resource.collation) so that it can be served by an index
+    with the same collation.
+    """
+    op = 'istartswith'
+    coerce_value = False
+    uses_collation = True
+
+    def prepare_queryset_kwargs(self, field, value, negate):
+        # U+FFFF sorts after every character in collations
+        prefix_range = {'$gte': value, '$lt': value + u'\uffff'}
+        return {field: {'$not': prefix_range} if negate else prefix_range}
+
+    def apply_without_collation(self, field, value, negate=False):
+        regex = re.compile(u'^%s' % re.escape(value), re.IGNORECASE | re.UNICODE)
+        return {field: {'$not': regex} if negate else regex}
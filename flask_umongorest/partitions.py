@@ -0,0 +1,164 @@
+"""
+Helpers for splitting a filtered collection scan into _id ranges which can
+be scanned in parallel.
+"""
+import datetime
+import threading
+
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+
+from bson.objectid import ObjectId
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError: # Python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+# Number of sampled _ids per partition when splitting with $sample
+SAMPLES_PER_PARTITION = 20
+
+
+def _id_bound(collection, query, direction):
+    doc = collection.find_one(query, projection={'_id': 1}, sort=[('_id', direction)])
+    return doc and doc['_id']
+
+def _interpolate(low, high, fraction):
+    """Return the value at `fraction` of the way from `low` to `high`."""
+    if isinstance(low, ObjectId) and isinstance(high, ObjectId):
+        # ObjectIds start with their creation timestamp
+        low_ts = low.generation_time
+        seconds = (high.generation_time - low_ts).total_seconds() * fraction
+        return ObjectId.from_datetime(low_ts + datetime.timedelta(seconds=seconds))
+    if isinstance(low, (int, float)) and isinstance(high, (int, float)):
+        return low + (high - low) * fraction
+    return None
+
+def get_boundaries(collection, query, partitions, method='minmax'):
+    """
+    Return a sorted list of up to `partitions - 1` _ids splitting the
+    documents matching `query` into ranges.
+
+    The 'minmax' method interpolates between the smallest and the largest
+    matching _id (ObjectIds are split by creation time, numbers linearly),
+    which costs two indexed lookups but assumes evenly distributed _ids. The
+    'sample' method picks the quantiles of a $sample of the matching _ids,
+    which adapts to skewed distributions. 'minmax' falls back to 'sample'
+    for _ids which can't be interpolated.
+    """
+    if partitions <= 1:
+        return []
+    if method == 'minmax':
+        low = _id_bound(collection, query, 1)
+        high = _id_bound(collection, query, -1)
+        if low is None or low == high:
+            return []
+        boundaries = [_interpolate(low, high, float(i) / partitions) for i in range(1, partitions)]
+        if None not in boundaries:
+            return sorted(set(boundaries))
+    elif method != 'sample':
+        raise ValueError('Unknown partitioning method: %r' % method)
+
+    sample = sorted(doc['_id'] for doc in collection.aggregate([
+        {'$match': query},
+        {'$sample': {'size': partitions * SAMPLES_PER_PARTITION}},
+        {'$project': {'_id': 1}},
+    ]))
+    if len(sample) < partitions:
+        return []
+    step = len(sample) / float(partitions)
+    return sorted(set(sample[int(step * i)] for i in range(1, partitions)))
+
+def partition_queries(query, boundaries):
+    """
+    Return one query per _id range delimited by `boundaries` (see
+    get_boundaries). Together, the queries match the same documents as
+    `query`.
+    """
+    ranges = zip([None] + list(boundaries), list(boundaries) + [None])
+    queries = []
+    for low, high in ranges:
+        id_range = {}
+        if low is not None:
+            id_range['$gte'] = low
+        if high is not None:
+            id_range['$lt'] = high
+        if not id_range:
+            queries.append(query)
+        elif query:
+            queries.append({'$and': [query, {'_id': id_range}]})
+        else:
+            queries.append({'_id': id_range})
+    return queries
+
+
+_DONE = object()
+
+def scan_partitions(queries, scan, workers, ordered=True, queue_size=4, wrap=None):
+    """
+    Run `scan(query)` (a function returning an iterable of items) for each
+    of the partition `queries` in a pool of `workers` threads and yield the
+    items.
+
+    If `ordered`, the items of a partition are yielded only after all the
+    items of the previous partitions; otherwise they're yielded as soon as
+    they're produced. Each partition buffers at most `queue_size` items
+    ahead of the consumer, so memory use stays bounded. In ordered mode,
+    this means that a partition stalls once it's `queue_size` items ahead:
+    partitions only run in parallel as long as they fit in their buffers,
+    and beyond that, they're scanned one after the other.
+
+    `wrap` is an optional decorator applied to the function run by each
+    thread, e.g. flask.copy_current_request_context.
+    """
+    if workers <= 1 or len(queries) <= 1 or ThreadPoolExecutor is None:
+        for query in queries:
+            for item in scan(query):
+                yield item
+        return
+
+    stop = threading.Event()
+    if ordered:
+        queues = [queue.Queue(queue_size) for _ in queries]
+    else:
+        queues = [queue.Queue(queue_size * workers)] * len(queries)
+
+    def put(q, item):
+        # Give up if the consumer went away
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def work(index, query):
+        try:
+            for item in scan(query):
+                if stop.is_set():
+                    return
+                put(queues[index], (None, item))
+        except Exception as e:
+            put(queues[index], (e, None))
+        put(queues[index], (_DONE, None))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for index, query in enumerate(queries):
+            executor.submit(wrap(work) if wrap else work, index, query)
+        # The consumer drains the queues in partition order. In unordered
+        # mode they're all the same queue, so it waits for every partition
+        # to be done.
+        for q in queues:
+            while True:
+                error, item = q.get()
+                if error is _DONE:
+                    break
+                if error is not None:
+                    raise error
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
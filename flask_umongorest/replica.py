@@ -0,0 +1,524 @@
+"""
+In-memory replicas of small, frequently read collections (see
+Resource.hot_replica).
+
+A HotReplica loads all the raw documents of a collection and answers the
+queries built by Resource.apply_filters in Python, using in-memory indexes
+of the filtered fields to narrow down the documents to match. It's kept
+fresh by polling the collection (for the documents whose updated-at field
+changed, or entirely) and, optionally, by the events of an invalidation bus
+(see invalidation.py).
+
+Only the query operators listed in OPERATORS are supported; queries using
+anything else raise UnsupportedQuery, so that they can be run by MongoDB
+instead.
+"""
+import collections
+import copy
+import datetime
+import numbers
+import os
+import re
+import threading
+import time
+
+from bson.objectid import ObjectId
+
+from flask_umongorest.exceptions import UnsupportedQuery
+
+try:
+    string_types = basestring # Python 2
+except NameError:
+    string_types = str # Python 3
+
+_regex_type = type(re.compile(''))
+
+OPERATORS = ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$exists', '$regex', '$options',
+             '$not', '$all', '$size', '$elemMatch')
+
+_REGEX_FLAGS = {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL, 'x': re.VERBOSE}
+
+
+def _bracket(value):
+    """Return the rank of the type of `value` in MongoDB's comparison order."""
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, numbers.Number):
+        return 2
+    if isinstance(value, string_types):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime.datetime):
+        return 9
+    return 10
+
+
+def _equal(a, b):
+    return _bracket(a) == _bracket(b) and a == b
+
+
+def _compare(a, b):
+    """Return the sign of a - b, or None if they can't be compared."""
+    if _bracket(a) != _bracket(b):
+        return None
+    try:
+        return (a > b) - (a < b)
+    except TypeError:
+        return None
+
+
+def get_values(doc, path):
+    """
+    Return the values at the dotted `path` of `doc`, traversing arrays of
+    subdocuments. Missing fields have no values.
+    """
+    values = [doc]
+    for part in path.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    next_values.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    next_values.append(value[int(part)])
+                for item in value:
+                    if isinstance(item, dict) and part in item:
+                        next_values.append(item[part])
+        values = next_values
+    return values
+
+
+def _candidates(values):
+    # Arrays match a condition if they or any of their elements do
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            for item in value:
+                yield item
+
+
+def _regex_matches(values, regex):
+    return any(isinstance(value, string_types) and regex.search(value) for value in _candidates(values))
+
+
+def _matches_value(values, expected):
+    if isinstance(expected, _regex_type):
+        return _regex_matches(values, expected)
+    if expected is None and not values:
+        # Missing fields are null
+        return True
+    return any(_equal(value, expected) for value in _candidates(values))
+
+
+def _compares(values, arg, accept):
+    for value in _candidates(values):
+        sign = _compare(value, arg)
+        if sign is not None and sign in accept:
+            return True
+    return False
+
+
+def _matches_operator(values, op, arg, condition):
+    if op == '$eq':
+        return _matches_value(values, arg)
+    if op == '$ne':
+        return not _matches_value(values, arg)
+    if op == '$gt':
+        return _compares(values, arg, (1,))
+    if op == '$gte':
+        return _compares(values, arg, (0, 1))
+    if op == '$lt':
+        return _compares(values, arg, (-1,))
+    if op == '$lte':
+        return _compares(values, arg, (-1, 0))
+    if op == '$in':
+        return any(_matches_value(values, item) for item in arg)
+    if op == '$nin':
+        return not any(_matches_value(values, item) for item in arg)
+    if op == '$exists':
+        return bool(values) == bool(arg)
+    if op == '$regex':
+        if not isinstance(arg, _regex_type):
+            flags = 0
+            for option in condition.get('$options', ''):
+                flags |= _REGEX_FLAGS.get(option, 0)
+            arg = re.compile(arg, flags)
+        return _regex_matches(values, arg)
+    if op == '$options':
+        # Handled with $regex
+        return True
+    if op == '$not':
+        return not match_condition(values, arg)
+    if op == '$all':
+        return all(_matches_value(values, item) for item in arg)
+    if op == '$size':
+        return any(isinstance(value, list) and len(value) == arg for value in values)
+    if op == '$elemMatch':
+        for value in values:
+            if not isinstance(value, list):
+                continue
+            for item in value:
+                if _is_operator_dict(arg):
+                    if match_condition([item], arg):
+                        return True
+                elif isinstance(item, dict) and match_query(item, arg):
+                    return True
+        return False
+    raise UnsupportedQuery(op)
+
+
+def _is_operator_dict(condition):
+    return isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition)
+
+
+def match_condition(values, condition):
+    """Return whether the `values` of a field match a query `condition`."""
+    if _is_operator_dict(condition):
+        return all(_matches_operator(values, op, arg, condition) for op, arg in condition.items())
+    return _matches_value(values, condition)
+
+
+def match_query(doc, query):
+    """Return whether the raw document `doc` matches the raw MongoDB filter `query`."""
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(match_query(doc, clause) for clause in condition):
+                return False
+        elif key == '$or':
+            if not any(match_query(doc, clause) for clause in condition):
+                return False
+        elif key == '$nor':
+            if any(match_query(doc, clause) for clause in condition):
+                return False
+        elif key.startswith('$'):
+            raise UnsupportedQuery(key)
+        elif not match_condition(get_values(doc, key), condition):
+            return False
+    return True
+
+
+def check_query(query):
+    """Raise UnsupportedQuery if `query` uses anything match_query doesn't support."""
+    for key, condition in query.items():
+        if key in ('$and', '$or', '$nor'):
+            for clause in condition:
+                check_query(clause)
+        elif key.startswith('$'):
+            raise UnsupportedQuery(key)
+        else:
+            _check_condition(condition)
+
+
+def _check_condition(condition):
+    if not isinstance(condition, dict):
+        return
+    if not any(key.startswith('$') or not key for key in condition):
+        # Subdocument equality
+        return
+    for op, arg in condition.items():
+        if op not in OPERATORS:
+            raise UnsupportedQuery(op)
+        if op == '$not':
+            _check_condition(arg)
+        elif op == '$elemMatch':
+            if _is_operator_dict(arg):
+                _check_condition(arg)
+            else:
+                check_query(arg)
+
+
+def _sort_key(values):
+    value = values[0] if values else None
+    bracket = _bracket(value)
+    # Documents, arrays and unknown types are compared by type only
+    return (bracket, value if bracket in (1, 2, 3, 7, 8, 9) else 0)
+
+
+def sort_documents(docs, sort):
+    """Sort `docs` in place by a list of (field, direction) tuples."""
+    for field, direction in reversed(sort):
+        docs.sort(key=lambda doc: _sort_key(get_values(doc, field)), reverse=direction < 0)
+
+
+def _index_keys(values):
+    if not values:
+        yield None
+    for value in _candidates(values):
+        try:
+            hash(value)
+        except TypeError:
+            continue
+        yield value
+
+
+def build_indexes(docs, fields):
+    """
+    Return a dict of {value: set of _ids} dicts, one per field of `fields`,
+    indexing `docs` (a dict of raw documents by _id).
+    """
+    indexes = dict((field, collections.defaultdict(set)) for field in fields)
+    for _id, doc in docs.items():
+        for field, index in indexes.items():
+            for key in _index_keys(get_values(doc, field)):
+                index[key].add(_id)
+    return indexes
+
+
+def _lookup(index, condition):
+    """
+    Return the _ids of the documents an equality or $in `condition` may
+    match according to `index`, or None if the index can't tell.
+    """
+    if _is_operator_dict(condition):
+        if list(condition) == ['$eq']:
+            values = [condition['$eq']]
+        elif list(condition) == ['$in']:
+            values = condition['$in']
+        else:
+            return None
+    elif isinstance(condition, (dict, list, _regex_type)):
+        return None
+    else:
+        values = [condition]
+    ids = set()
+    for value in values:
+        try:
+            ids |= index.get(value, set())
+        except TypeError: # unhashable
+            return None
+    return ids
+
+
+def get_candidate_ids(query, indexes):
+    """
+    Return the _ids of the documents `query` may match according to the
+    `indexes` of its equality conditions, or None to scan all the documents.
+    """
+    clauses = [query]
+    ids = None
+    while clauses:
+        clause = clauses.pop()
+        for key, condition in clause.items():
+            if key == '$and':
+                clauses.extend(condition)
+            elif key in indexes:
+                matching = _lookup(indexes[key], condition)
+                if matching is not None:
+                    ids = matching if ids is None else ids & matching
+    return ids
+
+
+class HotReplica(object):
+    """
+    In-memory copy of the up to `max_documents` documents of `collection`,
+    with indexes of `index_fields` (db field names).
+
+    Once started, it's refreshed every `poll_interval` seconds: if
+    `updated_field` is set, only the documents whose `updated_field` is
+    newer than the newest one loaded are read again (and the whole
+    collection every `reload_interval` seconds, to drop the deleted ones);
+    otherwise the whole collection is reloaded. If a refresh fails, the
+    replica is dropped (queries raise UnsupportedQuery, so that they're run
+    by MongoDB) until it's loaded again.
+    """
+
+    def __init__(self, collection, index_fields=(), updated_field=None, poll_interval=5,
+                 reload_interval=300, max_documents=10000):
+        self.collection = collection
+        self.index_fields = list(index_fields)
+        self.updated_field = updated_field
+        self.poll_interval = poll_interval
+        self.reload_interval = reload_interval
+        self.max_documents = max_documents
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        # Replaced as a whole on every change, so that readers can use a
+        # consistent snapshot without holding the lock
+        self._state = None
+        self._last_updated = None
+        self._loaded_at = None
+        # The polling thread doesn't survive a fork (see get_hot_replica)
+        self.pid = os.getpid()
+
+    @property
+    def loaded(self):
+        return self._state is not None
+
+    def load(self):
+        """Load all the documents of the collection."""
+        raws = list(self.collection.find(sort=[('_id', 1)], limit=self.max_documents + 1))
+        if len(raws) > self.max_documents:
+            raise ValueError('%s has more than %d documents.' % (self.collection.full_name, self.max_documents))
+        docs = collections.OrderedDict((raw['_id'], raw) for raw in raws)
+        with self._lock:
+            self._set_state(docs)
+            self._loaded_at = time.time()
+
+    def drop(self):
+        """Drop the loaded documents until the collection is loaded again."""
+        with self._lock:
+            self._state = None
+
+    def _set_state(self, docs):
+        self._state = (docs, build_indexes(docs, self.index_fields))
+        if self.updated_field:
+            updated = [v for doc in docs.values() for v in get_values(doc, self.updated_field)[:1]
+                       if v is not None]
+            self._last_updated = max(updated) if updated else None
+
+    def apply(self, upserted=(), deleted=()):
+        """Replace the `upserted` raw documents and drop the `deleted` _ids."""
+        with self._lock:
+            if self._state is None:
+                return
+            docs = collections.OrderedDict(self._state[0])
+            for _id in deleted:
+                docs.pop(_id, None)
+            for raw in upserted:
+                docs[raw['_id']] = raw
+            if upserted:
+                try:
+                    docs = collections.OrderedDict(sorted(docs.items(), key=lambda item: item[0]))
+                except TypeError: # _ids of different types
+                    pass
+            self._set_state(docs)
+
+    def refresh(self):
+        """Read the changes made to the collection since it was last loaded or refreshed."""
+        if not self.loaded or not self.updated_field or \
+                time.time() - self._loaded_at > self.reload_interval:
+            return self.load()
+        query = {self.updated_field: {'$gte': self._last_updated}} if self._last_updated is not None else {}
+        self.apply(upserted=list(self.collection.find(query)))
+
+    def handle_event(self, event):
+        """Apply an invalidation bus event (see invalidation.py) about a write to the collection."""
+        if event.get('ns') not in (None, self.collection.full_name) or not self.loaded:
+            return
+        if event.get('id') is None:
+            return self.load()
+        raw = self.collection.find_one({'_id': event['id']})
+        if raw is None:
+            self.apply(deleted=[event['id']])
+        else:
+            self.apply(upserted=[raw])
+
+    def start(self):
+        """Load the collection if needed, and start refreshing it in the background."""
+        if not self.loaded:
+            try:
+                self.load()
+            except Exception:
+                # Queries are run by MongoDB until a refresh loads it
+                pass
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._poll)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _poll(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception:
+                # e.g. MongoDB is unreachable, or the collection outgrew
+                # max_documents
+                self.drop()
+
+    def _get_state(self):
+        state = self._state
+        if state is None:
+            raise UnsupportedQuery('The replica of %s isn\'t loaded.' % self.collection.full_name)
+        return state
+
+    def get(self, _id):
+        """
+        Return a copy of the raw document with the given _id, or None. Raise
+        UnsupportedQuery if the replica isn't loaded.
+        """
+        raw = self._get_state()[0].get(_id)
+        return copy.deepcopy(raw) if raw is not None else None
+
+    def find(self, query, sort=None, skip=0, limit=None):
+        """
+        Return copies of the raw documents matching the raw MongoDB filter
+        `query` (sorted by a list of (field, direction) tuples, then by
+        _id), with the given `skip` and `limit`, and the number of matching
+        documents. Raise UnsupportedQuery if `query` can't be run in memory
+        or the replica isn't loaded.
+        """
+        check_query(query)
+        docs, indexes = self._get_state()
+        ids = get_candidate_ids(query, indexes)
+        if ids is None:
+            candidates = docs.values()
+        else:
+            candidates = [docs[_id] for _id in _sorted(ids)]
+        matched = [doc for doc in candidates if match_query(doc, query)]
+        if sort:
+            sort_documents(matched, sort)
+        page = matched[skip:skip + limit] if limit is not None else matched[skip:]
+        return [copy.deepcopy(doc) for doc in page], len(matched)
+
+
+def _sorted(ids):
+    try:
+        return sorted(ids)
+    except TypeError: # _ids of different types
+        return list(ids)
+
+
+_replicas = {}
+_replicas_lock = threading.Lock()
+
+
+def get_hot_replica(collection, on_create=None, **kwargs):
+    """
+    Return the HotReplica of `collection` shared by all its resources in this
+    process, creating it (with the given kwargs, see HotReplica) on first use
+    in the process, e.g. in each worker forked by a pre-fork server.
+    `on_create(replica)` is called once, when the replica is created, by the
+    thread which created it. Meanwhile, the other threads get the replica
+    before it's loaded.
+    """
+    with _replicas_lock:
+        replica = _replicas.get(collection.full_name)
+        created = replica is None or replica.pid != os.getpid()
+        if created:
+            replica = _replicas[collection.full_name] = HotReplica(collection, **kwargs)
+    # Loading a replica mustn't hold up the replicas of other collections
+    if created and on_create:
+        on_create(replica)
+    return replica
+
+
+def handle_event(event):
+    """
+    Apply an invalidation bus event (see invalidation.py) to the replica of
+    the written collection in this process, if any (to all of them if the
+    event's 'ns' is None). Replicas which fail to apply it are dropped until
+    they're loaded again.
+    """
+    with _replicas_lock:
+        replicas = [replica for namespace, replica in _replicas.items()
+                    if replica.pid == os.getpid() and event.get('ns') in (None, namespace)]
+    for replica in replicas:
+        try:
+            replica.handle_event(event)
+        except Exception:
+            replica.drop()
@@ -1,9 +1,23 @@
 import json
+import base64
+import time
+import marshmallow
+from bson import json_util
 from bson.dbref import DBRef
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from flask import request, url_for
+from bson.son import SON
+from flask import request, url_for, copy_current_request_context, after_this_request, has_request_context
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, WriteError
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.results import InsertOneResult
+from pymongo.write_concern import WriteConcern
 from umongo.fields import ReferenceField, GenericReferenceField, ListField, DictField
+from umongo.exceptions import UpdateError, DeleteError
 from umongo.frameworks.pymongo import PyMongoReference
+from umongo.frameworks.tools import cook_find_filter
+from werkzeug.exceptions import Unauthorized
 
 try:
     from urllib.parse import urlparse
@@ -18,14 +32,61 @@ except ImportError:
     SafeReferenceField = None
 
 from cleancat import ValidationError as SchemaValidationError
-from flask_umongorest import methods
-from flask_umongorest.exceptions import ValidationError, UnknownFieldError
-from flask_umongorest.utils import cmp_fields, isbound, isint, equal
+from flask_umongorest import bulk, cache, concurrency, cost, indexes, methods, partitions, replica, \
+    response_cache, serialization
+from flask_umongorest.exceptions import ValidationError, UnknownFieldError, PreconditionFailed, \
+    BulkWriteInterrupted, UnsupportedQuery, Conflict
+from flask_umongorest.utils import cmp_fields, isbound, isint, equal, iter_json_array, iter_ndjson, \
+    get_field_converter, MongoEncoder
+
+# Atomic update operators which PATCH requests can use (see
+# Resource.atomic_fields)
+ATOMIC_OPERATORS = ('inc', 'push', 'addToSet', 'unset')
+
+# Read preference classes by mode name (see Resource.read_preferences)
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+# Error codes of MongoDB's duplicate key errors
+DUPLICATE_KEY_ERROR_CODES = (11000, 11001, 12582)
+
+# Field the text search score is projected to in raw documents (see
+# Resource.text_score_field)
+TEXT_SCORE = '_text_score'
+
+# Accumulators the aggregation endpoint supports (see
+# Resource.aggregate_accumulators). `count` doesn't take a field.
+AGGREGATE_ACCUMULATORS = ('count', 'sum', 'avg', 'min', 'max')
+
+
+def is_text_search(query_filter):
+    """Return whether a filter built by apply_filters contains a $text search."""
+    return '$text' in query_filter or any('$text' in clause for clause in query_filter.get('$and', []))
+
+
+# Resource classes by "<module>.<class name>" (see get_resource_class)
+_resource_classes = {}
+
+def get_resource_class(path):
+    """
+    Return the Resource class named `path` ("<module>.<class name>"), e.g.
+    to run the hooks of a resource in a job worker, or None if there's no
+    such class. Only the classes of the modules imported by this process are
+    known: `path` may come from a stored job spec, so modules are never
+    imported on its behalf.
+    """
+    return _resource_classes.get(path)
 
 
 class ResourceMeta(type):
     def __init__(cls, name, bases, classdict):
         type.__init__(cls, name, bases, classdict)
+        _resource_classes['%s.%s' % (cls.__module__, name)] = cls
 
 class Resource(object):
     # MongoEngine Document class related to this resource (required)
@@ -59,6 +120,284 @@ class Resource(object):
     # Maximum number of objects which can be bulk-updated by a single request
     bulk_update_limit = 1000
 
+    # How List requests query the database: 'find' runs a find cursor and a
+    # separate count, 'facet' gets the page and the total count from a single
+    # aggregation (see get_objects_with_facet). Note that the page of a
+    # 'facet' query must fit in a 16MB document.
+    list_query_mode = 'find'
+
+    # Name of the field the relevance score of a text search (see
+    # operators.Text) is included under in List responses. None doesn't
+    # include it.
+    text_score_field = None
+
+    # Value of the `_order_by` param ordering the results of a text search
+    # by relevance (most relevant first)
+    text_score_ordering = 'relevance'
+
+    # Maximum number of fields the `_order_by` param can list
+    max_ordering_keys = 3
+
+    # If True, requests ordering by fields which aren't in allowed_ordering
+    # (or by too many fields) are rejected with a 400. Otherwise, their
+    # ordering is ignored.
+    strict_ordering = False
+
+    # What to do with List requests and exports whose ordering can't be
+    # served by an index (see sort_indexes), which makes MongoDB sort all
+    # the matching documents in memory (and fail beyond its memory limit):
+    # None runs them anyway, 'reject' rejects them and 'cap' only runs them
+    # if at most in_memory_sort_limit documents match.
+    unindexed_sort_policy = None
+
+    # Maximum number of documents sorted in memory with the 'cap' policy
+    in_memory_sort_limit = 1000
+
+    # Key lists of the indexes which can serve sorts, e.g.
+    # [[('status', 1), ('created', -1)]], using database field names. None
+    # discovers the indexes of the collection (see indexes.IndexAdvisor).
+    sort_indexes = None
+
+    # Maximum estimated cost of the queries of List, export, aggregation
+    # and distinct requests (see cost.get_query_cost). More expensive
+    # requests are rejected before any query is run. None doesn't limit it.
+    max_query_cost = None
+
+    # Weights of the features of a query overriding cost.DEFAULT_WEIGHTS,
+    # e.g. { 'regex': 50 }
+    query_cost_weights = {}
+
+    # Time budget (in milliseconds) of each query of a request, applied as
+    # MongoDB's maxTimeMS. Queries exceeding it are aborted by the server and
+    # the request fails with a 504. None doesn't limit it.
+    max_time_ms = None
+
+    # Request header with which clients can lower the time budget of their
+    # queries (in milliseconds), but not raise it above max_time_ms. None
+    # ignores it.
+    timeout_header = 'X-Timeout-Ms'
+
+    # Time budget (in milliseconds) of the cursors of exports, which aren't
+    # bound by max_time_ms: maxTimeMS counts the time of all the batches of
+    # a cursor, so long streams would fail midway. None doesn't limit it.
+    export_max_time_ms = None
+
+    # Collation of the queries using case-insensitive operators (IExact,
+    # IStartswith), as a dict of pymongo Collation kwargs. Strength 2
+    # compares strings regardless of their case. The filtered fields need
+    # an index with the same collation to be searched efficiently.
+    collation = {'locale': 'en', 'strength': 2}
+
+    # If True, filter values are converted to the type of the filtered
+    # document field (e.g. int, float, datetime, ObjectId or bool) before
+    # they're applied, and invalid values are rejected. Otherwise, they're
+    # passed to the operators as strings.
+    coerce_filter_values = False
+
+    # If True, requests whose filters need an index the collection doesn't
+    # have (e.g. text searches without a text index) are rejected before
+    # they're run (see indexes.IndexAdvisor)
+    check_indexes = False
+
+    # If set, bulk updates don't load the matching documents (and aren't
+    # capped by bulk_update_limit). Instead, their ids are streamed from a
+    # cursor and the update is applied in bulk_write chunks of this size.
+    # Interrupted updates can be resumed with an `_after` param set to the
+    # `last_id` they reported.
+    bulk_update_chunk_size = None
+
+    # Number of chunks of a streamed bulk update which are written in
+    # parallel
+    bulk_update_workers = 1
+
+    # If True, bulk updates and bulk deletes are validated and handed over
+    # to the view's job_backend (see jobs.py) instead of being executed by
+    # the request. The response is a 202 Accepted pointing to a job
+    # resource which reports their progress.
+    bulk_jobs = False
+
+    # Bulk writes respond 400 to unknown filters, and bulk deletes to
+    # requests without filters. If True, a bulk delete without filters
+    # deletes all the documents if it's confirmed with `_all=1`.
+    allow_bulk_delete_all = False
+
+    # Number of documents written by each insert_many of an import
+    import_batch_size = 500
+
+    # Maximum number of invalid records an import reports (invalid records
+    # beyond this are still skipped and counted)
+    import_max_errors = 100
+
+    # Number of documents fetched per cursor batch by exports
+    export_batch_size = 1000
+
+    # Number of exported objects between two checkpoints (see export_objects)
+    export_checkpoint_interval = 1000
+
+    # Maximum number of _id ranges an export or a bulk write can be split
+    # into with the `_partitions` param. The ranges are scanned in parallel,
+    # one thread each. 1 disables partitioned scans.
+    max_scan_partitions = 1
+
+    # How the _id ranges of partitioned scans are computed: 'minmax'
+    # (interpolating between the smallest and largest _id) or 'sample'
+    # (quantiles of a $sample, for unevenly distributed _ids)
+    partition_method = 'minmax'
+
+    # Number of batches (of export_batch_size documents) each range of an
+    # ordered partitioned export can read ahead while the previous ranges
+    # are emitted. Ranges only run in parallel within this bound, so small
+    # values make ordered exports mostly serial; unordered exports
+    # (`_ordered=false`) aren't limited by it.
+    ordered_export_buffer = 16
+
+    # Number of worker processes List responses and exports serialize and
+    # encode their objects in (see serialization.py). None serializes them
+    # in the request's thread. Only used by pool-safe resources (see
+    # pool_safe).
+    serialization_processes = None
+
+    # Number of raw documents sent to a serialization worker at a time
+    serialization_batch_size = 100
+
+    # Whether the resource can serialize objects in worker processes: its
+    # class must be importable by the workers and its serialization
+    # (including callable fields and value_for_field) must not depend on the
+    # request context, the database or other per-process state. None means
+    # pool-safe unless some of the fields are callables of the resource, or
+    # the resource builds URIs (uri_prefix), has related_resources or
+    # overrides value_for_field.
+    pool_safe = None
+
+    # Fields the aggregation endpoint (see aggregate_objects) can group by
+    aggregate_group_by = []
+
+    # Dict of field names and the accumulators the aggregation endpoint can
+    # compute on them, e.g. { 'amount': ['sum', 'avg'] }. Supported
+    # accumulators are 'sum', 'avg', 'min' and 'max'; 'count' is always
+    # allowed.
+    aggregate_accumulators = {}
+
+    # Whether aggregations may write temporary files when they exceed
+    # MongoDB's memory limit for pipeline stages
+    aggregate_allow_disk_use = False
+
+    # Maximum number of groups an aggregation returns
+    aggregate_max_groups = 1000
+
+    # Maximum number of values the distinct endpoint (see distinct_values)
+    # returns
+    distinct_max_values = 1000
+
+    # Number of seconds the distinct values are cached for (0 disables
+    # caching). The writes of this process invalidate them right away (see
+    # after_write); the writes of other processes after the TTL.
+    distinct_cache_ttl = 60
+
+    # Cache of the distinct values, shared by all the resources
+    distinct_cache = cache.TTLCache(max_entries=1000)
+
+    # Dict of field names and the atomic operators a PATCH request may apply
+    # to them, e.g. { 'views': ['inc'], 'tags': ['push', 'addToSet'] }.
+    # Supported operators are 'inc', 'push', 'addToSet' and 'unset'.
+    atomic_fields = {}
+
+    # Name of an integer document field holding the document's version. If
+    # set, the version is exposed as an ETag, incremented by every update and
+    # updates are conditioned on it, so PUT and PATCH requests with a stale
+    # If-Match header (or racing with another writer) fail with a 412.
+    version_field = None
+
+    # Whether a PUT to a pk URL creates the document if it doesn't exist yet
+    # (create-or-replace semantics), using a single upsert.
+    allow_upsert = False
+
+    # Write concern used for this resource's writes, as a dict of
+    # pymongo.WriteConcern kwargs (e.g. { 'w': 'majority' }). None uses the
+    # default write concern of the client.
+    write_concern = None
+
+    # Map of method classes (see methods.py) to write concerns overriding
+    # `write_concern` for that view method, e.g. { methods.Delete: {'w': 1} }
+    method_write_concerns = {}
+
+    # Named write concerns a request can choose with the `_write_concern`
+    # param, e.g. { 'fast': {'w': 1, 'j': False} }. Requests can't pick a
+    # write concern which isn't listed here.
+    write_concern_overrides = {}
+
+    # Map of method classes (see methods.py) to the read preference of their
+    # reads, as a dict with a `mode` (e.g. 'secondaryPreferred') and the
+    # kwargs of its pymongo read preference class, e.g.
+    # { methods.List: {'mode': 'secondaryPreferred', 'max_staleness': 90} }.
+    # Other view methods read with the collection's read preference.
+    read_preferences = {}
+
+    # Number of seconds after a write during which the reads of the client
+    # that wrote go to the primary, so it sees its own writes despite
+    # `read_preferences`. The client is tracked with the
+    # `read_your_writes_cookie` cookie. 0 disables it.
+    read_your_writes_window = 0
+    read_your_writes_cookie = 'umongorest_primary_until'
+
+    # If True, concurrent identical List and Fetch requests (same path,
+    # params, rendering and auth scope, see ResourceView.get_auth_scope) wait
+    # for the first one and share its response instead of querying again.
+    # Only enable it for resources whose responses don't depend on anything
+    # else about the request.
+    single_flight = False
+
+    # response_cache.ResponseCache storing the rendered List and Fetch
+    # responses of this resource, shared by all the processes using the
+    # same backend (e.g. ResponseCache(RedisBackend('cache-host'))). Cached
+    # responses are keyed like single_flight ones and invalidated by every
+    # write of the collection, whichever resource makes it.
+    response_cache = None
+
+    # Number of seconds cached responses are fresh for, and then served
+    # stale for while they're rendered again in the background
+    response_cache_ttl = 10
+    response_cache_stale_ttl = 60
+
+    # invalidation.InvalidationBus publishing the writes of this resource to
+    # the other processes, which evict what they cached from its collection
+    # (e.g. distinct values or the hot replica). Receiving events requires
+    # starting the bus in every process.
+    invalidation_bus = None
+
+    # If True, the whole collection is kept in the memory of every process
+    # (see replica.HotReplica) and List and Fetch requests are answered from
+    # it, without querying MongoDB. Only meant for small collections which
+    # are read constantly (e.g. lookup tables). Filters the replica can't
+    # run in Python (e.g. case-insensitive or text search ones) still query
+    # MongoDB.
+    hot_replica = False
+
+    # Document field holding the time each document was last updated. If
+    # set, the replica polls the documents updated since its last refresh
+    # every `hot_replica_poll_interval` seconds (and reloads the collection
+    # every `hot_replica_reload_interval` seconds to drop deleted ones);
+    # otherwise it reloads the collection. The replica also applies the
+    # events of the `invalidation_bus`, if any.
+    hot_replica_updated_field = None
+    hot_replica_poll_interval = 5
+    hot_replica_reload_interval = 300
+
+    # Maximum number of documents of the collection the replica loads
+    hot_replica_max_documents = 10000
+
+    # If True, created objects are validated individually but written
+    # together with the objects created by concurrent requests, using one
+    # unordered insert_many per batch (see concurrency.GroupCommitter).
+    group_commit = False
+
+    # Maximum time (in seconds) a created object waits for others to join
+    # its batch
+    group_commit_window = 0.005
+
+    # Maximum number of objects in a batch
+    group_commit_max_size = 100
+
     # Map of MongoEngine Document classes to Resource class names. Defines
     # which sub-resource should be used for handling a particular subclass of
     # this resource's document.
@@ -131,7 +470,7 @@ class Resource(object):
     def raw_data(self):
         """Validate and return parsed JSON payload."""
         if not hasattr(self, '_raw_data'):
-            if request.method in ('PUT', 'POST') or request.data:
+            if request.method in ('PUT', 'POST', 'PATCH') or request.data:
                 if request.mimetype and 'json' not in request.mimetype:
                     raise ValidationError({'error': "Please send valid JSON with a 'Content-Type: application/json' header."})
                 if request.headers.get('Transfer-Encoding') == 'chunked':
@@ -443,6 +782,11 @@ class Resource(object):
                     except UnknownFieldError:
                         pass
 
+        # Include the relevance of text search results
+        text_scores = getattr(self, '_text_scores', None)
+        if text_scores and self.text_score_field and obj.pk in text_scores:
+            data[self.text_score_field] = text_scores[obj.pk]
+
         return data
 
     def handle_serialization_error(self, exc, obj):
@@ -514,7 +858,16 @@ class Resource(object):
         Given a PK and an optional queryset filter function, find a matching
         document in the queryset.
         """
-        return self.document.find_one({"id":ObjectId(pk)})
+        if self.uses_hot_replica():
+            try:
+                raw = self.get_hot_replica().get(ObjectId(pk))
+                return self.document.build_from_mongo(raw, use_cls=True) if raw is not None else None
+            except UnsupportedQuery:
+                # The replica isn't loaded
+                pass
+        raw = self.get_read_collection().find_one(cook_find_filter(self.document, {"id": ObjectId(pk)}),
+                                                  **self.get_query_options(params={}))
+        return self.document.build_from_mongo(raw, use_cls=True) if raw is not None else None
 
     def apply_filters(self, params=None):
         """
@@ -525,8 +878,8 @@ class Resource(object):
         if params is None:
             params = self.params
         filters = []
+        collation = self.get_collation(params)
         for key, value in params.items():
-            allowed_operators = None
             # If this is a resource identified by a URI, we need
             # to extract the object id at this point since
             # MongoEngine only understands the object id
@@ -542,59 +895,208 @@ class Resource(object):
             elif value in ['""', "''"]:
                 value = ''
 
-            negate = False
-            op_name = ''
-            parts = key.split('__')
-            for i in range(len(parts) + 1, 0, -1):
-                field = '__'.join(parts[:i])
-                allowed_operators = self._filters.get(field)
-                if allowed_operators:
-                    parts = parts[i:]
-                    break
-            if allowed_operators is None:
-                continue
-
-            if parts:
-                # either an operator or a query lookup!  See what's allowed.
-                op_name = parts[-1]
-                if op_name in allowed_operators:
-                    # operator; drop it
-                    parts.pop()
-                else:
-                    # assume it's part of a lookup
-                    op_name = ''
-                if parts and parts[-1] == 'not':
-                    negate = True
-                    parts.pop()
-
-            operator = allowed_operators.get(op_name, None)
-            if operator is None:
-                continue
-            if negate and not operator.allow_negation:
+            parsed = self.parse_filter_param(key)
+            if parsed is None:
                 continue
-            if parts:
-                field = '%s__%s' % (field, '__'.join(parts))
-            field = self._reverse_rename_fields.get(field, field)
+            field, operator, negate = parsed
 
-            filters.append((operator().apply(field, value, negate)))
+            operator = operator()
+            if self.coerce_filter_values and value is not None and operator.coerce_value:
+                value = self.coerce_filter_value(key, field, operator, value)
+            if operator.uses_collation and collation is None:
+                filters.append(operator.apply_without_collation(field, value, negate))
+            else:
+                filters.append((operator.apply(field, value, negate)))
         if len(filters):
             return {'$and':filters}
         else:
             return {}
 
+    def parse_filter_param(self, key):
+        """
+        Return a (field, operator class, negate) tuple for the filter param
+        `key` (e.g. "name__not__in"), or None if it isn't an allowed filter.
+        """
+        negate = False
+        op_name = ''
+        parts = key.split('__')
+        allowed_operators = None
+        for i in range(len(parts) + 1, 0, -1):
+            field = '__'.join(parts[:i])
+            allowed_operators = self._filters.get(field)
+            if allowed_operators:
+                parts = parts[i:]
+                break
+        if allowed_operators is None:
+            return None
+
+        if parts:
+            # either an operator or a query lookup!  See what's allowed.
+            op_name = parts[-1]
+            if op_name in allowed_operators:
+                # operator; drop it
+                parts.pop()
+            else:
+                # assume it's part of a lookup
+                op_name = ''
+            if parts and parts[-1] == 'not':
+                negate = True
+                parts.pop()
+
+        operator = allowed_operators.get(op_name, None)
+        if operator is None:
+            return None
+        if negate and not operator.allow_negation:
+            return None
+        if parts:
+            field = '%s__%s' % (field, '__'.join(parts))
+        field = self._reverse_rename_fields.get(field, field)
+        return field, operator, negate
+
+    def get_collation_fields(self, params=None):
+        """
+        Return the set of fields the filters of `params` (the request's by
+        default) filter with operators which need the resource's collation
+        (e.g. IExact).
+        """
+        if params is None:
+            params = self.params
+        parsed = [self.parse_filter_param(key) for key in params]
+        return set(field for field, operator, _ in filter(None, parsed) if operator.uses_collation)
+
+    def get_collation(self, params=None):
+        """
+        Return the collation of the query apply_filters builds for `params`
+        (the request's by default): the resource's `collation` if its
+        filters use operators which need it (e.g. IExact), None otherwise.
+
+        A collation applies to the whole query, so when other filters would
+        be affected by it (e.g. Exact), the case-insensitive ones fall back
+        to regexes (which can't use the collation's indexes) to keep the
+        others case-sensitive.
+        """
+        if params is None:
+            params = self.params
+        operators = [parsed[1] for parsed in map(self.parse_filter_param, params) if parsed is not None]
+        if not any(operator.uses_collation for operator in operators):
+            return None
+        if any(operator.collation_sensitive and not operator.uses_collation for operator in operators):
+            return None
+        return self.collation
+
+    def get_max_time_ms(self):
+        """
+        Return the time budget (in milliseconds) of each query of the request
+        that's currently being processed: the resource's max_time_ms, or
+        less if the request's `timeout_header` asks for less. None doesn't
+        limit it.
+        """
+        max_time_ms = self.max_time_ms
+        header = request.headers.get(self.timeout_header) if self.timeout_header else None
+        if header:
+            if not isint(header) or int(header) <= 0:
+                raise ValidationError({'error': '%s must be a positive integer.' % self.timeout_header})
+            max_time_ms = min(int(header), max_time_ms or int(header))
+        return max_time_ms
+
+    def get_query_options(self, aggregate=False, params=None):
+        """
+        Return the kwargs of the find (or, if `aggregate`, aggregate) calls
+        running the queries apply_filters builds for `params` (the
+        request's by default).
+        """
+        options = {}
+        collation = self.get_collation(params)
+        if collation:
+            options['collation'] = collation
+        max_time_ms = self.get_max_time_ms()
+        if max_time_ms:
+            options['maxTimeMS' if aggregate else 'max_time_ms'] = max_time_ms
+        return options
+
+    def get_export_query_options(self, params=None):
+        """
+        Return the kwargs of the find calls of exports (see
+        get_query_options), bound by export_max_time_ms rather than the
+        request's time budget.
+        """
+        options = self.get_query_options(params=params)
+        options.pop('max_time_ms', None)
+        if self.export_max_time_ms:
+            options['max_time_ms'] = self.export_max_time_ms
+        return options
+
+    @classmethod
+    def get_filter_converters(cls):
+        """
+        Return a dict of document field names and the functions converting
+        query string values to their type (see utils.get_field_converter).
+        The table is built once per resource class.
+        """
+        converters = cls.__dict__.get('_filter_converters')
+        if converters is None:
+            converters = {}
+            for name, field in cls.document.DataProxy._fields.items():
+                converter = get_field_converter(field)
+                if converter is not None:
+                    converters[name] = converter
+            cls._filter_converters = converters
+        return converters
+
+    def coerce_filter_value(self, key, field, operator, value):
+        """
+        Convert the value of the `key` query string param (filtering `field`
+        with `operator`) to the type of the field, so that it's compared
+        with values of the same type and can use the field's indexes. Raise
+        a ValidationError if it's invalid.
+        """
+        converter = self.get_filter_converters().get(field)
+        if converter is None:
+            return value
+        try:
+            return operator.clean_value(value, converter)
+        except (ValueError, TypeError, ArithmeticError, InvalidId):
+            raise ValidationError({'field-errors': {key: 'Invalid value: "%s".' % value}})
+
     def apply_ordering(self, params=None):
         """
         Given this resource's allowed_ordering, and the params of the request
-        that's currently being processed, apply ordering to the queryset
-        and return it.
+        that's currently being processed, return the requested ordering as a
+        list of document field names, prefixed with `-` if descending, or
+        None.
+
+        The `_order_by` param is a comma-separated list of fields, each
+        optionally prefixed with `-` (descending) or `+` (ascending), e.g.
+        `-created,name`. Each field must be listed in allowed_ordering, and
+        there can be at most max_ordering_keys of them. Invalid orderings
+        are ignored, or rejected if strict_ordering is set.
         """
         if params is None:
             params = self.params
-        if self.allowed_ordering and params.get('_order_by') in self.allowed_ordering:
-            order_params = [self._reverse_rename_fields.get(p, p) for p in params['_order_by'].split(',')]
-            return order_params
-        else:
+        order_by = params.get('_order_by')
+        if not order_by or not self.allowed_ordering or order_by == self.text_score_ordering:
             return None
+        allowed = set(field.strip().lstrip('-+') for fields in self.allowed_ordering for field in fields.split(','))
+        ordering = []
+        for key in order_by.split(','):
+            name = key.strip().lstrip('-+')
+            field = self._reverse_rename_fields.get(name, name)
+            if name not in allowed and field not in allowed:
+                return self.reject_ordering("Can't order by %s." % name)
+            ordering.append(('-' if key.strip().startswith('-') else '') + field)
+        if len(ordering) > self.max_ordering_keys:
+            return self.reject_ordering("Can't order by more than %d fields." % self.max_ordering_keys)
+        return ordering
+
+    def reject_ordering(self, error):
+        """
+        Called by apply_ordering with an `error` message when the request's
+        ordering is invalid. Return None to ignore the ordering, or raise a
+        ValidationError if strict_ordering is set.
+        """
+        if self.strict_ordering:
+            raise ValidationError({'error': error})
+        return None
 
     def get_skip_and_limit(self, params=None):
         """
@@ -636,10 +1138,27 @@ class Resource(object):
         # Apply filters and ordering, based on the params supplied by the
         # request
         query_filter = self.apply_filters(params)
-        query_order = self.apply_ordering(params)
+        query_order = self.get_db_sort(params)
+
+        # The replica runs queries and sorts in memory, so the policies
+        # protecting MongoDB only apply to the queries it can't run
+        if self.uses_hot_replica():
+            try:
+                return self.get_objects_from_replica(query_filter, query_order, params)
+            except UnsupportedQuery:
+                pass
+        self.check_query_indexes(query_filter, params)
+        if self.view_method != methods.BulkUpdate:
+            self.check_query_cost(query_filter, skip=self.get_skip_and_limit(params)[0])
+            self.check_sort(query_filter, query_order)
+        if self.uses_text_score(query_filter, params):
+            return self.get_objects_with_text_score(query_filter, params)
+        if self.list_query_mode == 'facet' and self.view_method != methods.BulkUpdate:
+            return self.get_objects_with_facet(query_filter, params)
 
         # Create the query cureser
-        query_courser = self.document.find(query_filter)
+        query_courser = self.get_read_collection().find(cook_find_filter(self.document, query_filter),
+                                                        **self.get_query_options(params=params))
 
         # Apply limit and skip to the queryset
         limit = None
@@ -656,7 +1175,7 @@ class Resource(object):
 
         count = query_courser.count()
         # Evaluate the queryset
-        objs = list(query_courser)
+        objs = [self.document.build_from_mongo(raw, use_cls=True) for raw in query_courser]
 
         # Raise a validation error if bulk update would result in more than
         # bulk_update_limit updates
@@ -675,10 +1194,842 @@ class Resource(object):
 
         return objs, has_more, count
 
+    def uses_hot_replica(self):
+        """
+        Return whether the request that's currently being processed is
+        answered from the hot replica (see hot_replica).
+        """
+        if not self.hot_replica or self.view_method not in (methods.List, methods.Fetch):
+            return False
+        # The replicas of the other processes may not have the client's
+        # writes yet
+        if self.is_pinned_to_primary():
+            return False
+        return not self.get_collation_fields()
+
+    def get_hot_replica(self):
+        """
+        Return the HotReplica of the resource's collection, loading it and
+        starting its refreshes on first use in the process.
+        """
+        def on_create(hot_replica):
+            hot_replica.start()
+            if self.invalidation_bus is not None:
+                self.invalidation_bus.subscribe(replica.handle_event)
+
+        updated_field = self.hot_replica_updated_field
+        return replica.get_hot_replica(
+            self.document.collection, on_create=on_create,
+            index_fields=[self.get_db_field_name(self._reverse_rename_fields.get(field, field))
+                          for field in self._filters],
+            updated_field=self.get_db_field_name(updated_field) if updated_field else None,
+            poll_interval=self.hot_replica_poll_interval,
+            reload_interval=self.hot_replica_reload_interval,
+            max_documents=self.hot_replica_max_documents)
+
+    def get_objects_from_replica(self, query_filter, query_order, params):
+        """
+        Return the objects, has_more and count of a List request from the
+        hot replica. Raise UnsupportedQuery if it can't run `query_filter`.
+        """
+        skip, limit = self.get_skip_and_limit(params)
+        raws, count = self.get_hot_replica().find(cook_find_filter(self.document, query_filter),
+                                                  sort=query_order, skip=skip, limit=limit + 1)
+        objs = [self.document.build_from_mongo(raw, use_cls=True) for raw in raws]
+        if self.paginate:
+            has_more = len(objs) > limit
+            if has_more:
+                objs = objs[:-1]
+        else:
+            has_more = None
+        return objs, has_more, count
+
+    def get_index_advisor(self):
+        """Return the IndexAdvisor of the resource's collection."""
+        return indexes.get_index_advisor(self.document.collection)
+
+    def check_query_indexes(self, query_filter, params=None):
+        """
+        Raise a ValidationError if `check_indexes` is set and `query_filter`
+        (see apply_filters, which built it from `params`) needs an index the
+        collection doesn't have.
+        """
+        if not self.check_indexes:
+            return
+        advisor = self.get_index_advisor()
+        if is_text_search(query_filter) and not advisor.has_text_index():
+            raise ValidationError({'error': 'Text search is not available for this resource.'})
+        collation_fields = self.get_collation_fields(params) if self.get_collation(params) else ()
+        for field in collation_fields:
+            if not advisor.has_collation_index(self.get_db_field_name(field), self.collation):
+                name = self._rename_fields.get(field, field)
+                raise ValidationError({'error': 'Case-insensitive filtering is not available for %s.' % name})
+
+    def uses_text_score(self, query_filter, params):
+        """
+        Return whether the List request's text search score is needed, to be
+        included in the response or to order by relevance.
+        """
+        if self.view_method == methods.BulkUpdate or not is_text_search(query_filter):
+            return False
+        return bool(self.text_score_field) or params.get('_order_by') == self.text_score_ordering
+
+    def get_objects_with_text_score(self, query_filter, params):
+        """
+        Return the objects, has_more and count of a List request with a text
+        search, projecting the relevance score of each object (see
+        text_score_field and text_score_ordering).
+        """
+        skip, limit = self.get_skip_and_limit(params)
+        score = {'$meta': 'textScore'}
+        cursor = self.get_read_collection().find(cook_find_filter(self.document, query_filter),
+                                                 projection={TEXT_SCORE: score},
+                                                 **self.get_query_options(params=params))
+        if params.get('_order_by') == self.text_score_ordering:
+            cursor = cursor.sort([(TEXT_SCORE, score)])
+        else:
+            sort = self.get_db_sort(params)
+            if sort:
+                cursor = cursor.sort(sort)
+        count = cursor.count()
+        objs = []
+        self._text_scores = {}
+        for raw in cursor.skip(skip).limit(limit + 1):
+            self._text_scores[raw['_id']] = raw.pop(TEXT_SCORE, None)
+            objs.append(self.document.build_from_mongo(raw, use_cls=True))
+        if self.paginate:
+            has_more = len(objs) > limit
+            if has_more:
+                objs = objs[:-1]
+        else:
+            has_more = None
+        return objs, has_more, count
+
+    def get_sort_indexes(self):
+        """
+        Return the key lists of the indexes which can serve sorts: the
+        declared `sort_indexes`, or the indexes of the collection.
+        """
+        if self.sort_indexes is not None:
+            return self.sort_indexes
+        return [index['key'] for index in self.get_index_advisor().get_indexes().values()]
+
+    def check_query_cost(self, query_filter, skip=0):
+        """
+        Raise a ValidationError if the estimated cost of a query filtered by
+        `query_filter` (see apply_filters) and skipping `skip` documents
+        exceeds max_query_cost. Index coverage is only accounted for when
+        the indexes are known (see check_indexes and sort_indexes).
+        """
+        if self.max_query_cost is None:
+            return
+        index_keys = None
+        if self.sort_indexes is not None or self.check_indexes:
+            index_keys = self.get_sort_indexes()
+        query_cost = cost.get_query_cost(cook_find_filter(self.document, query_filter), skip=skip,
+                                         index_keys=index_keys, weights=self.query_cost_weights)
+        if query_cost > self.max_query_cost:
+            raise ValidationError({'error': 'This query is too expensive (cost %g, maximum %g). '
+                                            'Use fewer or more selective filters.'
+                                            % (query_cost, self.max_query_cost)})
+
+    def check_sort(self, query_filter, sort):
+        """
+        Enforce `unindexed_sort_policy` if the `sort` (see get_db_sort) of a
+        query filtered by `query_filter` (see apply_filters) can't be served
+        by an index, which makes MongoDB sort the matching documents in
+        memory.
+        """
+        if not sort or not self.unindexed_sort_policy:
+            return
+        query = cook_find_filter(self.document, query_filter)
+        if indexes.can_sort(self.get_sort_indexes(), sort, indexes.get_equality_fields(query)):
+            return
+        error = {'error': 'This ordering requires an index the collection doesn\'t have. '
+                          'Use another ordering or narrow the filters.'}
+        if self.unindexed_sort_policy == 'reject':
+            raise ValidationError(error)
+        # Only sort small enough results in memory
+        cursor = self.get_collection().find(query, projection={'_id': 1}, **self.get_query_options())
+        if cursor.limit(self.in_memory_sort_limit + 1).count(with_limit_and_skip=True) > self.in_memory_sort_limit:
+            raise ValidationError(error)
+
+    def get_list_pipeline(self, query_filter, params):
+        """
+        Return the aggregation pipeline of a 'facet' List query: a $match
+        stage with the request's filters and a $sort stage (before the
+        $facet, so that it can use an index) followed by a $facet stage
+        with a `page` branch (one more object than the limit, so we know if
+        there are more) and a `count` branch.
+        """
+        skip, limit = self.get_skip_and_limit(params)
+        pipeline = [{'$match': cook_find_filter(self.document, query_filter)}]
+        sort = self.get_db_sort(params)
+        if sort:
+            pipeline.append({'$sort': SON(sort)})
+        pipeline.append({'$facet': {
+            'page': [{'$skip': skip}, {'$limit': limit + 1}],
+            'count': [{'$count': 'count'}],
+        }})
+        return pipeline
+
+    def get_objects_with_facet(self, query_filter, params):
+        """
+        Return the objects, has_more and count of a List request fetched
+        with a single aggregation (see get_list_pipeline).
+        """
+        skip, limit = self.get_skip_and_limit(params)
+        pipeline = self.get_list_pipeline(query_filter, params)
+        result = next(self.get_read_collection().aggregate(pipeline,
+                                                           **self.get_query_options(aggregate=True, params=params)),
+                      None) or {}
+        objs = [self.document.build_from_mongo(raw, use_cls=True) for raw in result.get('page', [])]
+        count = result['count'][0]['count'] if result.get('count') else 0
+        if self.paginate:
+            has_more = len(objs) > limit
+            if has_more:
+                objs = objs[:-1]
+        else:
+            has_more = None
+        return objs, has_more, count
+
+    def get_db_field_name(self, field):
+        """Return the name `field` (a document field name) has in the database."""
+        doc_field = self.document.DataProxy._fields.get(field)
+        if doc_field is None:
+            return field
+        return doc_field.attribute or field
+
+    def get_db_sort(self, params=None):
+        """
+        Return the ordering of the request that's currently being processed
+        (see apply_ordering) as a list of (database field name, direction)
+        tuples.
+        """
+        return [(self.get_db_field_name(key.lstrip('-')), -1 if key.startswith('-') else 1)
+                for key in self.apply_ordering(params) or []]
+
+    def get_checkpoint(self, raw, sort):
+        """
+        Return an opaque token identifying the position of the raw document
+        `raw` in an export sorted by `sort` (see get_db_sort).
+        """
+        position = {'s': [raw.get(field) for field, _ in sort], 'id': raw['_id']}
+        return base64.urlsafe_b64encode(json_util.dumps(position).encode('utf-8')).decode('ascii')
+
+    def get_resume_filter(self, checkpoint, sort):
+        """
+        Return a raw MongoDB filter matching the documents which come after
+        the `checkpoint` token in an export sorted by `sort` (followed by
+        _id).
+        """
+        try:
+            position = json_util.loads(base64.urlsafe_b64decode(checkpoint.encode('ascii')).decode('utf-8'))
+            values = position['s'] + [position['id']]
+        except (ValueError, TypeError, KeyError):
+            raise ValidationError({'error': '_resume must be a checkpoint of an export.'})
+        keys = sort + [('_id', 1)]
+        if len(values) != len(keys):
+            raise ValidationError({'error': '_resume must be a checkpoint of an export with the same ordering.'})
+        # Keyset pagination: the documents with the same values for the
+        # first i keys and a greater (or smaller) value for the i-th one.
+        clauses = []
+        for i, (field, direction) in enumerate(keys):
+            clause = dict((keys[j][0], values[j]) for j in range(i))
+            value = values[i]
+            # Nulls and missing values sort before any other value, and
+            # comparisons with null never match
+            if value is None:
+                if direction != 1:
+                    continue
+                clause[field] = {'$ne': None}
+            elif direction == 1:
+                clause[field] = {'$gt': value}
+            else:
+                clause['$or'] = [{field: {'$lt': value}}, {field: None}]
+            clauses.append(clause)
+        return {'$or': clauses}
+
+    def get_scan_partitions(self, params=None):
+        """
+        Return the number of _id ranges the export (or bulk write) of the
+        request that's currently being processed is split into (its
+        `_partitions` param, capped by max_scan_partitions).
+        """
+        if params is None:
+            params = self.params
+        partition_count = params.get('_partitions') or 1
+        if not isint(partition_count) or int(partition_count) < 1:
+            raise ValidationError({'error': '_partitions must be a positive integer.'})
+        return min(int(partition_count), self.max_scan_partitions)
+
+    def get_export_cursor(self, params=None):
+        """
+        Return a raw cursor over all the documents matching the filters of
+        the request that's currently being processed, sorted by its ordering
+        followed by _id, starting after the `_resume` checkpoint.
+        """
+        if params is None:
+            params = self.params
+        sort = self.get_db_sort(params)
+        query = self.get_export_query(params, sort)
+        cursor = self.get_read_collection().find(query, sort=sort + [('_id', 1)],
+                                                 **self.get_export_query_options(params))
+        return cursor.batch_size(self.export_batch_size), sort
+
+    def get_export_query(self, params, sort):
+        """
+        Return the raw MongoDB filter of the documents an export (sorted by
+        `sort`) still has to emit.
+        """
+        query_filter = self.apply_filters(params)
+        self.check_query_cost(query_filter)
+        # The cursor breaks ties by _id (see get_export_cursor)
+        self.check_sort(query_filter, sort + [('_id', 1)])
+        query = cook_find_filter(self.document, query_filter)
+        if params.get('_resume'):
+            resume_filter = self.get_resume_filter(params['_resume'], sort)
+            query = {'$and': [query, resume_filter]} if query else resume_filter
+        return query
+
+    def is_pool_safe(self):
+        """Return whether objects can be serialized in worker processes (see pool_safe)."""
+        if self.pool_safe is not None:
+            return self.pool_safe
+        # URIs are built with url_for, which needs the request context, and
+        # related objects and custom values may be loaded from the database
+        if self.uri_prefix or getattr(self, 'related_resources', None):
+            return False
+        value_for_field = getattr(type(self).value_for_field, '__func__', type(self).value_for_field)
+        if value_for_field is not Resource.__dict__['value_for_field']:
+            return False
+        fields = list(self.get_fields()) + list(self.get_optional_fields())
+        return not any(callable(getattr(self, field, None)) for field in fields)
+
+    def uses_serialization_pool(self):
+        """Return whether objects are serialized in worker processes."""
+        # Text search scores aren't part of the documents sent to the workers
+        if getattr(self, '_text_scores', None):
+            return False
+        return bool(self.serialization_processes) and self.is_pool_safe()
+
+    def iter_encoded(self, rows, params):
+        """
+        Serialize and encode the raw documents of `rows`, an iterable of
+        (key, raw document) tuples, and yield (key, encoded JSON) tuples in
+        the same order, skipping the objects which can't be serialized. The
+        work is done by worker processes if the resource uses a
+        serialization pool.
+        """
+        if self.uses_serialization_pool():
+            return serialization.serialize_in_pool(self, rows, params, self.serialization_processes,
+                                                   self.serialization_batch_size)
+        encoded_rows = ((key, serialization.serialize_raw(self, raw, params)) for key, raw in rows)
+        return ((key, encoded) for key, encoded in encoded_rows if encoded is not None)
+
+    def get_encoded_objects(self, objs, params):
+        """
+        Return the list of the encoded JSON serializations of `objs` (see
+        iter_encoded).
+        """
+        rows = ((None, obj.to_mongo()) for obj in objs)
+        return [encoded for _, encoded in self.iter_encoded(rows, params)]
+
+    def iter_export_rows(self, cursor, sort, params):
+        """
+        Yield a (position, encoded object) tuple per document of a raw
+        export `cursor`, skipping the objects which can't be serialized. The
+        position holds the values of the `sort` fields and _id of the
+        document (see get_checkpoint).
+        """
+        def rows():
+            for raw in cursor:
+                position = dict((field, raw.get(field)) for field, _ in sort)
+                position['_id'] = raw['_id']
+                yield position, raw
+        return self.iter_encoded(rows(), params)
+
+    def iter_partitioned_export_rows(self, query, partition_count, ordered, params):
+        """
+        Split the documents matching `query` into `partition_count` _id ranges
+        which are read and serialized in parallel threads, and yield their
+        rows (see iter_export_rows). If `ordered`, the rows are yielded in
+        _id order; otherwise in whichever order the ranges produce them.
+        """
+        collection = self.get_read_collection()
+        options = self.get_export_query_options()
+        boundaries = partitions.get_boundaries(collection, query, partition_count, self.partition_method)
+        queries = partitions.partition_queries(query, boundaries)
+
+        def scan(partition_query):
+            cursor = collection.find(partition_query, sort=[('_id', 1)], **options).batch_size(self.export_batch_size)
+            # Hand over whole batches to limit the synchronization overhead
+            batch = []
+            for row in self.iter_export_rows(cursor, [], params):
+                batch.append(row)
+                if len(batch) == self.export_batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        batches = partitions.scan_partitions(queries, scan, workers=len(queries), ordered=ordered,
+                                             queue_size=self.ordered_export_buffer,
+                                             wrap=copy_current_request_context)
+        for batch in batches:
+            for row in batch:
+                yield row
+
+    def export_objects(self, params=None):
+        """
+        Serialize all the objects matching the request that's currently
+        being processed and return a tuple of a generator of encoded chunks
+        and their mimetype. The `_format` param selects NDJSON (the default)
+        or a JSON array (`_format=json`).
+
+        Every `export_checkpoint_interval` objects, a `{"_checkpoint": ...}`
+        object is emitted. A dropped export can be continued by passing the
+        last checkpoint it received as the `_resume` param.
+
+        With a `_partitions` param (see get_scan_partitions), the export
+        is split into _id ranges scanned in parallel. Partitioned exports
+        can't be ordered; they're emitted in _id order unless `_ordered` is
+        false, in which case they're emitted as soon as they're serialized
+        and without checkpoints.
+        """
+        if params is None:
+            params = self.params
+        export_format = params.get('_format', 'ndjson')
+        if export_format not in ('ndjson', 'json'):
+            raise ValidationError({'error': '_format must be "ndjson" or "json".'})
+        # Validate the request before starting to stream
+        partition_count = self.get_scan_partitions(params)
+        ordered = params.get('_ordered', 'true').lower() not in ('false', '0')
+        if partition_count > 1:
+            sort = self.get_db_sort(params)
+            if sort:
+                raise ValidationError({'error': 'Partitioned exports can\'t be ordered.'})
+            if not ordered and params.get('_resume'):
+                raise ValidationError({'error': 'Unordered exports can\'t be resumed.'})
+            rows = self.iter_partitioned_export_rows(self.get_export_query(params, sort),
+                                                     partition_count, ordered, request.args)
+        else:
+            cursor, sort = self.get_export_cursor(params)
+            rows = self.iter_export_rows(cursor, sort, request.args)
+        encode = lambda data: json.dumps(data, allow_nan=False, cls=MongoEncoder)
+        separator = '\n' if export_format == 'ndjson' else ','
+
+        def generate():
+            first = True
+            count = 0
+            if export_format == 'json':
+                yield '['
+            for position, chunk in rows:
+                count += 1
+                if ordered and count % self.export_checkpoint_interval == 0:
+                    chunk += separator + encode({'_checkpoint': self.get_checkpoint(position, sort)})
+                if export_format == 'ndjson':
+                    yield chunk + separator
+                else:
+                    yield chunk if first else separator + chunk
+                first = False
+            if export_format == 'json':
+                yield ']'
+
+        mimetype = 'application/x-ndjson' if export_format == 'ndjson' else 'application/json'
+        return generate(), mimetype
+
+    def get_aggregate_group_by(self, params):
+        """
+        Return the (response field name, document field name) tuples of the
+        fields listed in the `_group_by` param, which must be allowed by
+        aggregate_group_by.
+        """
+        group_by = []
+        for name in filter(None, params.get('_group_by', '').split(',')):
+            field = self._reverse_rename_fields.get(name, name)
+            if field not in self.aggregate_group_by:
+                raise ValidationError({'error': "Can't group by %s." % name})
+            group_by.append((self._rename_fields.get(field, field), field))
+        return group_by
+
+    def get_aggregate_accumulators(self, params):
+        """
+        Return the (response field name, accumulator, document field name)
+        tuples of the accumulators listed in the `_aggregate` param (`count`
+        by default). Accumulators other than `count` are requested as
+        `<field>__<accumulator>` and must be allowed by
+        aggregate_accumulators.
+        """
+        accumulators = []
+        for name in filter(None, params.get('_aggregate', 'count').split(',')):
+            if name == 'count':
+                accumulators.append((name, 'count', None))
+                continue
+            field, _, accumulator = name.rpartition('__')
+            field = self._reverse_rename_fields.get(field, field)
+            if accumulator not in AGGREGATE_ACCUMULATORS or \
+                    accumulator not in self.aggregate_accumulators.get(field, []):
+                raise ValidationError({'error': "Can't aggregate %s." % name})
+            name = '%s__%s' % (self._rename_fields.get(field, field), accumulator)
+            accumulators.append((name, accumulator, field))
+        return accumulators
+
+    def get_aggregate_pipeline(self, params=None):
+        """
+        Return the aggregation pipeline of the request that's currently
+        being processed: a $match stage with its filters (see apply_filters)
+        followed by a $group stage computing the requested accumulators per
+        group (see get_aggregate_group_by and get_aggregate_accumulators).
+        """
+        if params is None:
+            params = self.params
+        group_by = self.get_aggregate_group_by(params)
+        group = {
+            '_id': dict((name, '$' + self.get_db_field_name(field)) for name, field in group_by) or None
+        }
+        for name, accumulator, field in self.get_aggregate_accumulators(params):
+            if accumulator == 'count':
+                group[name] = {'$sum': 1}
+            else:
+                group[name] = {'$' + accumulator: '$' + self.get_db_field_name(field)}
+        query_filter = self.apply_filters(params)
+        self.check_query_cost(query_filter)
+        return [
+            {'$match': cook_find_filter(self.document, query_filter)},
+            {'$group': group},
+            {'$sort': {'_id': 1}},
+            # Fetch one more so we know if there are more groups
+            {'$limit': self.aggregate_max_groups + 1},
+        ]
+
+    def aggregate_objects(self, params=None):
+        """
+        Run the aggregation of the request that's currently being processed
+        (see get_aggregate_pipeline) and return a dict with a `data` list of
+        groups (their group-by values and accumulated values, named like in
+        responses) and a `has_more` bool telling if the groups have been
+        capped by aggregate_max_groups.
+        """
+        pipeline = self.get_aggregate_pipeline(params)
+        cursor = self.get_read_collection().aggregate(pipeline, allowDiskUse=self.aggregate_allow_disk_use,
+                                                      **self.get_query_options(aggregate=True))
+        data = []
+        for group in cursor:
+            values = group.pop('_id') or {}
+            values.update(group)
+            data.append(values)
+        has_more = len(data) > self.aggregate_max_groups
+        return {
+            'data': data[:self.aggregate_max_groups],
+            'has_more': has_more,
+        }
+
+    def get_distinct_field(self, params):
+        """
+        Return the document field name of the `_field` param, which must be
+        declared in `filters`.
+        """
+        name = params.get('_field')
+        if not name:
+            raise ValidationError({'error': '_field is required.'})
+        field = self._reverse_rename_fields.get(name, name)
+        if field not in self._filters:
+            raise ValidationError({'error': "Can't list the values of %s." % name})
+        return field
+
+    def get_distinct_cache_key(self, field, params):
+        """
+        Return the key the distinct values of `field` are cached under.
+        Resources whose filtering depends on more than the params (e.g. on
+        the current user) must add it to the key.
+        """
+        name = self.document.collection.full_name
+        return (name, cache.get_generation(name), field, tuple(sorted(params.items())))
+
+    def distinct_values(self, params=None):
+        """
+        Return a dict with a sorted `data` list of the distinct values of the
+        `_field` param among the documents matching the other filters of the
+        request that's currently being processed, and a `has_more` bool
+        telling if they have been capped by distinct_max_values.
+
+        The values are computed with a $group (rather than `distinct`, whose
+        result can't be capped) and cached (see distinct_cache_ttl).
+        """
+        if params is None:
+            params = self.params
+        field = self.get_distinct_field(params)
+        key = self.get_distinct_cache_key(field, params)
+        if self.distinct_cache_ttl:
+            ret = self.distinct_cache.get(key)
+            if ret is not None:
+                return dict(ret)
+        query_filter = self.apply_filters(params)
+        self.check_query_cost(query_filter)
+        db_field = '$' + self.get_db_field_name(field)
+        pipeline = [{'$match': cook_find_filter(self.document, query_filter)}]
+        # Like distinct, return the elements of lists rather than the lists
+        if isinstance(self.document.DataProxy._fields.get(field), ListField):
+            pipeline.append({'$unwind': db_field})
+        pipeline += [
+            {'$group': {'_id': db_field}},
+            {'$sort': {'_id': 1}},
+            # Fetch one more so we know if there are more values
+            {'$limit': self.distinct_max_values + 1},
+        ]
+        cursor = self.get_read_collection().aggregate(pipeline, **self.get_query_options(aggregate=True, params=params))
+        values = [doc['_id'] for doc in cursor]
+        ret = {
+            'data': values[:self.distinct_max_values],
+            'has_more': len(values) > self.distinct_max_values,
+        }
+        if self.distinct_cache_ttl:
+            self.distinct_cache.set(key, ret, self.distinct_cache_ttl)
+        return dict(ret)
+
+    def after_write(self, obj_id=None):
+        """
+        Called after every write of the resource to its collection, with the
+        _id of the written document, or None if any number of documents may
+        have been written. Invalidates the cached query results of the
+        collection in this process (see cache.py), in the response caches
+        of all the resources reading it (see response_cache.py) and in the
+        other processes (see invalidation.py), applies the write to the hot
+        replica of this process, if any, and pins the client's reads to the
+        primary (see read_your_writes_window).
+        """
+        namespace = self.document.collection.full_name
+        generation = cache.bump_generation(namespace)
+        if self.hot_replica:
+            # The bus doesn't hand this process its own writes
+            replica.handle_event({'ns': namespace, 'id': obj_id})
+        if self.response_cache is not None:
+            response_cache.register(namespace, self.response_cache)
+        response_cache.bump_generation(namespace)
+        if self.invalidation_bus is not None:
+            self.invalidation_bus.publish(namespace, obj_id, generation)
+        self.pin_to_primary()
+
+    def get_version(self, obj):
+        """Return the version of `obj`, or None if it isn't versioned."""
+        if not self.version_field or obj is None:
+            return None
+        return getattr(obj, self.version_field)
+
+    def get_etag(self, obj):
+        """Return the ETag of `obj`, or None if it isn't versioned."""
+        version = self.get_version(obj)
+        if version is None:
+            return None
+        return '"%d"' % version
+
+    def get_expected_versions(self):
+        """
+        Return a list of versions accepted by the If-Match header of the
+        request that's currently being processed, or None if any version is
+        acceptable.
+        """
+        if not self.version_field or 'If-Match' not in request.headers:
+            return None
+        if request.if_match.star_tag:
+            return None
+        return [int(tag) for tag in request.if_match.as_set() if isint(tag)]
+
+    def check_version(self, obj):
+        """
+        Raise PreconditionFailed if the loaded version of `obj` doesn't match
+        the request's If-Match header.
+        """
+        expected = self.get_expected_versions()
+        if expected is not None and self.get_version(obj) not in expected:
+            raise PreconditionFailed({'error': 'The object has been modified (version %s).' % self.get_version(obj)})
+
+    def _version_db_field(self):
+        doc_field = self.document.DataProxy._fields[self.version_field]
+        return doc_field.attribute or self.version_field
+
+    def get_write_concern(self):
+        """
+        Return the WriteConcern for the request that's currently being
+        processed, or None to use the client's default.
+        """
+        name = self.params.get('_write_concern')
+        if name:
+            if name not in self.write_concern_overrides:
+                raise ValidationError({'error': '"%s" is not a valid write concern for this resource.' % name})
+            options = self.write_concern_overrides[name]
+        else:
+            options = self.method_write_concerns.get(self.view_method, self.write_concern)
+        if options is None:
+            return None
+        return WriteConcern(**options)
+
+    def get_write_options(self):
+        """
+        Return the kwargs of the find_one_and_* calls of the request that's
+        currently being processed.
+        """
+        max_time_ms = self.get_max_time_ms()
+        return {'maxTimeMS': max_time_ms} if max_time_ms else {}
+
+    def is_pinned_to_primary(self):
+        """
+        Return whether the client wrote through a resource less than
+        `read_your_writes_window` seconds ago (see after_write), in which
+        case its reads go to the primary to see its own writes.
+        """
+        if not self.read_your_writes_window:
+            return False
+        until = request.cookies.get(self.read_your_writes_cookie)
+        return isint(until) and int(until) > time.time()
+
+    def pin_to_primary(self):
+        """
+        Pin the reads of the client that's currently writing to the primary
+        for the next `read_your_writes_window` seconds.
+        """
+        window = self.read_your_writes_window
+        if not window or not has_request_context():
+            return
+        until = str(int(time.time() + window))
+
+        @after_this_request
+        def set_cookie(response):
+            response.set_cookie(self.read_your_writes_cookie, until, max_age=window, httponly=True)
+            return response
+
+    def get_read_preference(self):
+        """
+        Return the read preference of the request that's currently being
+        processed (see read_preferences), or None to use the collection's.
+        """
+        options = self.read_preferences.get(self.view_method)
+        if options is None:
+            return None
+        if self.is_pinned_to_primary():
+            return Primary()
+        options = dict(options)
+        mode = options.pop('mode')
+        if mode not in READ_PREFERENCES:
+            raise ValueError('Unknown read preference mode: %r' % mode)
+        return READ_PREFERENCES[mode](**options)
+
+    def get_read_collection(self):
+        """
+        Return the document's collection, configured for the reads of the
+        request that's currently being processed (e.g. with its read
+        preference).
+        """
+        collection = self.document.collection
+        read_preference = self.get_read_preference()
+        if read_preference is not None:
+            collection = collection.with_options(read_preference=read_preference)
+        return collection
+
+    def get_collection(self):
+        """
+        Return the document's collection, configured for the request that's
+        currently being processed (e.g. with its write concern). All the
+        writes of this resource go through this collection.
+        """
+        collection = self.document.collection
+        write_concern = self.get_write_concern()
+        if write_concern is not None:
+            collection = collection.with_options(write_concern=write_concern)
+        return collection
+
+    def commit_object(self, obj, conditions=None):
+        """
+        Insert or update `obj` like umongo's Document.commit does, but
+        through get_collection. Raises umongo's UpdateError if `conditions`
+        don't match the stored document. Return the pymongo write result, or
+        None if there was nothing to write.
+        """
+        collection = self.get_collection()
+        if obj.is_created:
+            if not obj.is_modified():
+                return None
+            query = dict(conditions or {}, _id=obj.pk)
+            additional_filter = obj.pre_update()
+            if additional_filter:
+                query.update(cook_find_filter(self.document, additional_filter))
+            obj.required_validate()
+            obj.io_validate()
+            ret = collection.update_one(query, obj.to_mongo(update=True))
+            # Unacknowledged writes don't report whether anything matched
+            if ret.acknowledged and ret.matched_count != 1:
+                raise UpdateError(ret)
+            obj.post_update(ret)
+        else:
+            obj.pre_insert()
+            obj.required_validate()
+            obj.io_validate()
+            payload = obj.to_mongo()
+            # insert_one adds the generated _id to the payload
+            ret = collection.insert_one(payload)
+            obj._data.from_mongo(payload)
+            obj.is_created = True
+            obj.post_insert(ret)
+        obj.clear_modified()
+        return ret
+
+    def group_commit_object(self, obj):
+        """
+        Insert `obj` as part of a batch of concurrently created objects (see
+        `group_commit`).
+        """
+        obj.pre_insert()
+        obj.required_validate()
+        obj.io_validate()
+        payload = obj.to_mongo()
+        collection = self.get_collection()
+        committer = concurrency.get_group_committer(
+            collection, self.group_commit_window, self.group_commit_max_size,
+            on_create=obj.ensure_indexes)
+        try:
+            inserted_id = committer.insert(payload)
+        except WriteError as e:
+            # The document itself was rejected, rather than its batch
+            if e.code in DUPLICATE_KEY_ERROR_CODES:
+                raise Conflict({'error': 'The object conflicts with an existing one.'})
+            raise ValidationError({'error': e.details.get('errmsg') if e.details else str(e)})
+        # The payload is exactly what has been stored, so there's no need
+        # to reload the object
+        obj._data.from_mongo(payload)
+        obj.is_created = True
+        obj.post_insert(InsertOneResult(inserted_id, collection.write_concern.acknowledged))
+        obj.clear_modified()
+
     def save_object(self, obj, **kwargs):
+        if self.group_commit and not obj.is_created:
+            if self.version_field:
+                setattr(obj, self.version_field, 1)
+            self.group_commit_object(obj)
+            self.after_write(obj.pk)
+            self._dirty_fields = None # No longer dirty.
+            return
+
         obj.ensure_indexes()
-        obj.commit()
-        obj.reload()
+        conditions = None
+        if self.version_field:
+            if not obj.is_created:
+                setattr(obj, self.version_field, 1)
+            elif obj.is_modified():
+                # Only write if nobody else has updated the object since we
+                # loaded it
+                version = self.get_version(obj)
+                conditions = {self._version_db_field(): version}
+                setattr(obj, self.version_field, (version or 0) + 1)
+        try:
+            ret = self.commit_object(obj, conditions=conditions)
+        except UpdateError:
+            raise PreconditionFailed({'error': 'The object has been modified concurrently.'})
+        if ret is not None:
+            self.after_write(obj.pk)
+        # There's no guarantee an unacknowledged write is visible yet
+        if ret is None or ret.acknowledged:
+            obj.reload()
 
         self._dirty_fields = None # No longer dirty.
 
@@ -690,6 +2041,8 @@ class Resource(object):
             # rather than re-updating all the document's existing/other fields.
             filter_fields &= set(self._reverse_rename_fields.get(field, field)
                                  for field in self.raw_data.keys())
+        # The version is maintained by save_object, never by the client
+        filter_fields.discard(self.version_field)
         update_dict = {field: value for field, value in data.items()
                        if field in filter_fields}
         return update_dict
@@ -733,8 +2086,356 @@ class Resource(object):
             self.save_object(obj)
         return obj
 
+    def upsert_object(self, pk, data=None, has_permission=None):
+        """
+        Replace the document identified by `pk` with the validated request
+        data, creating it if it doesn't exist, in a single round trip.
+        Return a tuple of the resulting document and whether it was created
+        (False if that's unknown, i.e. the write isn't acknowledged).
+        `has_permission(obj)` can veto the write of the validated object.
+
+        Versioned documents only get replaced if their version matches the
+        request's If-Match header (they're never created in that case), and
+        their version is incremented.
+        """
+        try:
+            obj = self.document(**self.get_object_dict(data))
+            obj.required_validate()
+            obj.io_validate()
+        except marshmallow.ValidationError as e:
+            raise ValidationError({'field-errors': e.messages, 'errors': []})
+        if has_permission and not has_permission(obj):
+            raise Unauthorized
+        payload = obj.to_mongo()
+        payload['_id'] = ObjectId(pk)
+        query = {'_id': payload['_id']}
+        collection = self.get_collection()
+
+        if self.version_field:
+            version_field = self._version_db_field()
+            payload.pop(version_field, None)
+            expected = self.get_expected_versions()
+            if expected is not None:
+                query[version_field] = {'$in': expected}
+            # Emulate a replacement, since replace_one can't increment the
+            # version
+            unset = dict((field.attribute or name, '')
+                         for name, field in self.document.DataProxy._fields.items()
+                         if (field.attribute or name) not in payload)
+            unset.pop('_id', None)
+            unset.pop(version_field, None)
+            update = {'$set': payload, '$inc': {version_field: 1}}
+            if unset:
+                update['$unset'] = unset
+            before = collection.find_one_and_update(
+                query, update, upsert=expected is None,
+                projection={version_field: 1}, return_document=ReturnDocument.BEFORE,
+                **self.get_write_options())
+            if before is None and expected is not None:
+                raise PreconditionFailed({'error': 'The object has been modified or does not exist.'})
+            created = before is None
+            payload[version_field] = 1 if created else (before.get(version_field) or 0) + 1
+        else:
+            ret = collection.replace_one(query, payload, upsert=True)
+            # Unacknowledged writes don't report whether they inserted
+            created = ret.acknowledged and ret.upserted_id is not None
+        self.after_write(payload['_id'])
+
+        return self.document.build_from_mongo(payload, use_cls=True), created
+
+    def get_db_update(self, update_dict):
+        """
+        Return a MongoDB update document setting the fields of
+        `update_dict` (see get_object_dict) to their database
+        representations. Raise a ValidationError if any of the values
+        doesn't match its field's type.
+        """
+        update = {}
+        field_errors = {}
+        for field, value in update_dict.items():
+            doc_field = self.document.DataProxy._fields[field]
+            try:
+                value = doc_field.serialize_to_mongo(doc_field.deserialize(value))
+            except marshmallow.ValidationError as e:
+                field_errors[self._rename_fields.get(field, field)] = e.messages
+                continue
+            update.setdefault('$set', {})[doc_field.attribute or field] = value
+        if field_errors:
+            raise ValidationError({'field-errors': field_errors, 'errors': []})
+        if update and self.version_field:
+            update['$inc'] = {self._version_db_field(): 1}
+        return update
+
+    def get_bulk_write_spec(self, kind):
+        """
+        Return a spec (see bulk.run_spec) of a chunked bulk write of the
+        given kind ('update' or 'delete') for the request that's currently
+        being processed. Updates apply the request's validated data to all
+        the documents matching its filters.
+        """
+        params = self.params
+        after = params.get('_after')
+        if after:
+            try:
+                after = ObjectId(after)
+            except (InvalidId, TypeError):
+                raise ValidationError({'error': '_after must be an object id (got "%s" instead).' % after})
+        # Unlike reads, bulk writes don't ignore misspelled filters, which
+        # would widen them
+        unknown = [key for key in params if not key.startswith('_') and self.parse_filter_param(key) is None]
+        if unknown:
+            raise ValidationError({'field-errors': dict((key, 'Unknown filter.') for key in unknown), 'errors': []})
+        query = self.apply_filters(params)
+        if kind == 'delete' and not query and not (self.allow_bulk_delete_all and params.get('_all')):
+            raise ValidationError({'error': 'Bulk deletes require at least one filter.'})
+        spec = {
+            'kind': kind,
+            'query': cook_find_filter(self.document, query),
+            'chunk_size': self.bulk_update_chunk_size,
+            'workers': self.bulk_update_workers,
+            'after': after or None,
+            'partitions': self.get_scan_partitions(params),
+            'collation': self.get_collation(params),
+            'partition_method': self.partition_method,
+            # Jobs call the resource's after_write hook (see jobs.py)
+            'resource': '%s.%s' % (type(self).__module__, type(self).__name__),
+        }
+        if kind == 'update':
+            spec['update'] = self.get_db_update(self.get_object_dict(update=True))
+        return spec
+
+    def run_bulk_write(self, spec, on_progress=None):
+        """
+        Run a bulk write spec (see get_bulk_write_spec) in chunks and return
+        the progress counts.
+        """
+        if spec['kind'] == 'update' and not spec['update']:
+            return bulk.BulkProgress().to_dict()
+        # Only bound the scan of bulk writes run by the request (background
+        # jobs aren't bound by the request's deadline)
+        spec = dict(spec, max_time_ms=self.get_max_time_ms())
+        try:
+            progress = bulk.run_spec(self.get_collection(), spec, on_progress=on_progress)
+        except BulkWriteInterrupted as e:
+            message = e.progress.to_dict()
+            message['errors'] = [str(e.error)]
+            raise ValidationError(message)
+        finally:
+            self.after_write()
+        return progress.to_dict()
+
+    def iter_import_records(self):
+        """
+        Parse the body of the request that's currently being processed
+        incrementally, straight from the input stream (so chunked uploads
+        are supported). `application/x-ndjson` bodies contain one JSON object
+        per line, other JSON bodies an array of objects. Yield a (record
+        number, record) tuple per record, where record is a ValueError if it
+        isn't valid JSON.
+        """
+        if request.mimetype == 'application/x-ndjson':
+            try:
+                for line_number, record in iter_ndjson(request.stream, parse_constant=self._enforce_strict_json):
+                    yield line_number, record
+            except ValueError as e:
+                # The line is too large to be read
+                raise ValidationError({'error': 'The request contains invalid JSON: %s' % e})
+        elif request.mimetype and 'json' not in request.mimetype:
+            raise ValidationError({'error': "Please send JSON with a 'Content-Type: application/json' or 'application/x-ndjson' header."})
+        else:
+            records = iter_json_array(request.stream, parse_constant=self._enforce_strict_json)
+            index = 0
+            while True:
+                try:
+                    record = next(records)
+                except StopIteration:
+                    return
+                except ValueError as e:
+                    # The rest of the array can't be parsed
+                    raise ValidationError({'error': 'The request contains invalid JSON: %s' % e})
+                yield index, record
+                index += 1
+
+    def import_objects(self, records, has_permission=None):
+        """
+        Validate each of the `records` (see iter_import_records) like a
+        created object and write the valid ones in unordered insert_many
+        batches of `import_batch_size`. Invalid records are skipped.
+        `has_permission(obj)` can veto each object.
+
+        Return the number of imported and invalid records, along with the
+        errors of the first `import_max_errors` invalid records.
+        """
+        collection = self.get_collection()
+        result = {'count': 0, 'invalid': 0, 'errors': []}
+
+        def error(index, message):
+            result['invalid'] += 1
+            if len(result['errors']) < self.import_max_errors:
+                result['errors'].append(dict(message, record=index))
+
+        def flush(batch, indexes):
+            try:
+                collection.insert_many(batch, ordered=False)
+                result['count'] += len(batch)
+            except BulkWriteError as e:
+                result['count'] += e.details.get('nInserted', 0)
+                for write_error in e.details.get('writeErrors', []):
+                    error(indexes[write_error['index']], {'error': write_error.get('errmsg')})
+            finally:
+                self.after_write()
+
+        batch, indexes = [], []
+        try:
+            for index, record in records:
+                if isinstance(record, ValueError):
+                    error(index, {'error': 'Invalid JSON: %s' % record})
+                    continue
+                if not isinstance(record, dict):
+                    error(index, {'error': 'JSON data must be a dict.'})
+                    continue
+                try:
+                    self._raw_data = record
+                    self.validate_request()
+                    obj = self.create_object(save=False)
+                    if has_permission and not has_permission(obj):
+                        error(index, {'error': 'Unauthorized'})
+                        continue
+                    if self.version_field:
+                        setattr(obj, self.version_field, 1)
+                    obj.pre_insert()
+                    obj.required_validate()
+                    obj.io_validate()
+                except ValidationError as e:
+                    error(index, e.message)
+                    continue
+                except marshmallow.ValidationError as e:
+                    error(index, {'field-errors': e.messages})
+                    continue
+                batch.append(obj.to_mongo())
+                indexes.append(index)
+                if len(batch) >= self.import_batch_size:
+                    flush(batch, indexes)
+                    batch, indexes = [], []
+        except ValidationError as e:
+            # The body can't be parsed any further. Report what has been
+            # imported so far.
+            if batch:
+                flush(batch, indexes)
+            raise ValidationError(dict(result, **e.message))
+        if batch:
+            flush(batch, indexes)
+        return result
+
     def delete_object(self, obj):
-        obj.delete()
+        query = {'_id': obj.pk}
+        # Like umongo's Document.delete, honour the pre_delete filter
+        additional_filter = obj.pre_delete()
+        if additional_filter:
+            query.update(cook_find_filter(self.document, additional_filter))
+        ret = self.get_collection().delete_one(query)
+        if ret.acknowledged and ret.deleted_count != 1:
+            raise DeleteError(ret)
+        obj.is_created = False
+        obj.post_delete(ret)
+        self.after_write(obj.pk)
+
+    def get_atomic_update(self):
+        """
+        Validate the atomic operators of the PATCH request that's currently
+        being processed, e.g. { '$inc': { 'views': 1 } }, against
+        `atomic_fields` and the document's field types. Return a MongoDB
+        update document using the database names and representations of the
+        fields.
+        """
+        update = {}
+        field_errors = {}
+        errors = []
+        updated_fields = set()
+        for op, values in self.raw_data.items():
+            if op == '_params':
+                continue
+            if not op.startswith('$') or op[1:] not in ATOMIC_OPERATORS:
+                errors.append('"%s" is not a valid atomic operator.' % op)
+                continue
+            if not isinstance(values, dict):
+                errors.append('The value of "%s" must be a dict.' % op)
+                continue
+            op = op[1:]
+            for field, value in values.items():
+                actual_field = self._reverse_rename_fields.get(field, field)
+                if op not in self.atomic_fields.get(actual_field, []):
+                    field_errors[field] = '"$%s" is not allowed on this field.' % op
+                    continue
+                if actual_field in updated_fields:
+                    field_errors[field] = 'Only one atomic operator can be applied to a field at a time.'
+                    continue
+                updated_fields.add(actual_field)
+                doc_field = self.document.DataProxy._fields[actual_field]
+                try:
+                    value = self._atomic_value(op, doc_field, value)
+                except marshmallow.ValidationError as e:
+                    field_errors[field] = e.messages
+                    continue
+                db_field = doc_field.attribute or actual_field
+                update.setdefault('$%s' % op, {})[db_field] = value
+        if not update and not errors and not field_errors:
+            errors.append('At least one atomic operator is required.')
+        if errors or field_errors:
+            raise ValidationError({'field-errors': field_errors, 'errors': errors})
+        return update
+
+    def _atomic_value(self, op, doc_field, value):
+        """
+        Deserialize the value of a single atomic operator and return its
+        MongoDB representation. Raises marshmallow's ValidationError if the
+        value or the operator don't match the field's type.
+        """
+        if op == 'unset':
+            if doc_field.required:
+                raise marshmallow.ValidationError('Required fields cannot be unset.')
+            return ''
+        if op == 'inc':
+            if not isinstance(doc_field, marshmallow.fields.Number) or \
+                    isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise marshmallow.ValidationError('"$inc" requires a numeric field and value.')
+            return doc_field.serialize_to_mongo(doc_field.deserialize(value))
+        # push and addToSet append (one or several, via "$each") elements to
+        # a list
+        if not isinstance(doc_field, ListField):
+            raise marshmallow.ValidationError('"$%s" requires a list field.' % op)
+        inner = getattr(doc_field, 'inner', None) or doc_field.container
+        if isinstance(value, dict) and list(value.keys()) == ['$each']:
+            if not isinstance(value['$each'], list):
+                raise marshmallow.ValidationError('"$each" must be a list.')
+            return {'$each': [inner.serialize_to_mongo(inner.deserialize(v)) for v in value['$each']]}
+        return inner.serialize_to_mongo(inner.deserialize(value))
+
+    def atomic_update_object(self, pk, update):
+        """
+        Apply a validated atomic update (see get_atomic_update) to the
+        document identified by `pk` with a single find_one_and_update and
+        return the updated document, or None if it doesn't exist.
+
+        Versioned documents are only updated if their version matches the
+        request's If-Match header, and their version is incremented.
+        """
+        query = {'_id': ObjectId(pk)}
+        expected = self.get_expected_versions()
+        if self.version_field:
+            version_field = self._version_db_field()
+            if expected is not None:
+                query[version_field] = {'$in': expected}
+            update = dict(update)
+            update['$inc'] = dict(update.get('$inc', {}), **{version_field: 1})
+        raw = self.get_collection().find_one_and_update(
+            query, update, return_document=ReturnDocument.AFTER, **self.get_write_options())
+        if raw is None:
+            if expected is not None and self.document.collection.find_one({'_id': query['_id']}, projection={'_id': 1}):
+                raise PreconditionFailed({'error': 'The object has been modified.'})
+            return None
+        self.after_write(raw['_id'])
+        return self.document.build_from_mongo(raw, use_cls=True)
 
 
 # Py2/3 compatible way to do metaclasses (or six.add_metaclass)
@@ -0,0 +1,332 @@
+"""
+Response cache shared by all the processes serving a resource (see
+Resource.response_cache).
+
+Rendered List and Fetch responses are stored in a backend (in-memory, or a
+Redis server shared by several hosts) under a key which includes the
+generation of the resource's collection. Every write of a collection bumps
+its generation in all the caches registered for it (see register and
+Resource.after_write), whichever resource wrote it, so that responses
+rendered before the write are never served again.
+
+Responses stay fresh for `ttl` seconds, then are served stale for another
+`stale_ttl` seconds while a single worker renders them again in the
+background.
+"""
+import collections
+import hashlib
+import json
+import math
+import socket
+import threading
+import time
+
+from flask_umongorest.exceptions import CacheBackendError
+
+_caches = collections.defaultdict(list)
+_caches_lock = threading.Lock()
+
+
+def register(namespace, response_cache):
+    """Have the writes of `namespace` (e.g. a collection name) invalidate the responses of `response_cache`."""
+    with _caches_lock:
+        if response_cache not in _caches[namespace]:
+            _caches[namespace].append(response_cache)
+
+
+def bump_generation(namespace):
+    """Invalidate the responses cached for `namespace` in all the caches registered for it."""
+    with _caches_lock:
+        caches = list(_caches[namespace])
+    for response_cache in caches:
+        response_cache.bump_generation(namespace)
+
+
+def bump_all_generations():
+    """Invalidate the responses cached for all the registered namespaces."""
+    with _caches_lock:
+        caches = [(namespace, response_cache) for namespace, registered in _caches.items()
+                  for response_cache in registered]
+    for namespace, response_cache in caches:
+        response_cache.bump_generation(namespace)
+
+
+class CacheBackend(object):
+    """
+    Interface of the backends of a ResponseCache. Keys are strings and
+    values bytes.
+    """
+
+    def get(self, key):
+        """Return the value of `key`, or None if it's missing or expired."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """Store `value` for `ttl` seconds."""
+        raise NotImplementedError
+
+    def add(self, key, value, ttl):
+        """Store `value` for `ttl` seconds unless `key` exists. Return whether it was stored."""
+        raise NotImplementedError
+
+    def incr(self, key):
+        """Increment the counter `key` (which never expires) and return its new value."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Backend storing up to `max_entries` values in the memory of the process.
+    The least recently used values are evicted first; counters are never
+    evicted.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            return None
+        return value
+
+    def get(self, key):
+        with self._lock:
+            if key in self._counters:
+                return str(self._counters[key]).encode('ascii')
+            value = self._get(key)
+            if value is not None:
+                # Mark as recently used
+                self._entries[key] = self._entries.pop(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value, ttl):
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._entries[key] = (time.time() + ttl, value)
+            return True
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._counters.pop(key, None)
+
+
+class RedisBackend(CacheBackend):
+    """
+    Backend storing values in a Redis server (or anything speaking its
+    protocol), so they're shared by all the processes and hosts using it.
+    Each thread keeps its own connection.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, socket_timeout=1.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.socket_timeout = socket_timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.socket_timeout)
+        self._local.connection = (sock, sock.makefile('rb'))
+        if self.password:
+            self.execute('AUTH', self.password)
+        if self.db:
+            self.execute('SELECT', self.db)
+
+    def _disconnect(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            sock, reader = connection
+            reader.close()
+            sock.close()
+
+    def _encode(self, args):
+        chunks = [b'*' + str(len(args)).encode('ascii') + b'\r\n']
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = (arg if isinstance(arg, type(u'')) else str(arg)).encode('utf-8')
+            chunks.append(b'$' + str(len(arg)).encode('ascii') + b'\r\n' + arg + b'\r\n')
+        return b''.join(chunks)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise socket.error('Connection closed by the server.')
+        kind, data = line[:1], line[1:-2]
+        if kind == b'+':
+            return data
+        if kind == b'-':
+            raise CacheBackendError(data.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(data)
+        if kind == b'$':
+            length = int(data)
+            if length < 0:
+                return None
+            value = reader.read(length + 2)
+            if len(value) != length + 2:
+                raise socket.error('Connection closed by the server.')
+            return value[:-2]
+        if kind == b'*':
+            length = int(data)
+            return None if length < 0 else [self._read_reply(reader) for _ in range(length)]
+        raise CacheBackendError('Invalid reply: %r' % line)
+
+    def execute(self, *args):
+        """Run a Redis command and return its reply."""
+        if getattr(self._local, 'connection', None) is None:
+            try:
+                self._connect()
+            except (socket.error, CacheBackendError) as e:
+                self._disconnect()
+                raise CacheBackendError(str(e))
+        sock, reader = self._local.connection
+        try:
+            sock.sendall(self._encode(args))
+            return self._read_reply(reader)
+        except socket.error as e:
+            # The connection is in an unknown state
+            self._disconnect()
+            raise CacheBackendError(str(e))
+
+    def get(self, key):
+        return self.execute('GET', key)
+
+    def set(self, key, value, ttl):
+        self.execute('SET', key, value, 'EX', int(math.ceil(ttl)))
+
+    def add(self, key, value, ttl):
+        return self.execute('SET', key, value, 'NX', 'EX', int(math.ceil(ttl))) is not None
+
+    def incr(self, key):
+        return self.execute('INCR', key)
+
+    def delete(self, key):
+        self.execute('DEL', key)
+
+
+class ResponseCache(object):
+    """
+    Cache of rendered responses, stored in `backend` under keys starting
+    with `prefix`. Backend failures are treated as cache misses.
+    """
+
+    def __init__(self, backend, prefix='umongorest', refresh_timeout=30):
+        self.backend = backend
+        self.prefix = prefix
+        # Time after which the refresh of a stale response is assumed to
+        # have failed and another worker may try again
+        self.refresh_timeout = refresh_timeout
+
+    def _generation_key(self, namespace):
+        return '%s:gen:%s' % (self.prefix, namespace)
+
+    def get_generation(self, namespace):
+        """Return the current generation of `namespace` (e.g. a collection name)."""
+        generation = self.backend.get(self._generation_key(namespace))
+        return int(generation) if generation is not None else 0
+
+    def bump_generation(self, namespace):
+        """Invalidate all the responses cached for `namespace`."""
+        try:
+            return self.backend.incr(self._generation_key(namespace))
+        except CacheBackendError:
+            return None
+
+    def get_key(self, namespace, request_key):
+        """
+        Return the backend key of the response to the request identified by
+        `request_key` (any value with a stable repr) in the current
+        generation of `namespace`.
+        """
+        digest = hashlib.sha1(repr(request_key).encode('utf-8')).hexdigest()
+        return '%s:resp:%s:%d:%s' % (self.prefix, namespace, self.get_generation(namespace), digest)
+
+    def fetch(self, namespace, request_key, render, ttl, stale_ttl=0, spawn=None):
+        """
+        Return the (body, status, headers) of the response to the request
+        identified by `request_key`, rendering it with `render()` on a miss.
+        Only 200 responses are cached.
+
+        Stale responses are returned as is while `render()` runs again in
+        the background, started with `spawn(fn)` (a new thread by default)
+        by the first worker which sees them.
+        """
+        register(namespace, self)
+        try:
+            key = self.get_key(namespace, request_key)
+            entry = self.backend.get(key)
+        except CacheBackendError:
+            return render()
+        if entry is not None:
+            entry = json.loads(entry.decode('utf-8'))
+            if entry['fresh_until'] < time.time() and self._lock_refresh(key):
+                (spawn or _spawn)(lambda: self._refresh(key, render, ttl, stale_ttl))
+            return entry['body'].encode('utf-8'), entry['status'], [tuple(h) for h in entry['headers']]
+        response = render()
+        self.store(key, response, ttl, stale_ttl)
+        return response
+
+    def store(self, key, response, ttl, stale_ttl):
+        body, status, headers = response
+        if not status.startswith('200'):
+            return
+        # Cookies are set for a single client
+        headers = [(name, value) for name, value in headers if name.lower() != 'set-cookie']
+        entry = json.dumps({
+            'fresh_until': time.time() + ttl,
+            'body': body.decode('utf-8'),
+            'status': status,
+            'headers': headers,
+        })
+        try:
+            self.backend.set(key, entry.encode('utf-8'), ttl + stale_ttl)
+        except CacheBackendError:
+            pass
+
+    def _lock_refresh(self, key):
+        try:
+            return self.backend.add(key + ':refresh', b'1', self.refresh_timeout)
+        except CacheBackendError:
+            return False
+
+    def _refresh(self, key, render, ttl, stale_ttl):
+        try:
+            self.store(key, render(), ttl, stale_ttl)
+        finally:
+            try:
+                self.backend.delete(key + ':refresh')
+            except CacheBackendError:
+                pass
+
+
+def _spawn(fn):
+    thread = threading.Thread(target=fn)
+    thread.daemon = True
+    thread.start()
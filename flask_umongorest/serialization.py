@@ -0,0 +1,115 @@
+"""
+Serialization of raw documents in a pool of worker processes (see
+Resource.serialization_processes).
+
+Serializing and JSON-encoding objects is pure-Python work which holds the
+GIL, so a single request serializing thousands of objects keeps one core
+busy while the others idle. Instead, batches of raw documents are sent to
+worker processes, which build the documents, serialize them with the
+resource (instantiated in the worker) and return the encoded JSON.
+
+Only the resource class, the request params and the raw documents are
+pickled, so the resource class must be importable by the workers (i.e.
+defined at the top level of a module) and its serialization must not
+depend on the request context, the database or any other state of the
+process which received the request.
+"""
+import collections
+import json
+import multiprocessing
+import os
+import threading
+
+from flask_umongorest.utils import MongoEncoder
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(processes):
+    """
+    Return the process pool of the given size shared by all the resources
+    of this process, creating it on first use in the process (e.g. in each
+    worker forked by a pre-fork server).
+    """
+    pid = os.getpid()
+    with _pools_lock:
+        pool = _pools.get((pid, processes))
+        if pool is None:
+            # The pools inherited from the parent of a forked process belong
+            # to the parent
+            for key in [key for key in _pools if key[0] != pid]:
+                del _pools[key]
+            pool = _pools[pid, processes] = multiprocessing.Pool(processes)
+        return pool
+
+
+def encode(data):
+    return json.dumps(data, allow_nan=False, cls=MongoEncoder)
+
+
+def serialize_raw(resource, raw, params):
+    """
+    Build the document stored as `raw` and return its encoded serialization
+    by `resource`, or None if it can't be serialized.
+    """
+    obj = resource.document.build_from_mongo(raw, use_cls=True)
+    try:
+        data = resource.serialize(obj, params=params)
+    except Exception as e:
+        data = resource.handle_serialization_error(e, obj)
+        if data is None:
+            return None
+    return encode(data)
+
+
+def _serialize_batch(task):
+    """
+    Worker entry point: return the encoded serializations of a batch of
+    raw documents, each paired with its key (documents which can't be
+    serialized are left out).
+    """
+    resource_class, view_method, params, rows = task
+    resource = resource_class(view_method=view_method)
+    encoded_rows = []
+    for key, raw in rows:
+        encoded = serialize_raw(resource, raw, params)
+        if encoded is not None:
+            encoded_rows.append((key, encoded))
+    return encoded_rows
+
+
+def serialize_in_pool(resource, rows, params, processes, batch_size):
+    """
+    Serialize the raw documents of `rows`, an iterable of (key, raw
+    document) tuples, with `resource` in a pool of `processes` worker
+    processes. Yield the (key, encoded JSON) tuples in the same order,
+    leaving out the documents which can't be serialized.
+
+    The documents are sent to the workers in batches of `batch_size`. At
+    most two batches per process are in flight at a time, so the rows are
+    consumed lazily.
+    """
+    pool = get_pool(processes)
+    resource_class = type(resource)
+    pending = collections.deque()
+
+    def batches():
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    for batch in batches():
+        task = (resource_class, resource.view_method, params, batch)
+        pending.append(pool.apply_async(_serialize_batch, (task,)))
+        if len(pending) >= processes * 2:
+            for encoded_row in pending.popleft().get():
+                yield encoded_row
+    while pending:
+        for encoded_row in pending.popleft().get():
+            yield encoded_row
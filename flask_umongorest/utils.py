@@ -1,10 +1,14 @@
 import json
+import codecs
 import decimal
 import datetime
 import base64
 from bson.dbref import DBRef
+from bson.decimal128 import Decimal128
 from bson.objectid import ObjectId
+from dateutil import parser as date_parser
 import mongoengine
+from umongo import fields
 from umongo.document import DocumentImplementation
 from umongo.frameworks.pymongo import PyMongoReference
 from umongo.frameworks.pymongo import Reference
@@ -43,6 +47,132 @@ class MongoEncoder(json.JSONEncoder):
         return super(MongoEncoder, self).default(value, **kwargs)
 
 
+def parse_bool(value):
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise ValueError('Not a boolean: %r' % value)
+
+
+# Functions converting query string values to the type of a field, most
+# specific field classes first
+FIELD_CONVERTERS = [
+    (fields.BooleanField, parse_bool),
+    (fields.IntegerField, int),
+    (fields.FloatField, float),
+    (fields.DecimalField, Decimal128),
+    (fields.NumberField, float),
+    ((fields.DateTimeField, fields.LocalDateTimeField, fields.StrictDateTimeField, fields.DateField),
+     date_parser.parse),
+    ((fields.ObjectIdField, fields.ReferenceField), ObjectId),
+]
+
+def get_field_converter(field):
+    """
+    Return a function converting a query string value to the type of the
+    umongo `field` (or of its elements, for list fields), or None if the
+    value doesn't need any conversion. The functions raise ValueError,
+    TypeError or bson's InvalidId for invalid values.
+    """
+    if isinstance(field, fields.ListField):
+        inner = getattr(field, 'container', None) or getattr(field, 'inner', None)
+        return get_field_converter(inner) if inner is not None else None
+    for field_classes, converter in FIELD_CONVERTERS:
+        if isinstance(field, field_classes):
+            return converter
+    return None
+
+
+def iter_json_array(stream, parse_constant=None, chunk_size=65536, max_record_size=16 * 1024 * 1024):
+    """
+    Incrementally parse a JSON array of objects read from a binary `stream`
+    and yield the objects one by one, so that memory use is bounded by the
+    size of a single object rather than the size of the array. Raise a
+    ValueError if the stream doesn't contain a valid array of objects.
+    """
+    decoder = json.JSONDecoder(parse_constant=parse_constant)
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+    state = 'start' # start, first_value, value, separator or end
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        if pos < len(buf):
+            char = buf[pos]
+            if state == 'end':
+                raise ValueError('Unexpected data after the JSON array.')
+            elif state == 'start':
+                if char != '[':
+                    raise ValueError('Expected a JSON array.')
+                state = 'first_value'
+                pos += 1
+                continue
+            elif char == ']' and state in ('first_value', 'separator'):
+                state = 'end'
+                pos += 1
+                continue
+            elif state == 'separator':
+                if char != ',':
+                    raise ValueError('Expected "," or "]" in the JSON array.')
+                state = 'value'
+                pos += 1
+                continue
+            elif char != '{':
+                raise ValueError('The JSON array must only contain objects.')
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The object may be incomplete, read more data below
+                if eof:
+                    raise
+                if len(buf) - pos > max_record_size:
+                    raise ValueError('A JSON object in the array is too large.')
+            else:
+                yield obj
+                state = 'separator'
+                # Drop the parsed data from the buffer
+                buf = buf[end:]
+                pos = 0
+                continue
+        elif eof:
+            if state != 'end':
+                raise ValueError('Unexpected end of the JSON array.')
+            return
+
+        data = stream.read(chunk_size)
+        eof = not data
+        buf = buf[pos:] + text_decoder.decode(data, final=eof)
+        pos = 0
+
+
+def iter_ndjson(stream, parse_constant=None, max_record_size=16 * 1024 * 1024):
+    """
+    Parse newline-delimited JSON read from a binary `stream` line by line.
+    Yield a (line number, object) tuple for each non-empty line, or a (line
+    number, ValueError) tuple for a line which isn't valid JSON. Raise a
+    ValueError if a line is longer than `max_record_size` bytes, so that
+    memory use is bounded by the size of a single line.
+    """
+    line_number = 0
+    while True:
+        line = stream.readline(max_record_size + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > max_record_size and not line.endswith(b'\n'):
+            raise ValueError('Line %d is too large.' % line_number)
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line.decode('utf-8'), parse_constant=parse_constant)
+        except ValueError as e:
+            yield line_number, e
+
+
 try:
     cmp
 except NameError: # Python 3
@@ -1,13 +1,16 @@
 import json
+import threading
 import mimerender
 import mongoengine
 
-from flask import request, render_template
+from flask import request, render_template, url_for, stream_with_context, Response, \
+    copy_current_request_context, current_app
+from pymongo.errors import ExecutionTimeout, WTimeoutError
 from werkzeug.exceptions import NotFound, Unauthorized
 
-from flask_umongorest.exceptions import ValidationError
+from flask_umongorest.exceptions import ValidationError, PreconditionFailed, Conflict
 from flask_umongorest.utils import MongoEncoder
-from flask_umongorest import methods
+from flask_umongorest import concurrency, methods
 from flask_views.base import View
 
 mimerender = mimerender.FlaskMimeRender()
@@ -39,50 +42,153 @@ def serialize_mongoengine_validation_error(e):
     else:
         return {'error': e.message}
 
+def is_authorized(authentication_methods):
+    """
+    Return whether the request that's currently being processed passes the
+    given authentication methods (classes or instances of
+    AuthenticationBase).
+    """
+    authorized = True if len(authentication_methods) == 0 else False
+    for authentication_method in authentication_methods:
+        if callable(authentication_method):
+            if authentication_method().authorized():
+                authorized = True
+            else:
+                authorized = False
+        else:
+            if authentication_method.authorized():
+                authorized = True
+            else:
+                authorized = False
+    return authorized
+
+def spawn_with_request_context(fn):
+    """Run `fn` in a new thread, within a copy of the current request context."""
+    thread = threading.Thread(target=copy_current_request_context(fn))
+    thread.daemon = True
+    thread.start()
+
+
+# Endpoint of the job resource registered by UMongoRest
+JOB_ENDPOINT = 'umongorest_job'
+
 class ResourceView(View):
     resource = None
     methods = []
     authentication_methods = []
 
+    # Job backend running the bulk writes of resources with `bulk_jobs`
+    # (see jobs.py). Set by UMongoRest unless overridden.
+    job_backend = None
+
+    # Coalesces the concurrent identical GET requests of resources with
+    # `single_flight` (see get_request_key)
+    single_flight = concurrency.SingleFlight()
+
     def __init__(self):
         assert(self.resource and self.methods)
 
-    @mimerender(default='json', json=render_json, html=render_html)
     def dispatch_request(self, *args, **kwargs):
+        key = self.get_request_key(**kwargs)
+        resource = self.resource
+        if key is None or not (resource.single_flight or resource.response_cache):
+            return self.render(*args, **kwargs)
+
+        render = lambda: self.render_shared(*args, **kwargs)
+        if resource.single_flight:
+            render_once = render
+            render = lambda: self.single_flight.do(key, render_once)
+        if resource.response_cache is not None:
+            body, status, headers = resource.response_cache.fetch(
+                resource.document.collection.full_name, key, render,
+                ttl=resource.response_cache_ttl, stale_ttl=resource.response_cache_stale_ttl,
+                spawn=spawn_with_request_context)
+        else:
+            body, status, headers = render()
+        return Response(body, status=status, headers=headers)
+
+    def render(self, *args, **kwargs):
         # keep all the logic in a helper method (_dispatch_request) so that
         # it's easy for subclasses to override this method (when they don't want to use
-        # this mimerender decorator) without them also having to copy/paste all the
-        # authentication logic, etc.
-        return self._dispatch_request(*args, **kwargs)
+        # the mimerender decorator of render_response) without them also having to
+        # copy/paste all the authentication logic, etc.
+        ret = self._dispatch_request(*args, **kwargs)
+        if isinstance(ret, Response):
+            # Streamed responses are already encoded
+            return ret
+        return self.render_response(ret)
+
+    def render_shared(self, *args, **kwargs):
+        """
+        Render the response and return its body, status and headers, which
+        concurrent identical requests can turn into their own response.
+        """
+        response = self.render(*args, **kwargs)
+        return response.get_data(), response.status, list(response.headers)
+
+    def get_request_key(self, **kwargs):
+        """
+        Return the key by which identical List and Fetch requests share
+        their response (see Resource.single_flight and
+        Resource.response_cache), or None if the request must run on its own.
+        """
+        if request.method != 'GET' or 'action' in kwargs:
+            return None
+        scope = self.get_auth_scope()
+        if scope is None:
+            return None
+        args = tuple(sorted(request.args.items(multi=True)))
+        resource = '%s.%s' % (self.resource.__module__, self.resource.__name__)
+        return (resource, request.path, args, self.accepts_json(), scope)
+
+    def get_auth_scope(self):
+        """
+        Return a value identifying who the request is authorized as. Only
+        requests with the same scope share their responses. Defaults to the
+        request's credentials (Authorization and Cookie headers); override it
+        to share responses more widely (e.g. return the user's role), or
+        return None to never share the request's response.
+        """
+        return (request.headers.get('Authorization'), request.headers.get('Cookie'))
+
+    @mimerender(default='json', json=render_json, html=render_html)
+    def render_response(self, ret):
+        return ret
 
     def _dispatch_request(self, *args, **kwargs):
-        authorized = True if len(self.authentication_methods) == 0 else False
-        for authentication_method in self.authentication_methods:
-            if callable(authentication_method):
-                if authentication_method().authorized():
-                    authorized = True
-                else:
-                    authorized = False
-            else:
-                if authentication_method.authorized():
-                    authorized = True
-                else:
-                    authorized = False
-        if not authorized:
+        if not is_authorized(self.authentication_methods):
             return {'error': 'Unauthorized'}, '401 Unauthorized'
 
         try:
             self._resource = self.requested_resource(request)
+            action = kwargs.pop('action', None)
+            if action is not None:
+                return getattr(self, self.get_action_method(action).handler)(*args, **kwargs)
             return super(ResourceView, self).dispatch_request(*args, **kwargs)
         except mongoengine.queryset.DoesNotExist as e:
             return {'error': 'Empty query: ' + str(e)}, '404 Not Found'
         except ValidationError as e:
             return e.message, '400 Bad Request'
+        except PreconditionFailed as e:
+            return e.message, '412 Precondition Failed'
+        except Conflict as e:
+            return e.message, '409 Conflict'
+        except ExecutionTimeout:
+            return {'error': 'The request took too long.'}, '504 Gateway Timeout'
+        except WTimeoutError:
+            return {'error': 'The write could not be replicated in time.'}, '503 Service Unavailable'
         except Unauthorized as e:
             return {'error': 'Unauthorized'}, '401 Unauthorized'
         except NotFound as e:
             return {'error': str(e)}, '404 Not Found'
 
+    def get_action_method(self, action):
+        """Return the method class (see methods.py) serving `action`."""
+        for method in self.methods:
+            if getattr(method, 'action', None) == action and method.method == request.method:
+                return method
+        raise NotFound
+
     def handle_validation_error(self, e):
         if isinstance(e, ValidationError):
             raise e
@@ -123,14 +229,20 @@ class ResourceView(View):
             else:
                 raise ValueError('Unsupported value of resource.get_objects')
 
-            data = []
-            for obj in objs:
-                try:
-                    data.append(self._resource.serialize(obj, params=request.args))
-                except Exception as e:
-                    fixed_obj = self._resource.handle_serialization_error(e, obj)
-                    if fixed_obj is not None:
-                        data.append(fixed_obj)
+            if self._resource.uses_serialization_pool():
+                encoded = self._resource.get_encoded_objects(objs, request.args)
+                if self.accepts_json():
+                    return self.encoded_list_response(encoded, has_more, amount)
+                data = [json.loads(chunk) for chunk in encoded]
+            else:
+                data = []
+                for obj in objs:
+                    try:
+                        data.append(self._resource.serialize(obj, params=request.args))
+                    except Exception as e:
+                        fixed_obj = self._resource.handle_serialization_error(e, obj)
+                        if fixed_obj is not None:
+                            data.append(fixed_obj)
 
             # Serialize the objects one by one
             ret = {
@@ -145,8 +257,26 @@ class ResourceView(View):
         else:
             obj = self._resource.get_object(pk)
             ret = self._resource.serialize(obj, params=request.args)
+            return self.versioned_response(ret, obj)
         return ret
 
+    def accepts_json(self):
+        """Return whether the response is rendered as JSON (see render_response)."""
+        return request.accept_mimetypes.best_match(['application/json', 'text/html']) != 'text/html'
+
+    def encoded_list_response(self, encoded, has_more, amount):
+        """
+        Return a List response made of the already encoded JSON objects
+        `encoded` (see Resource.get_encoded_objects).
+        """
+        chunks = ['{"data": [', ', '.join(encoded), ']']
+        if has_more is not None:
+            chunks.append(', "has_more": %s' % json.dumps(has_more))
+        if amount:
+            chunks.append(', "amount": %s' % json.dumps(amount, allow_nan=False, cls=MongoEncoder))
+        chunks.append('}')
+        return Response(''.join(chunks), mimetype='application/json')
+
     def post(self, **kwargs):
         if 'pk' in kwargs:
             raise NotFound("Did you mean to use PUT?")
@@ -208,7 +338,11 @@ class ResourceView(View):
         else:
             self._resource.view_method = methods.BulkUpdate
 
-        if pk is None:
+        if pk is None and self._resource.bulk_jobs:
+            return self.enqueue_bulk_write('update')
+        elif pk is None and self._resource.bulk_update_chunk_size:
+            return self.stream_bulk_update()
+        elif pk is None:
             # Bulk update where the body contains the new values for certain
             # fields.
 
@@ -231,15 +365,174 @@ class ResourceView(View):
 
             # Update all the objects and return their count
             return self.process_objects(objs)
+        elif self._resource.allow_upsert:
+            return self.upsert_object(pk)
         else:
             obj = self._resource.get_object(pk)
+            if obj is None:
+                raise NotFound("Object %s does not exist." % pk)
+            # Fail early if the client's copy is stale
+            self._resource.check_version(obj)
             self.process_object(obj)
             ret = self._resource.serialize(obj, params=request.args)
+            return self.versioned_response(ret, obj)
+
+    def stream_bulk_update(self):
+        """
+        Validate the request once and apply it to all the matching objects
+        in chunks, without loading them.
+        """
+        if not self.has_bulk_change_permission(request):
+            raise Unauthorized
+
+        self._resource.validate_request()
+        return self._resource.run_bulk_write(self._resource.get_bulk_write_spec('update'))
+
+    def enqueue_bulk_write(self, kind):
+        """
+        Validate a bulk update or bulk delete (depending on `kind`) and hand
+        it over to the job backend. Respond with a 202 Accepted and the URL
+        of the job resource.
+        """
+        assert self.job_backend is not None, 'Bulk jobs require a job_backend'
+
+        if kind == 'update':
+            if not self.has_bulk_change_permission(request):
+                raise Unauthorized
+            self._resource.validate_request()
+        elif not self.has_bulk_delete_permission(request):
+            raise Unauthorized
+
+        spec = self._resource.get_bulk_write_spec(kind)
+        # The job's status is only reported to clients authorized by this
+        # view (see JobView)
+        owner = {'view': request.endpoint, 'id': self.get_job_owner(request)}
+        job = self.job_backend.submit(self._resource.get_collection(), spec, owner=owner)
+        ret = JobView.serialize_job(job)
+        return ret, '202 Accepted', {'Location': ret['url']}
+
+    def get_job_owner(self, request):
+        """
+        Return an identifier (any JSON value) of the client of `request`,
+        such as a user id. Only that client can read the status of the bulk
+        jobs it starts. None lets any client authorized by this view read
+        them.
+        """
+        return None
+
+    def upsert_object(self, pk):
+        """Validate the request and create or replace the object at `pk`"""
+        # The existing object is only loaded if a permission hook needs it
+        existing = None
+        if self.overrides_permission('has_change_permission') or self.overrides_permission('has_add_permission'):
+            existing = self._resource.get_object(pk)
+            if existing is not None and not self.has_change_permission(request, existing):
+                raise Unauthorized
+
+        self._resource.validate_request()
+        has_permission = None
+        if existing is None:
+            has_permission = lambda obj: self.has_add_permission(request, obj)
+        try:
+            obj, created = self._resource.upsert_object(pk, has_permission=has_permission)
+        except Exception as e:
+            self.handle_validation_error(e)
+
+        ret = self._resource.serialize(obj, params=request.args)
+        if not created:
+            return self.versioned_response(ret, obj)
+        headers = {}
+        if self._resource.uri_prefix:
+            headers['Location'] = self._resource._url(str(obj.id))
+        etag = self._resource.get_etag(obj)
+        if etag is not None:
+            headers['ETag'] = etag
+        return ret, '201 Created', headers
+
+    def patch(self, **kwargs):
+        pk = kwargs.pop('pk', None)
+
+        # Set the view_method on a resource instance
+        self._resource.view_method = methods.Patch
+
+        # PATCH doesn't need to load the document, unless
+        # has_change_permission is overridden to inspect it
+        if self.overrides_permission('has_change_permission'):
+            current = self._resource.get_object(pk)
+            if current is None:
+                raise NotFound("Object %s does not exist." % pk)
+            if not self.has_change_permission(request, current):
+                raise Unauthorized
+
+        update = self._resource.get_atomic_update()
+        try:
+            obj = self._resource.atomic_update_object(pk, update)
+        except Exception as e:
+            self.handle_validation_error(e)
+        if obj is None:
+            raise NotFound("Object %s does not exist." % pk)
+
+        ret = self._resource.serialize(obj, params=request.args)
+        return self.versioned_response(ret, obj)
+
+    def versioned_response(self, ret, obj, status='200 OK'):
+        """Add an ETag header to the response if the object is versioned."""
+        etag = self._resource.get_etag(obj)
+        if etag is None:
             return ret
+        return ret, status, {'ETag': etag}
+
+    def import_objects(self, **kwargs):
+        """
+        Import the objects streamed in the request body (NDJSON or a JSON
+        array) and return the counts of imported and invalid records.
+        """
+        self._resource.view_method = methods.Import
+
+        # Take the params from the querystring only, the body is read as a
+        # stream
+        self._resource._params = request.args.to_dict()
+        return self._resource.import_objects(
+            self._resource.iter_import_records(),
+            has_permission=lambda obj: self.has_add_permission(request, obj))
+
+    def export_objects(self, **kwargs):
+        """
+        Stream all the objects matching the request's filters (without
+        pagination) as NDJSON or a JSON array.
+        """
+        self._resource.view_method = methods.Export
+        chunks, mimetype = self._resource.export_objects()
+        return Response(stream_with_context(chunks), mimetype=mimetype)
+
+    def aggregate_objects(self, **kwargs):
+        """
+        Return the groups of the objects matching the request's filters,
+        with their accumulated values.
+        """
+        self._resource.view_method = methods.Aggregate
+        return self._resource.aggregate_objects()
+
+    def distinct_values(self, **kwargs):
+        """
+        Return the distinct values of a field among the objects matching the
+        request's filters.
+        """
+        self._resource.view_method = methods.Distinct
+        return self._resource.distinct_values()
 
     def delete(self, **kwargs):
         pk = kwargs.pop('pk', None)
 
+        if pk is None:
+            # Bulk delete of all the objects matching the filters, in chunks
+            self._resource.view_method = methods.BulkDelete
+            if self._resource.bulk_jobs:
+                return self.enqueue_bulk_write('delete')
+            if not self.has_bulk_delete_permission(request):
+                raise Unauthorized
+            return self._resource.run_bulk_write(self._resource.get_bulk_write_spec('delete'))
+
         # Set the view_method on a resource instance
         self._resource.view_method = methods.Delete
 
@@ -266,3 +559,66 @@ class ResourceView(View):
     def has_delete_permission(self, request, obj):
         return True
 
+    # Bulk writes which don't load the objects (streamed bulk updates, bulk
+    # jobs and bulk deletes) can't call the per-object hooks above. They're
+    # denied by default if those hooks are overridden, so that per-object
+    # checks can't be bypassed.
+
+    def has_bulk_change_permission(self, request):
+        return not self.overrides_permission('has_change_permission')
+
+    def has_bulk_delete_permission(self, request):
+        return not self.overrides_permission('has_delete_permission')
+
+    def overrides_permission(self, name):
+        """Return whether the permission hook `name` is overridden by a subclass."""
+        method = getattr(type(self), name)
+        return getattr(method, '__func__', method) is not ResourceView.__dict__[name]
+
+
+class JobView(View):
+    """
+    Report the status of a bulk job (see ResourceView.job_backend).
+    Registered by UMongoRest when it's given a job backend.
+
+    Clients must be authorized by the view which started the job (its
+    authentication_methods and get_job_owner), on top of the
+    authentication_methods of this view.
+    """
+    job_backend = None
+    authentication_methods = []
+
+    def __init__(self, job_backend=None):
+        if job_backend is not None:
+            self.job_backend = job_backend
+
+    @mimerender(default='json', json=render_json, html=render_html)
+    def dispatch_request(self, *args, **kwargs):
+        if not is_authorized(self.authentication_methods):
+            return {'error': 'Unauthorized'}, '401 Unauthorized'
+        return super(JobView, self).dispatch_request(*args, **kwargs)
+
+    def get(self, job_id):
+        job = self.job_backend.get(job_id)
+        if job is None:
+            return {'error': 'Job %s does not exist.' % job_id}, '404 Not Found'
+        view_class = self.get_owner_view_class(job)
+        if view_class is None or not is_authorized(view_class.authentication_methods):
+            return {'error': 'Unauthorized'}, '401 Unauthorized'
+        if view_class().get_job_owner(request) != job['owner'].get('id'):
+            # Don't reveal the jobs of other clients
+            return {'error': 'Job %s does not exist.' % job_id}, '404 Not Found'
+        return self.serialize_job(job)
+
+    def get_owner_view_class(self, job):
+        """Return the ResourceView class which started `job`, or None."""
+        owner = job.get('owner') or {}
+        view_func = current_app.view_functions.get(owner.get('view'))
+        return getattr(view_func, 'view_class', None)
+
+    @staticmethod
+    def serialize_job(job):
+        ret = dict((k, v) for k, v in job.items() if k != 'owner')
+        ret['url'] = url_for(JOB_ENDPOINT, job_id=job['id'], _external=True)
+        return ret
+
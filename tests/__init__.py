@@ -3,8 +3,11 @@
 import json
 import copy
 import datetime
+import time
 import unittest
 import example.app as example
+from example.documents import db, instance
+from umongo import Document, fields
 from mongoengine.context_managers import query_counter
 from mongoengine.errors import ValidationError
 
@@ -1322,6 +1325,1717 @@ class InternalTestCase(unittest.TestCase):
         })
 
 
+class AtomicUpdateTestCase(unittest.TestCase):
+    """
+    Test validation of PATCH requests' atomic operators.
+    """
+
+    def setUp(self):
+        from flask_umongorest.resources import Resource
+
+        class UserResource(Resource):
+            document = example.User
+            rename_fields = {'listfield': 'tags'}
+            atomic_fields = {
+                'listfield': ['push', 'addToSet'],
+                'lastname': ['unset'],
+            }
+
+        self.resource_class = UserResource
+
+    def get_atomic_update(self, body):
+        with example.app.test_request_context('/user/', method='PATCH', data=json.dumps(body), content_type='application/json'):
+            return self.resource_class().get_atomic_update()
+
+    def test_atomic_update(self):
+        update = self.get_atomic_update({
+            '$push': {'tags': {'$each': ['a', 'b']}},
+            '$unset': {'lastname': True},
+        })
+        self.assertEqual(update, {
+            '$push': {'listfield': {'$each': ['a', 'b']}},
+            '$unset': {'lastname': ''},
+        })
+
+    def test_atomic_update_errors(self):
+        from flask_umongorest.exceptions import ValidationError as ResourceValidationError
+
+        with self.assertRaises(ResourceValidationError) as cm:
+            self.get_atomic_update({
+                '$inc': {'tags': 1},
+                '$unset': {'nick': True},
+                '$set': {'firstname': 'x'},
+            })
+        self.assertEqual(set(cm.exception.message['field-errors']), set(['tags', 'nick']))
+        self.assertEqual(cm.exception.message['errors'], ['"$set" is not a valid atomic operator.'])
+
+        with self.assertRaises(ResourceValidationError):
+            self.get_atomic_update({})
+
+
+class AggregateTestCase(unittest.TestCase):
+    """
+    Test the pipelines built by the aggregation endpoint.
+    """
+
+    def setUp(self):
+        from flask_umongorest.resources import Resource
+        import flask_umongorest.operators as ops
+
+        class UserResource(Resource):
+            document = example.User
+            rename_fields = {'lastname': 'surname'}
+            filters = {'nick': [ops.Exact]}
+            aggregate_group_by = ['lastname']
+            aggregate_accumulators = {'birthday': ['min', 'max']}
+            aggregate_max_groups = 10
+
+        self.resource_class = UserResource
+
+    def get_pipeline(self, query_string):
+        with example.app.test_request_context('/user/aggregate/?' + query_string):
+            return self.resource_class().get_aggregate_pipeline()
+
+    def test_aggregate_pipeline(self):
+        pipeline = self.get_pipeline('nick=joe&_group_by=surname&_aggregate=count,birthday__min')
+        self.assertEqual(pipeline, [
+            {'$match': {'$and': [{'nick': 'joe'}]}},
+            {'$group': {
+                '_id': {'surname': '$lastname'},
+                'count': {'$sum': 1},
+                'birthday__min': {'$min': '$birthday'},
+            }},
+            {'$sort': {'_id': 1}},
+            {'$limit': 11},
+        ])
+
+        pipeline = self.get_pipeline('')
+        self.assertEqual(pipeline[1], {'$group': {'_id': None, 'count': {'$sum': 1}}})
+
+    def test_aggregate_errors(self):
+        from flask_umongorest.exceptions import ValidationError as ResourceValidationError
+
+        for query_string in ['_group_by=nick', '_aggregate=birthday__sum', '_aggregate=nick__min']:
+            with self.assertRaises(ResourceValidationError):
+                self.get_pipeline(query_string)
+
+
+class FacetListTestCase(unittest.TestCase):
+    """
+    Test the single-aggregation List query mode.
+    """
+
+    def test_list_pipeline(self):
+        from bson.son import SON
+        from flask_umongorest.resources import Resource
+        import flask_umongorest.operators as ops
+
+        class UserResource(Resource):
+            document = example.User
+            filters = {'nick': [ops.Exact]}
+            allowed_ordering = ['firstname']
+            list_query_mode = 'facet'
+
+        with example.app.test_request_context('/user/?nick=joe&_order_by=firstname&_skip=20&_limit=10'):
+            resource = UserResource()
+            pipeline = resource.get_list_pipeline(resource.apply_filters(), resource.params)
+        self.assertEqual(pipeline, [
+            {'$match': {'$and': [{'nick': 'joe'}]}},
+            {'$sort': SON([('firstname', 1)])},
+            {'$facet': {
+                'page': [{'$skip': 20}, {'$limit': 11}],
+                'count': [{'$count': 'count'}],
+            }},
+        ])
+
+class DistinctTestCase(unittest.TestCase):
+    """
+    Test the caching of the distinct endpoint.
+    """
+
+    def test_ttl_cache(self):
+        import time
+        from flask_umongorest.cache import TTLCache
+
+        cache = TTLCache(max_entries=2)
+        cache.set('a', 1, ttl=60)
+        cache.set('b', 2, ttl=0.01)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('b'), None)
+        cache.set('c', 3, ttl=60)
+        cache.set('d', 4, ttl=60)
+        # The least recently used entry has been evicted
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('d'), 4)
+
+    def test_distinct_values(self):
+        from flask_umongorest.resources import Resource
+        from flask_umongorest.cache import TTLCache
+        import flask_umongorest.operators as ops
+
+        pipelines = []
+
+        class Collection(object):
+            def aggregate(self, pipeline):
+                pipelines.append(pipeline)
+                return iter([{'_id': 'a'}, {'_id': 'b'}, {'_id': 'c'}])
+
+        class UserResource(Resource):
+            document = example.User
+            filters = {'nick': [ops.Exact], 'lastname': [ops.Exact], 'listfield': [ops.Exact]}
+            distinct_max_values = 2
+            distinct_cache = TTLCache()
+
+            def get_collection(self):
+                return Collection()
+
+        def distinct(query_string):
+            with example.app.test_request_context('/user/distinct/?' + query_string):
+                return UserResource().distinct_values()
+
+        self.assertEqual(distinct('_field=lastname&nick=joe'), {'data': ['a', 'b'], 'has_more': True})
+        self.assertEqual(pipelines[0][:2], [
+            {'$match': {'$and': [{'nick': 'joe'}]}},
+            {'$group': {'_id': '$lastname'}},
+        ])
+        # Cached until the next write
+        distinct('_field=lastname&nick=joe')
+        self.assertEqual(len(pipelines), 1)
+        UserResource().after_write()
+        distinct('_field=lastname&nick=joe')
+        self.assertEqual(len(pipelines), 2)
+
+        from flask_umongorest.exceptions import ValidationError as ResourceValidationError
+        with self.assertRaises(ResourceValidationError):
+            distinct('_field=password')
+
+        # The elements of lists are grouped, not the whole lists
+        distinct('_field=listfield')
+        self.assertEqual(pipelines[-1][1:3], [
+            {'$unwind': '$listfield'},
+            {'$group': {'_id': '$listfield'}},
+        ])
+
+class TextSearchTestCase(unittest.TestCase):
+    """
+    Test the text search operator and the detection of text indexes.
+    """
+
+    def test_text_operator(self):
+        from flask_umongorest.resources import Resource, is_text_search
+        import flask_umongorest.operators as ops
+
+        class UserResource(Resource):
+            document = example.User
+            filters = {'nick': [ops.Exact], 'lastname': [ops.Text]}
+
+        with example.app.test_request_context('/user/?lastname__text=foo+bar&nick=joe'):
+            query_filter = UserResource().apply_filters()
+        self.assertTrue({'$text': {'$search': 'foo bar'}} in query_filter['$and'])
+        self.assertTrue(is_text_search(query_filter))
+        self.assertFalse(is_text_search({'$and': [{'nick': 'joe'}]}))
+
+    def test_has_text_index(self):
+        from flask_umongorest.indexes import IndexAdvisor
+
+        class Collection(object):
+            full_name = 'db.test'
+            indexes = {'_id_': {'key': [('_id', 1)]}}
+
+            def index_information(self):
+                return self.indexes
+
+        collection = Collection()
+        advisor = IndexAdvisor(collection)
+        self.assertFalse(advisor.has_text_index())
+
+        collection.indexes = dict(collection.indexes, title_text={
+            'key': [('_fts', 'text'), ('_ftsx', 1)],
+            'weights': {'title': 1},
+        })
+        advisor.refresh()
+        self.assertTrue(advisor.has_text_index())
+        self.assertTrue(advisor.has_text_index(['title']))
+        self.assertFalse(advisor.has_text_index(['body']))
+
+class FilterCoercionTestCase(unittest.TestCase):
+    """
+    Test the conversion of filter values to the type of their field.
+    """
+
+    def setUp(self):
+        from flask_umongorest.resources import Resource
+        import flask_umongorest.operators as ops
+
+        class UserResource(Resource):
+            document = example.User
+            rename_fields = {'birthday': 'born'}
+            coerce_filter_values = True
+            filters = {
+                'id': [ops.Exact, ops.In],
+                'nick': [ops.Exact],
+                'born': [ops.Gte],
+            }
+
+        self.resource_class = UserResource
+
+    def apply_filters(self, query_string):
+        with example.app.test_request_context('/user/?' + query_string):
+            return self.resource_class().apply_filters()['$and']
+
+    def test_coercion(self):
+        from bson.objectid import ObjectId
+
+        _id = ObjectId()
+        self.assertEqual(self.apply_filters('born__gte=2026-01-01'),
+                         [{'birthday': {'$gte': datetime.datetime(2026, 1, 1)}}])
+        self.assertEqual(self.apply_filters('id=%s' % _id), [{'id': _id}])
+        self.assertEqual(self.apply_filters('id__in=%s,%s' % (_id, _id)), [{'id': {'$in': [_id, _id]}}])
+        self.assertEqual(self.apply_filters('nick=123'), [{'nick': '123'}])
+
+        self.resource_class.coerce_filter_values = False
+        self.assertEqual(self.apply_filters('born__gte=2026-01-01'), [{'birthday': {'$gte': '2026-01-01'}}])
+
+    def test_invalid_values(self):
+        from flask_umongorest.exceptions import ValidationError as ResourceValidationError
+
+        for query_string in ['born__gte=yesterday-ish', 'id=123']:
+            with self.assertRaises(ResourceValidationError) as cm:
+                self.apply_filters(query_string)
+            self.assertEqual(list(cm.exception.message['field-errors']), [query_string.split('=')[0]])
+
+class CollationTestCase(unittest.TestCase):
+    """
+    Test the case-insensitive operators and their collation.
+    """
+
+    def setUp(self):
+        from flask_umongorest.resources import Resource
+        import flask_umongorest.operators as ops
+
+        class UserResource(Resource):
+            document = example.User
+            filters = {
+                'nick': [ops.Exact, ops.IExact, ops.IStartswith(allow_negation=True)],
+                'lastname': [ops.Startswith],
+                'firstname': [ops.Exact],
+            }
+
+        self.resource_class = UserResource
+
+    def test_operators(self):
+        with example.app.test_request_context('/user/?nick__istartswith=Jo&lastname__startswith=a.b*'):
+            resource = self.resource_class()
+            query_filter = resource.apply_filters()
+            self.assertEqual(resource.get_query_options(), {'collation': {'locale': 'en', 'strength': 2}})
+        self.assertTrue({'nick': {'$gte': 'Jo', '$lt': u'Jo\uffff'}} in query_filter['$and'])
+        self.assertTrue({'lastname': {'$regex': '^a\\.b\\*'}} in query_filter['$and'])
+
+        with example.app.test_request_context('/user/?nick=joe'):
+            resource = self.resource_class()
+            resource.apply_filters()
+            self.assertEqual(resource.get_query_options(), {})
+
+        with example.app.test_request_context('/user/?nick__not__istartswith=Jo'):
+            resource = self.resource_class()
+            self.assertEqual(resource.apply_filters()['$and'], [{'nick': {'$not': {'$gte': 'Jo', '$lt': u'Jo\uffff'}}}])
+            self.assertTrue(resource.get_query_options()['collation'])
+
+    def test_regex_fallback(self):
+        import re
+
+        # The collation would make the other filters case-insensitive too
+        with example.app.test_request_context('/user/?nick__iexact=J.o&firstname=Ann'):
+            resource = self.resource_class()
+            query_filter = resource.apply_filters()
+            self.assertEqual(resource.get_query_options(), {})
+            self.assertEqual(resource.get_collation_fields(), set(['nick']))
+        self.assertTrue({'firstname': 'Ann'} in query_filter['$and'])
+        self.assertTrue({'nick': re.compile(u'^J\\.o$', re.IGNORECASE | re.UNICODE)} in query_filter['$and'])
+
+    def test_has_collation_index(self):
+        from flask_umongorest.indexes import IndexAdvisor
+
+        class Collection(object):
+            def index_information(self):
+                return {
+                    '_id_': {'key': [('_id', 1)]},
+                    'nick_1': {'key': [('nick', 1)], 'collation': {'locale': 'en', 'strength': 2, 'caseLevel': False}},
+                }
+
+        advisor = IndexAdvisor(Collection())
+        self.assertTrue(advisor.has_collation_index('nick', {'locale': 'en', 'strength': 2}))
+        self.assertFalse(advisor.has_collation_index('nick', {'locale': 'fr', 'strength': 2}))
+        self.assertFalse(advisor.has_collation_index('lastname', {'locale': 'en', 'strength': 2}))
+
+class OrderingTestCase(unittest.TestCase):
+    """
+    Test multi-field orderings and the detection of unindexed sorts.
+    """
+
+    def setUp(self):
+        from flask_umongorest.resources import Resource
+        import flask_umongorest.operators as ops
+
+        class UserResource(Resource):
+            document = example.User
+            rename_fields = {'lastname': 'surname'}
+            filters = {'nick': [ops.Exact]}
+            allowed_ordering = ['firstname', 'lastname', 'birthday']
+            unindexed_sort_policy = 'reject'
+            sort_indexes = [[('nick', 1), ('birthday', -1)], [('lastname', 1), ('firstname', 1)]]
+
+        self.resource_class = UserResource
+
+    def test_apply_ordering(self):
+        with example.app.test_request_context('/user/?_order_by=-surname,%2Bfirstname'):
+            resource = self.resource_class()
+            self.assertEqual(resource.apply_ordering(), ['-lastname', 'firstname'])
+            self.assertEqual(resource.get_db_sort(), [('lastname', -1), ('firstname', 1)])
+
+        from flask_umongorest.exceptions import ValidationError as ResourceValidationError
+        for order_by in ['password', 'firstname,lastname,birthday,firstname']:
+            with example.app.test_request_context('/user/?_order_by=' + order_by):
+                # Invalid orderings are ignored...
+                self.assertIsNone(self.resource_class().apply_ordering())
+                # ... unless the resource is strict
+                self.resource_class.strict_ordering = True
+                with self.assertRaises(ResourceValidationError):
+                    self.resource_class().apply_ordering()
+                self.resource_class.strict_ordering = False
+
+    def test_check_sort(self):
+        from flask_umongorest.exceptions import ValidationError as ResourceValidationError
+
+        def check_sort(query_string):
+            with example.app.test_request_context('/user/?' + query_string):
+                resource = self.resource_class()
+                resource.check_sort(resource.apply_filters(), resource.get_db_sort())
+
+        check_sort('_order_by=-surname,-firstname')
+        check_sort('nick=joe&_order_by=birthday')
+        with self.assertRaises(ResourceValidationError):
+            check_sort('_order_by=birthday')
+        with self.assertRaises(ResourceValidationError):
+            check_sort('_order_by=surname,-firstname')
+
+class QueryCostTestCase(unittest.TestCase):
+    """
+    Test the admission control of expensive queries.
+    """
+
+    def test_query_cost(self):
+        from flask_umongorest.cost import get_query_cost
+
+        query = {'$and': [
+            {'a': {'$ne': 1}},
+            {'b': {'$in': list(range(5000))}},
+            {'c': {'$regex': 'foo'}},
+            {'d': {'$regex': '^foo'}},
+        ]}
+        # 4 clauses, 1 negation, 5000 $in values, 1 unanchored regex, 1000
+        # skipped documents and no index on the filtered fields
+        self.assertEqual(get_query_cost(query, skip=1000, index_keys=[[('_id', 1)]]), 129)
+        self.assertEqual(get_query_cost(query, index_keys=[[('b', 1)]]), 69)
+        self.assertEqual(get_query_cost({}), 0)
+
+    def test_max_query_cost(self):
+        from flask_umongorest.resources import Resource
+        from flask_umongorest.exceptions import ValidationError as ResourceValidationError
+        import flask_umongorest.operators as ops
+
+        class UserResource(Resource):
+            document = example.User
+            filters = {'nick': [ops.Exact, ops.Ne, ops.In]}
+            max_query_cost = 20
+
+        def check_query_cost(query_string):
+            with example.app.test_request_context('/user/?' + query_string):
+                resource = UserResource()
+                resource.check_query_cost(resource.apply_filters(), skip=resource.get_skip_and_limit()[0])
+
+        check_query_cost('nick=joe&_skip=100')
+        with self.assertRaises(ResourceValidationError):
+            check_query_cost('nick__ne=joe&_skip=2000')
+        with self.assertRaises(ResourceValidationError):
+            check_query_cost('nick__in=' + ','.join(str(i) for i in range(2000)))
+
+
+class QueryDeadlineTestCase(unittest.TestCase):
+    """
+    Test the propagation of the request's time budget to the queries.
+    """
+
+    def test_max_time_ms(self):
+        from flask_umongorest.resources import Resource
+        from flask_umongorest.exceptions import ValidationError as ResourceValidationError
+
+        class UserResource(Resource):
+            document = example.User
+            max_time_ms = 500
+
+        def get_options(headers=None, aggregate=False):
+            with example.app.test_request_context('/user/', headers=headers or {}):
+                return UserResource().get_query_options(aggregate=aggregate)
+
+        self.assertEqual(get_options().get('max_time_ms'), 500)
+        self.assertEqual(get_options(aggregate=True).get('maxTimeMS'), 500)
+        # The header can only lower the budget
+        self.assertEqual(get_options({'X-Timeout-Ms': '100'}).get('max_time_ms'), 100)
+        self.assertEqual(get_options({'X-Timeout-Ms': '10000'}).get('max_time_ms'), 500)
+        with self.assertRaises(ResourceValidationError):
+            get_options({'X-Timeout-Ms': 'soon'})
+
+        UserResource.max_time_ms = None
+        self.assertNotIn('max_time_ms', get_options())
+        self.assertEqual(get_options({'X-Timeout-Ms': '100'}).get('max_time_ms'), 100)
+
+    def test_export_max_time_ms(self):
+        from flask_umongorest.resources import Resource
+
+        class UserResource(Resource):
+            document = example.User
+            max_time_ms = 500
+
+        with example.app.test_request_context('/user/export/'):
+            # Streams outlive the request's time budget
+            self.assertNotIn('max_time_ms', UserResource().get_export_query_options())
+            UserResource.export_max_time_ms = 60000
+            self.assertEqual(UserResource().get_export_query_options()['max_time_ms'], 60000)
+
+
+class ReadPreferenceTestCase(unittest.TestCase):
+    """
+    Test the routing of reads by view method and read-your-writes pinning.
+    """
+
+    def test_read_preferences(self):
+        from pymongo.read_preferences import Primary, SecondaryPreferred
+        from flask_umongorest import methods
+        from flask_umongorest.resources import Resource
+
+        class UserResource(Resource):
+            document = example.User
+            read_preferences = {methods.List: {'mode': 'secondaryPreferred', 'max_staleness': 90}}
+            read_your_writes_window = 10
+
+        def get_read_preference(view_method, cookies=''):
+            headers = {'Cookie': cookies} if cookies else {}
+            with example.app.test_request_context('/user/', headers=headers):
+                return UserResource(view_method=view_method).get_read_collection().read_preference
+
+        self.assertEqual(get_read_preference(methods.List), SecondaryPreferred(max_staleness=90))
+        self.assertEqual(get_read_preference(methods.Fetch), example.User.collection.read_preference)
+        # Recent writers read from the primary
+        until = int(time.time()) + 10
+        self.assertEqual(get_read_preference(methods.List, 'umongorest_primary_until=%d' % until), Primary())
+        self.assertEqual(get_read_preference(methods.List, 'umongorest_primary_until=%d' % (until - 20)),
+                         SecondaryPreferred(max_staleness=90))
+
+
+class ChunkedBulkWriteTestCase(unittest.TestCase):
+    """
+    Test bulk.run_in_chunks against a minimal in-memory collection.
+    """
+
+    class Collection(object):
+        def __init__(self, ids, fail_on=None):
+            self.ids = ids
+            self.fail_on = fail_on
+            self.written = []
+
+        def find(self, query, projection=None, collation=None):
+            after = query.get('_id', {}).get('$gt', -1) if query else -1
+            collection = self
+
+            class Cursor(list):
+                def sort(self, *args):
+                    return self
+
+                def batch_size(self, size):
+                    return self
+            return Cursor({'_id': i} for i in collection.ids if i > after)
+
+        def bulk_write(self, requests, ordered=True):
+            if self.fail_on in requests:
+                raise Exception('chunk failed')
+            self.written.extend(requests)
+
+            class Result(object):
+                acknowledged = True
+                modified_count = len(requests)
+                deleted_count = 0
+            return Result()
+
+    def test_run_in_chunks(self):
+        from flask_umongorest import bulk
+
+        for workers in (1, 3):
+            collection = self.Collection(list(range(10)))
+            progress = bulk.run_in_chunks(collection, {}, lambda ids: ids, chunk_size=3, workers=workers)
+            self.assertEqual(progress.to_dict(), {'count': 10, 'modified': 10, 'chunks': 4, 'last_id': 9})
+            self.assertEqual(sorted(collection.written), list(range(10)))
+
+        collection = self.Collection(list(range(10)))
+        bulk.run_in_chunks(collection, {}, lambda ids: ids, chunk_size=3, after=5)
+        self.assertEqual(collection.written, [6, 7, 8, 9])
+
+    def test_run_in_chunks_interrupted(self):
+        from flask_umongorest import bulk
+        from flask_umongorest.exceptions import BulkWriteInterrupted
+
+        collection = self.Collection(list(range(10)), fail_on=4)
+        with self.assertRaises(BulkWriteInterrupted) as cm:
+            bulk.run_in_chunks(collection, {}, lambda ids: ids, chunk_size=3)
+        self.assertEqual(cm.exception.progress.last_id, 2)
+        self.assertEqual(cm.exception.progress.count, 3)
+
+    def test_run_spec_filters(self):
+        from pymongo import DeleteOne, UpdateOne
+        from flask_umongorest import bulk
+
+        # Each write repeats the filter, in case the document stopped
+        # matching after the scan
+        collection = self.Collection([1, 2])
+        query = {'nick': 'joe'}
+        update = {'$set': {'nick': 'jack'}}
+        bulk.run_spec(collection, {'kind': 'update', 'query': query, 'update': update})
+        self.assertEqual(collection.written, [UpdateOne({'$and': [query, {'_id': _id}]}, update)
+                                              for _id in (1, 2)])
+        collection = self.Collection([1])
+        bulk.run_spec(collection, {'kind': 'delete', 'query': {}})
+        self.assertEqual(collection.written, [DeleteOne({'_id': 1})])
+
+
+class GroupCommitTestCase(unittest.TestCase):
+    """
+    Test that concurrent inserts are coalesced into batches.
+    """
+
+    class Collection(object):
+        def __init__(self):
+            import threading
+            self.batches = []
+            self.started = threading.Event()
+            self.release = threading.Event()
+
+        def insert_many(self, payloads, ordered=True):
+            from pymongo.errors import BulkWriteError
+
+            self.batches.append(list(payloads))
+            self.started.set()
+            # Hold the first batch while the others pile up
+            if len(self.batches) == 1:
+                self.release.wait()
+            errors = [{'index': i, 'code': 11000, 'errmsg': 'duplicate key'}
+                      for i, payload in enumerate(payloads) if payload.get('duplicate')]
+            if errors:
+                raise BulkWriteError({'writeErrors': errors})
+
+    def test_group_commit(self):
+        import threading
+        from flask_umongorest.concurrency import GroupCommitter
+
+        collection = self.Collection()
+        committer = GroupCommitter(collection, window=1, max_size=5)
+        ids = []
+        threads = [threading.Thread(target=lambda i=i: ids.append(committer.insert({'i': i}))) for i in range(10)]
+        # The first insert is alone, so it's written right away
+        threads[0].start()
+        collection.started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        collection.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(ids)), 10)
+        self.assertEqual([len(batch) for batch in collection.batches], [1, 5, 4])
+        stats = committer.stats()
+        self.assertEqual(stats['batches'], 3)
+        self.assertEqual(stats['documents'], 10)
+        self.assertEqual(stats['max_batch_size'], 5)
+
+    def test_lone_insert(self):
+        from pymongo.errors import WriteError
+        from flask_umongorest.concurrency import GroupCommitter
+
+        collection = self.Collection()
+        collection.release.set()
+        committer = GroupCommitter(collection, window=10)
+        started = time.time()
+        committer.insert({'i': 0})
+        self.assertLess(time.time() - started, 1)
+
+        with self.assertRaises(WriteError) as cm:
+            committer.insert({'duplicate': True})
+        self.assertEqual(cm.exception.code, 11000)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """
+    Test that concurrent identical calls share a single execution.
+    """
+
+    def test_single_flight(self):
+        import threading
+        from flask_umongorest.concurrency import SingleFlight
+
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        runs = []
+
+        def fn():
+            runs.append(1)
+            started.set()
+            release.wait()
+            return b'{"data": []}'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(single_flight.do('key', fn)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(single_flight.do('key', fn)))
+                     for _ in range(5)]
+        for thread in followers:
+            thread.start()
+        # Wait for the followers to join the running call
+        while single_flight.stats()['shared'] < 5:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(results, [b'{"data": []}'] * 6)
+        # Calls made after the first one completed run again
+        self.assertEqual(single_flight.do('key', lambda: b'{}'), b'{}')
+        self.assertEqual(single_flight.stats(), {'calls': 2, 'shared': 5})
+
+    def test_single_flight_error(self):
+        from flask_umongorest.concurrency import SingleFlight
+
+        def fn():
+            raise ValueError('boom')
+
+        single_flight = SingleFlight()
+        with self.assertRaises(ValueError):
+            single_flight.do('key', fn)
+        # Failed calls aren't remembered
+        self.assertEqual(single_flight.do('key', lambda: 1), 1)
+
+
+class RedisStandIn(object):
+    """
+    Minimal server speaking the Redis protocol (GET, SET [NX] [EX], INCR and
+    DEL), to test the RedisBackend without a Redis server.
+    """
+
+    def __init__(self):
+        import socket
+        import threading
+
+        self.data = {}
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        import threading
+
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except Exception:
+                return
+            thread = threading.Thread(target=self.handle, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, sock):
+        reader = sock.makefile('rb')
+        while True:
+            line = reader.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(reader.readline()[1:])
+                args.append(reader.read(length + 2)[:-2])
+            sock.sendall(self.run(args[0].upper(), args[1:]))
+
+    def run(self, command, args):
+        def bulk(value):
+            return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+
+        if command == b'GET':
+            return bulk(self.data.get(args[0]))
+        if command == b'SET':
+            if b'NX' in args[2:] and args[0] in self.data:
+                return bulk(None)
+            self.data[args[0]] = args[1]
+            return b'+OK\r\n'
+        if command == b'INCR':
+            self.data[args[0]] = str(int(self.data.get(args[0], 0)) + 1).encode('ascii')
+            return b':%s\r\n' % self.data[args[0]]
+        if command == b'DEL':
+            return b':%d\r\n' % int(self.data.pop(args[0], None) is not None)
+        return b'-ERR unknown command\r\n'
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """
+    Test the shared response cache and its backends.
+    """
+
+    def check_backend(self, backend):
+        self.assertEqual(backend.get('a'), None)
+        backend.set('a', b'1', 10)
+        self.assertEqual(backend.get('a'), b'1')
+        self.assertFalse(backend.add('a', b'2', 10))
+        self.assertTrue(backend.add('b', b'2', 10))
+        backend.delete('a')
+        self.assertEqual(backend.get('a'), None)
+        self.assertEqual(backend.incr('c'), 1)
+        self.assertEqual(backend.incr('c'), 2)
+
+    def test_memory_backend(self):
+        from flask_umongorest.response_cache import MemoryBackend
+        self.check_backend(MemoryBackend())
+
+    def test_redis_backend(self):
+        from flask_umongorest.response_cache import RedisBackend
+        from flask_umongorest.exceptions import CacheBackendError
+
+        self.check_backend(RedisBackend(port=RedisStandIn().port, host='127.0.0.1'))
+        with self.assertRaises(CacheBackendError):
+            RedisBackend(port=RedisStandIn().port, host='127.0.0.1').execute('FLUSHALL')
+
+    def test_stale_while_revalidate(self):
+        from flask_umongorest.response_cache import ResponseCache, RedisBackend
+
+        cache = ResponseCache(RedisBackend(port=RedisStandIn().port, host='127.0.0.1'))
+        renders = []
+        spawned = []
+
+        def render():
+            renders.append(1)
+            return b'{"n": %d}' % len(renders), '200 OK', [('Content-Type', 'application/json')]
+
+        def fetch(ttl):
+            return cache.fetch('db.user', ('/user/',), render, ttl=ttl, stale_ttl=60, spawn=spawned.append)
+
+        self.assertEqual(fetch(0)[0], b'{"n": 1}')
+        # The response is stale: it's served while a single refresh is
+        # spawned
+        self.assertEqual(fetch(0)[0], b'{"n": 1}')
+        self.assertEqual(fetch(0)[0], b'{"n": 1}')
+        self.assertEqual(len(spawned), 1)
+        spawned.pop()()
+        self.assertEqual(fetch(0), (b'{"n": 2}', '200 OK', [('Content-Type', 'application/json')]))
+        self.assertEqual(len(renders), 2)
+
+        # Writes invalidate the cached responses
+        cache.bump_generation('db.user')
+        self.assertEqual(fetch(60)[0], b'{"n": 3}')
+
+    def test_writes_of_other_resources(self):
+        from flask_umongorest.resources import Resource
+        from flask_umongorest.response_cache import ResponseCache, MemoryBackend
+
+        cache = ResponseCache(MemoryBackend())
+
+        class CachedUserResource(Resource):
+            document = example.User
+            response_cache = cache
+
+        class UserResource(Resource):
+            document = example.User
+
+        namespace = example.User.collection.full_name
+        render = lambda: (b'{}', '200 OK', [])
+        cache.fetch(namespace, ('/user/',), render, ttl=60)
+        generation = cache.get_generation(namespace)
+        # Writes of resources without a response cache invalidate the
+        # responses of the others
+        with example.app.test_request_context('/user/', method='POST'):
+            UserResource().after_write()
+        self.assertEqual(cache.get_generation(namespace), generation + 1)
+
+
+class InvalidationBusTestCase(unittest.TestCase):
+    """
+    Test the publication and dispatch of write events between processes.
+    """
+
+    class Collection(object):
+        def __init__(self):
+            self.events = []
+
+        def insert_one(self, doc):
+            self.events.append(doc)
+
+    def test_dispatch(self):
+        from flask_umongorest import cache
+        from flask_umongorest.invalidation import InvalidationBus
+
+        collection = self.Collection()
+        publisher = InvalidationBus(collection)
+        subscriber = InvalidationBus(collection)
+        received = []
+        subscriber.subscribe(received.append)
+
+        self.assertTrue(publisher.publish('db.bus_test', 1, 5))
+        event = collection.events[0]
+        self.assertEqual((event['ns'], event['id'], event['generation']), ('db.bus_test', 1, 5))
+
+        generation = cache.get_generation('db.bus_test')
+        # Processes ignore their own events
+        publisher.dispatch(event)
+        self.assertEqual(cache.get_generation('db.bus_test'), generation)
+        subscriber.dispatch(event)
+        self.assertEqual(cache.get_generation('db.bus_test'), generation + 1)
+        self.assertEqual(received, [event])
+
+    def test_response_caches(self):
+        from flask_umongorest import response_cache
+        from flask_umongorest.invalidation import InvalidationBus
+        from flask_umongorest.response_cache import ResponseCache, MemoryBackend
+
+        # e.g. a cache in the memory of the receiving process
+        local_cache = ResponseCache(MemoryBackend())
+        response_cache.register('db.bus_cache_test', local_cache)
+        bus = InvalidationBus(self.Collection())
+        bus.dispatch({'ns': 'db.bus_cache_test', 'id': None, 'origin': 'other'})
+        self.assertEqual(local_cache.get_generation('db.bus_cache_test'), 1)
+        bus.resync()
+        self.assertEqual(local_cache.get_generation('db.bus_cache_test'), 2)
+
+    def test_tail_resume(self):
+        from flask_umongorest import cache
+        from flask_umongorest.invalidation import InvalidationBus
+
+        class Cursor(object):
+            def __init__(self, events):
+                self.events = events
+                self.alive = True
+
+            def __iter__(self):
+                self.alive = False
+                return iter(self.events)
+
+        class CappedCollection(object):
+            database = name = None
+
+            def __init__(self, events, reads):
+                self.events = events
+                self.reads = reads
+
+            def find_one(self, sort=None, projection=None):
+                return self.events[-1]
+
+            def find(self, cursor_type=None):
+                if not self.reads:
+                    bus.stop()
+                    return Cursor([])
+                self.events = self.reads.pop(0)(self.events)
+                return Cursor(list(self.events))
+
+        def event(_id):
+            return {'_id': _id, 'ns': 'db.tail_test', 'id': None, 'origin': 'other'}
+
+        reads = [
+            # An event published by a host with a late clock has a lower _id
+            lambda events: events + [event(2)],
+            # The events received so far were overwritten before the cursor
+            # could resume
+            lambda events: [event(7)],
+        ]
+        bus = InvalidationBus(CappedCollection([event(10)], reads), poll_interval=0)
+        bus.ensure_collection = lambda: None
+        received = []
+        bus.subscribe(received.append)
+        generation = cache.get_generation('db.tail_resync_test')
+        bus._tail()
+        self.assertEqual([e['_id'] for e in received if e['ns']], [2])
+        # Missed events invalidate everything
+        self.assertEqual(received[-1]['ns'], None)
+        self.assertEqual(cache.get_generation('db.tail_resync_test'), generation + 1)
+
+
+class HotReplicaTestCase(unittest.TestCase):
+    """
+    Test the in-memory replica of small collections.
+    """
+
+    class Collection(object):
+        full_name = 'db.country'
+
+        def __init__(self, docs):
+            self.docs = docs
+
+        def find(self, query=None, sort=None, limit=None):
+            return [dict(doc) for doc in self.docs][:limit]
+
+        def find_one(self, query):
+            docs = [dict(doc) for doc in self.docs if doc['_id'] == query['_id']]
+            return docs[0] if docs else None
+
+    def get_replica(self):
+        from flask_umongorest.replica import HotReplica
+
+        rows = [('FR', 'eu', 67, ['euro']), ('DE', 'eu', 83, ['euro']), ('US', 'na', 331, []),
+                ('CA', 'na', 38, ['g7']), ('XX', None, 0, [])]
+        docs = [{'_id': i, 'code': code, 'region': region, 'pop': pop, 'tags': tags}
+                for i, (code, region, pop, tags) in enumerate(rows)]
+        collection = self.Collection(docs)
+        replica = HotReplica(collection, index_fields=['region', 'code'])
+        replica.load()
+        return replica, collection
+
+    def test_find(self):
+        replica, _ = self.get_replica()
+
+        def codes(query, **kwargs):
+            return [doc['code'] for doc in replica.find(query, **kwargs)[0]]
+
+        self.assertEqual(codes({'$and': [{'region': 'eu'}]}, sort=[('pop', -1)]), ['DE', 'FR'])
+        query = {'$and': [{'region': {'$in': ['eu', 'na']}}, {'pop': {'$gt': 50}}]}
+        self.assertEqual(replica.find(query, skip=1, limit=1)[1], 3)
+        self.assertEqual(codes(query, skip=1, limit=1), ['DE'])
+        # Missing and null values match null
+        self.assertEqual(codes({'region': None}), ['XX'])
+        self.assertEqual(len(codes({'region': {'$ne': None}})), 4)
+        # Arrays match if any of their elements does
+        self.assertEqual(codes({'tags': 'euro'}), ['FR', 'DE'])
+        self.assertEqual(codes({'code': {'$regex': '^f', '$options': 'i'}}), ['FR'])
+        self.assertEqual(len(codes({'code': {'$not': {'$in': ['FR']}}})), 4)
+
+    def test_unsupported_query(self):
+        from flask_umongorest.exceptions import UnsupportedQuery
+
+        replica, _ = self.get_replica()
+        for query in [{'$text': {'$search': 'france'}}, {'code': {'$where': 'true'}}]:
+            with self.assertRaises(UnsupportedQuery):
+                replica.find(query)
+
+    def test_events(self):
+        replica, collection = self.get_replica()
+
+        collection.docs.append({'_id': 9, 'code': 'JP', 'region': 'as', 'pop': 125, 'tags': []})
+        replica.handle_event({'ns': 'db.country', 'id': 9})
+        self.assertEqual(replica.get(9)['code'], 'JP')
+        self.assertEqual(replica.find({'region': 'as'})[1], 1)
+
+        collection.docs.pop(0)
+        replica.handle_event({'ns': 'db.country', 'id': 0})
+        self.assertEqual(replica.get(0), None)
+        self.assertEqual(replica.find({'region': 'eu'})[1], 1)
+        # Events of other collections are ignored
+        replica.handle_event({'ns': 'db.other', 'id': 1})
+        self.assertEqual(replica.get(1)['code'], 'DE')
+
+    def test_failed_refresh(self):
+        from flask_umongorest.exceptions import UnsupportedQuery
+
+        replica, collection = self.get_replica()
+        replica.max_documents = len(collection.docs)
+        replica.poll_interval = 0
+        collection.docs.append({'_id': 9, 'code': 'JP', 'region': 'as', 'pop': 125, 'tags': []})
+        find = collection.find
+
+        def find_once(*args, **kwargs):
+            replica.stop()
+            return find(*args, **kwargs)
+        collection.find = find_once
+        # The reload fails: the replica is dropped instead of serving stale
+        # documents, and queries fall back to MongoDB
+        replica._poll()
+        self.assertFalse(replica.loaded)
+        with self.assertRaises(UnsupportedQuery):
+            replica.find({})
+        with self.assertRaises(UnsupportedQuery):
+            replica.get(0)
+
+    def test_replica_per_process(self):
+        from flask_umongorest import replica
+
+        collection = self.Collection([{'_id': 1, 'code': 'FR'}])
+        created = []
+
+        def on_create(hot_replica):
+            # Replicas are loaded without holding up the other ones
+            self.assertTrue(replica._replicas_lock.acquire(False))
+            replica._replicas_lock.release()
+            created.append(hot_replica)
+
+        first = replica.get_hot_replica(collection, on_create=on_create)
+        self.assertIs(replica.get_hot_replica(collection, on_create=on_create), first)
+        # Forked workers create their own replica (and polling thread)
+        first.pid = -1
+        self.assertIsNot(replica.get_hot_replica(collection, on_create=on_create), first)
+        self.assertEqual(len(created), 2)
+
+        created[1].load()
+        collection.docs.append({'_id': 2, 'code': 'DE'})
+        replica.handle_event({'ns': 'db.country', 'id': 2})
+        self.assertEqual(created[1].get(2)['code'], 'DE')
+        replica._replicas.pop('db.country')
+
+    def test_read_your_writes(self):
+        from flask_umongorest.resources import Resource
+        from flask_umongorest import methods, replica
+
+        class UserResource(Resource):
+            document = example.User
+            hot_replica = True
+            read_your_writes_window = 10
+
+        resource = UserResource()
+        resource.view_method = methods.Fetch
+        with example.app.test_request_context('/user/'):
+            self.assertTrue(resource.uses_hot_replica())
+        cookie = '%s=%d' % (UserResource.read_your_writes_cookie, time.time() + 10)
+        with example.app.test_request_context('/user/', headers={'Cookie': cookie}):
+            self.assertFalse(resource.uses_hot_replica())
+
+        # Writes are applied to the replica of the writing process
+        with example.app.test_request_context('/user/', method='POST'):
+            hot_replica = resource.get_hot_replica()
+            user = example.User(nick='replica')
+            user.commit()
+            resource.after_write(user.pk)
+            self.assertEqual(hot_replica.get(user.pk)['nick'], 'replica')
+            user.delete()
+        replica._replicas.pop(example.User.collection.full_name).stop()
+
+    def test_sort_policies(self):
+        from flask_umongorest import methods, replica
+        from flask_umongorest.resources import Resource
+        from flask_umongorest.views import ResourceView
+
+        class UserResource(Resource):
+            document = example.User
+            hot_replica = True
+            allowed_ordering = ['firstname']
+            unindexed_sort_policy = 'reject'
+            sort_indexes = []
+
+        class UserView(ResourceView):
+            resource = UserResource
+            methods = [methods.List]
+
+        example.User.collection.drop()
+        for nick in ('b', 'a'):
+            example.User(nick=nick, firstname=nick).commit()
+        app = make_test_client(UserView)
+        # The replica sorts in memory, without MongoDB's sort policies
+        resp = app.get('/user/?_order_by=firstname')
+        response_success(resp)
+        self.assertEqual([user['nick'] for user in resp_json(resp)['data']], ['a', 'b'])
+        replica._replicas.pop(example.User.collection.full_name).stop()
+
+
+class StreamingParserTestCase(unittest.TestCase):
+    """
+    Test the incremental parsers used by imports.
+    """
+
+    def test_iter_json_array(self):
+        import io
+        from flask_umongorest.utils import iter_json_array
+
+        records = [{'n': i, 'text': u'ünïcode ' * i} for i in range(100)]
+        stream = io.BytesIO(json.dumps(records).encode('utf-8'))
+        # A tiny chunk size splits objects and multi-byte characters
+        self.assertEqual(list(iter_json_array(stream, chunk_size=5)), records)
+        self.assertEqual(list(iter_json_array(io.BytesIO(b' [ ] '))), [])
+
+        for invalid in [b'{}', b'[1]', b'[{"a": 1}', b'[{"a": 1}}', b'[{"a": 1}] []']:
+            with self.assertRaises(ValueError):
+                list(iter_json_array(io.BytesIO(invalid), chunk_size=3))
+
+    def test_iter_ndjson(self):
+        import io
+        from flask_umongorest.utils import iter_ndjson
+
+        records = list(iter_ndjson(io.BytesIO(b'{"a": 1}\n\ninvalid\n{"b": 2}')))
+        self.assertEqual(records[0], (1, {'a': 1}))
+        self.assertEqual(records[1][0], 3)
+        self.assertTrue(isinstance(records[1][1], ValueError))
+        self.assertEqual(records[2], (4, {'b': 2}))
+
+        # Lines are read up to the size limit
+        def stream(size):
+            return io.BytesIO(b'{"a": 1}\n{"b": "' + b'x' * size + b'"}\n')
+        self.assertEqual(len(list(iter_ndjson(stream(10), max_record_size=19))), 2)
+        with self.assertRaises(ValueError) as cm:
+            list(iter_ndjson(stream(11), max_record_size=19))
+        self.assertIn('Line 2', str(cm.exception))
+
+
+class PartitionedScanTestCase(unittest.TestCase):
+    """
+    Test the splitting of scans into _id ranges read in parallel.
+    """
+
+    def test_boundaries(self):
+        from bson.objectid import ObjectId
+        from flask_umongorest.partitions import get_boundaries, partition_queries
+
+        start = datetime.datetime(2020, 1, 1)
+        ids = [ObjectId.from_datetime(start + datetime.timedelta(hours=i)) for i in range(100)]
+
+        class Collection(object):
+            def find_one(self, query, projection, sort):
+                return {'_id': sorted(ids, reverse=sort[0][1] == -1)[0]}
+
+        boundaries = get_boundaries(Collection(), {}, 4)
+        self.assertEqual(len(boundaries), 3)
+        self.assertEqual(boundaries, sorted(boundaries))
+
+        queries = partition_queries({'a': 1}, boundaries)
+        self.assertEqual(len(queries), 4)
+        self.assertEqual(queries[0], {'$and': [{'a': 1}, {'_id': {'$lt': boundaries[0]}}]})
+        self.assertEqual(queries[3], {'$and': [{'a': 1}, {'_id': {'$gte': boundaries[2]}}]})
+        # Every id falls into exactly one range
+        for _id in ids:
+            matches = [q for q in partition_queries({}, boundaries)
+                       if q['_id'].get('$gte', _id) <= _id and ('$lt' not in q['_id'] or _id < q['_id']['$lt'])]
+            self.assertEqual(len(matches), 1)
+
+    def test_scan_partitions(self):
+        import time
+        from flask_umongorest.partitions import scan_partitions
+
+        def scan(query):
+            for i in range(query * 10, query * 10 + 10):
+                # Make the later partitions produce faster
+                time.sleep(0.001 * (5 - query))
+                yield i
+
+        self.assertEqual(list(scan_partitions(list(range(5)), scan, workers=3)), list(range(50)))
+        self.assertEqual(sorted(scan_partitions(list(range(5)), scan, workers=3, ordered=False)),
+                         list(range(50)))
+
+        def failing_scan(query):
+            yield query
+            raise ValueError(query)
+
+        with self.assertRaises(ValueError):
+            list(scan_partitions(list(range(5)), failing_scan, workers=2))
+
+
+class _PoolDocument(object):
+    @staticmethod
+    def build_from_mongo(raw, use_cls=True):
+        return raw
+
+
+class _PoolResource(object):
+    """Minimal resource serialized by worker processes (must be importable)."""
+    document = _PoolDocument
+
+    def __init__(self, view_method=None):
+        self.view_method = view_method
+
+    def serialize(self, obj, params=None):
+        if obj['n'] == 3:
+            raise ValueError
+        return {'n': obj['n'], 'fields': params.get('_fields')}
+
+    def handle_serialization_error(self, exc, obj):
+        pass
+
+
+class SerializationPoolTestCase(unittest.TestCase):
+    """
+    Test serializing raw documents in a process pool.
+    """
+
+    def test_serialize_in_pool(self):
+        from flask_umongorest.serialization import serialize_in_pool
+
+        rows = ((i, {'n': i}) for i in range(50))
+        encoded = list(serialize_in_pool(_PoolResource(), rows, {'_fields': 'n'}, processes=2, batch_size=7))
+        # Rows keep their order and unserializable documents are skipped
+        self.assertEqual([key for key, _ in encoded], [i for i in range(50) if i != 3])
+        self.assertEqual(json.loads(encoded[0][1]), {'n': 0, 'fields': 'n'})
+
+    def test_pool_per_process(self):
+        from flask_umongorest import serialization
+
+        pool = serialization.get_pool(2)
+        self.assertIs(serialization.get_pool(2), pool)
+        # A pool inherited from the parent process isn't reused
+        inherited = object()
+        serialization._pools.clear()
+        serialization._pools[-1, 2] = inherited
+        new_pool = serialization.get_pool(2)
+        self.assertIsNot(new_pool, inherited)
+        self.assertNotIn((-1, 2), serialization._pools)
+        pool.terminate()
+
+    def test_is_pool_safe(self):
+        from flask_umongorest.resources import Resource
+
+        class UserResource(Resource):
+            document = example.User
+
+        class URIResource(UserResource):
+            uri_prefix = '/user/'
+
+        class RelatedResource(UserResource):
+            related_resources = {'father': example.UserResource}
+
+        class CustomValueResource(UserResource):
+            def value_for_field(self, obj, field):
+                return None
+
+        class DeclaredResource(URIResource):
+            pool_safe = True
+
+        with example.app.test_request_context('/user/'):
+            self.assertTrue(UserResource().is_pool_safe())
+            self.assertFalse(URIResource().is_pool_safe())
+            self.assertFalse(RelatedResource().is_pool_safe())
+            self.assertFalse(CustomValueResource().is_pool_safe())
+            self.assertTrue(DeclaredResource().is_pool_safe())
+
+
+def make_test_client(*views, **kwargs):
+    """
+    Return a test client of a new app serving `views` (each registered at
+    the URL of its document), with the UMongoRest `kwargs`.
+    """
+    from flask import Flask
+    from flask_umongorest import UMongoRest
+
+    app = Flask(__name__)
+    app.config['TESTING'] = True
+    api = UMongoRest(app, **kwargs)
+    for view in views:
+        api.register()(view)
+    return app.test_client()
+
+
+class PermissionHookTestCase(unittest.TestCase):
+    """
+    Test that the per-object permission hooks always get the object.
+    """
+
+    def setUp(self):
+        example.User.collection.drop()
+        self.user = example.User(nick='owner', firstname='Owner')
+        self.user.commit()
+
+    def get_client(self, **resource_attrs):
+        from flask_umongorest import methods
+        from flask_umongorest.resources import Resource
+        from flask_umongorest.views import ResourceView
+
+        resource = type('UserResource', (Resource,), dict(
+            document=example.User, filters={'nick': [example.ops.Exact]}, **resource_attrs))
+
+        class UserView(ResourceView):
+            methods = [methods.Update, methods.BulkUpdate, methods.Patch, methods.BulkDelete]
+
+            def has_change_permission(self, request, obj):
+                # Crashes if called without the object
+                return obj.nick != 'owner'
+
+        UserView.resource = resource
+        return make_test_client(UserView)
+
+    def test_patch_loads_object(self):
+        from bson import ObjectId
+
+        client = self.get_client()
+        resp = client.patch('/user/%s/' % self.user.id, data=json.dumps({'firstname': 'Other'}))
+        self.assertEqual(resp.status_code, 401)
+        resp = client.patch('/user/%s/' % ObjectId(), data=json.dumps({'firstname': 'Other'}))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_upsert_loads_object(self):
+        client = self.get_client(allow_upsert=True)
+        resp = client.put('/user/%s/' % self.user.id, data=json.dumps({'nick': 'other'}))
+        self.assertEqual(resp.status_code, 401)
+
+    def test_bulk_writes_denied(self):
+        # Per-object checks can't be applied to bulk writes which don't load
+        # the objects
+        client = self.get_client(bulk_update_chunk_size=10)
+        resp = client.put('/user/?nick=owner', data=json.dumps({'firstname': 'Other'}))
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(example.User.find_one({'nick': 'owner'}).firstname, 'Owner')
+
+
+@instance.register
+class VersionedUser(Document):
+    nick = fields.StrField(required=True)
+    version = fields.IntField()
+
+    class Meta:
+        collection = db.demo_versioned_user
+
+
+def get_versioned_client(**resource_attrs):
+    """Return a test client serving VersionedUser with the given resource attributes."""
+    from flask_umongorest import methods
+    from flask_umongorest.resources import Resource
+    from flask_umongorest.views import ResourceView
+
+    class VersionedUserView(ResourceView):
+        methods = [methods.Create, methods.Update, methods.Fetch, methods.Patch]
+
+    VersionedUserView.resource = type('VersionedUserResource', (Resource,), dict(
+        document=VersionedUser, version_field='version', **resource_attrs))
+    return make_test_client(VersionedUserView)
+
+
+class VersionTestCase(unittest.TestCase):
+    """
+    Test the ETags of versioned objects and conditional updates.
+    """
+
+    def setUp(self):
+        VersionedUser.collection.drop()
+        self.app = get_versioned_client()
+        resp = self.app.post('/versioneduser/', data=json.dumps({'nick': 'alan'}))
+        response_success(resp)
+        self.url = '/versioneduser/%s/' % resp_json(resp)['id']
+
+    def test_etag(self):
+        resp = self.app.get(self.url)
+        response_success(resp)
+        self.assertEqual(resp.headers['ETag'], '"1"')
+
+    def test_if_match(self):
+        resp = self.app.put(self.url, data=json.dumps({'nick': 'olivia'}), headers={'If-Match': '"1"'})
+        response_success(resp)
+        self.assertEqual(resp.headers['ETag'], '"2"')
+
+        # The client's copy is stale
+        resp = self.app.put(self.url, data=json.dumps({'nick': 'bob'}), headers={'If-Match': '"1"'})
+        response_error(resp, 412)
+        self.assertEqual(resp_json(self.app.get(self.url))['nick'], 'olivia')
+
+        resp = self.app.put(self.url, data=json.dumps({'nick': 'bob'}), headers={'If-Match': '*'})
+        response_success(resp)
+        self.assertEqual(resp.headers['ETag'], '"3"')
+
+    def test_if_match_missing_object(self):
+        from bson import ObjectId
+
+        resp = self.app.put('/versioneduser/%s/' % ObjectId(), data=json.dumps({'nick': 'bob'}),
+                            headers={'If-Match': '"1"'})
+        response_error(resp, 404)
+
+
+class UpsertTestCase(unittest.TestCase):
+    """
+    Test creating and replacing objects with PUT.
+    """
+
+    def setUp(self):
+        from flask_umongorest import methods
+        from flask_umongorest.resources import Resource
+        from flask_umongorest.views import ResourceView
+
+        class UserResource(Resource):
+            document = example.User
+            allow_upsert = True
+
+        class UserView(ResourceView):
+            resource = UserResource
+            methods = [methods.Update, methods.Fetch]
+
+        example.User.collection.drop()
+        self.resource_class = UserResource
+        self.app = make_test_client(UserView)
+
+    def test_upsert(self):
+        from bson import ObjectId
+
+        url = '/user/%s/' % ObjectId()
+        resp = self.app.put(url, data=json.dumps({'nick': 'alan', 'firstname': 'Alan'}))
+        response_success(resp, 201)
+        self.assertEqual(resp_json(resp)['nick'], 'alan')
+
+        # The whole object is replaced
+        resp = self.app.put(url, data=json.dumps({'nick': 'olivia'}))
+        response_success(resp, 200)
+        user = resp_json(self.app.get(url))
+        self.assertEqual(user['nick'], 'olivia')
+        self.assertNotIn('firstname', user)
+        self.assertEqual(len(list(example.User.find())), 1)
+
+    def test_upsert_unacknowledged(self):
+        from bson import ObjectId
+
+        # Unacknowledged writes can't tell whether they created the object
+        self.resource_class.write_concern = {'w': 0}
+        resp = self.app.put('/user/%s/' % ObjectId(), data=json.dumps({'nick': 'alan'}))
+        response_success(resp, 200)
+
+    def test_upsert_invalid(self):
+        from bson import ObjectId
+
+        url = '/user/%s/' % ObjectId()
+        resp = self.app.put(url, data=json.dumps({'firstname': 'Alan'}))
+        response_error(resp, 400)
+        self.assertIn('nick', resp_json(resp)['field-errors'])
+        resp = self.app.put(url, data=json.dumps({'nick': 'alan', 'birthday': 'someday'}))
+        response_error(resp, 400)
+        self.assertIn('birthday', resp_json(resp)['field-errors'])
+        self.assertEqual(len(list(example.User.find())), 0)
+
+
+@instance.register
+class HookedUser(Document):
+    nick = fields.StrField(required=True)
+
+    class Meta:
+        collection = db.demo_hooked_user
+
+    # Calls of the hooks below
+    calls = []
+
+    def pre_insert(self):
+        self.calls.append('pre_insert')
+
+    def post_insert(self, ret):
+        self.calls.append('post_insert')
+
+    def pre_update(self):
+        self.calls.append('pre_update')
+
+    def post_update(self, ret):
+        self.calls.append('post_update')
+
+
+class CommitObjectTestCase(unittest.TestCase):
+    """
+    Test that Resource.commit_object behaves like umongo's Document.commit.
+    """
+
+    def test_commit_object(self):
+        from umongo.exceptions import UpdateError
+        from flask_umongorest.resources import Resource
+
+        class HookedUserResource(Resource):
+            document = HookedUser
+
+        HookedUser.collection.drop()
+        del HookedUser.calls[:]
+        with example.app.test_request_context('/hookeduser/'):
+            resource = HookedUserResource()
+            obj = HookedUser(nick='alan')
+            self.assertTrue(obj.is_modified())
+            resource.commit_object(obj)
+            self.assertEqual(obj.calls, ['pre_insert', 'post_insert'])
+            self.assertTrue(obj.is_created)
+            self.assertFalse(obj.is_modified())
+            self.assertEqual(HookedUser.find_one({'id': obj.pk}).nick, 'alan')
+
+            # Unmodified objects aren't written
+            self.assertIsNone(resource.commit_object(obj))
+
+            obj.nick = 'olivia'
+            self.assertTrue(obj.is_modified())
+            resource.commit_object(obj)
+            self.assertEqual(obj.calls, ['pre_insert', 'post_insert', 'pre_update', 'post_update'])
+            self.assertFalse(obj.is_modified())
+            self.assertEqual(HookedUser.find_one({'id': obj.pk}).nick, 'olivia')
+
+            obj.nick = 'bob'
+            with self.assertRaises(UpdateError):
+                resource.commit_object(obj, conditions={'nick': 'alan'})
+            self.assertEqual(HookedUser.find_one({'id': obj.pk}).nick, 'olivia')
+
+
+class HeaderAuthentication(object):
+    """Authorize the requests with an X-User header."""
+
+    def authorized(self):
+        from flask import request
+        return 'X-User' in request.headers
+
+
+class BulkJobTestCase(unittest.TestCase):
+    """
+    Test running bulk writes as background jobs and reporting their status.
+    """
+
+    def setUp(self):
+        from flask_umongorest import methods
+        from flask_umongorest.jobs import ThreadPoolJobBackend
+        from flask_umongorest.resources import Resource
+        from flask_umongorest.views import ResourceView
+
+        class UserResource(Resource):
+            document = example.User
+            filters = {'nick': [example.ops.Exact], 'firstname': [example.ops.Exact]}
+            bulk_jobs = True
+            bulk_update_chunk_size = 10
+
+        class UserView(ResourceView):
+            resource = UserResource
+            methods = [methods.BulkUpdate, methods.BulkDelete]
+            authentication_methods = [HeaderAuthentication]
+
+            def get_job_owner(self, request):
+                return request.headers.get('X-User')
+
+        example.User.collection.drop()
+        for nick in ('alan', 'olivia', 'bob'):
+            example.User(nick=nick).commit()
+        self.app = make_test_client(UserView, job_backend=ThreadPoolJobBackend())
+
+    def wait_for_job(self, url, headers):
+        for _ in range(100):
+            job = resp_json(self.app.get(url, headers=headers))
+            if job['status'] in ('done', 'failed'):
+                return job
+            time.sleep(0.05)
+        self.fail('The job did not finish.')
+
+    def test_bulk_update_job(self):
+        headers = {'X-User': 'alan'}
+        resp = self.app.put('/user/?nick=olivia', data=json.dumps({'firstname': 'Olivia'}), headers=headers)
+        response_success(resp, 202)
+        job = resp_json(resp)
+        self.assertTrue(resp.headers['Location'].endswith('/jobs/%s/' % job['id']))
+        self.assertNotIn('owner', job)
+
+        job = self.wait_for_job(resp.headers['Location'], headers)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['progress']['modified'], 1)
+        self.assertEqual(example.User.find_one({'nick': 'olivia'}).firstname, 'Olivia')
+
+    def test_job_invalidates_cache(self):
+        from flask_umongorest import cache
+
+        headers = {'X-User': 'alan'}
+        generation = cache.get_generation(example.User.collection.full_name)
+        resp = self.app.put('/user/?nick=olivia', data=json.dumps({'firstname': 'Olivia'}), headers=headers)
+        self.wait_for_job(resp.headers['Location'], headers)
+        # The job ran the resource's after_write hook
+        self.assertGreater(cache.get_generation(example.User.collection.full_name), generation)
+
+    def test_unknown_resource_class(self):
+        import sys
+        from flask_umongorest import jobs
+
+        reports = []
+        spec = {'kind': 'delete', 'query': {'nick': 'olivia'}, 'resource': 'json.tool.Resource'}
+        jobs._run(example.User.collection, spec, lambda **changes: reports.append(changes))
+        # Job specs can't make workers import modules
+        self.assertNotIn('json.tool', sys.modules)
+        self.assertEqual(reports[-1]['status'], jobs.FAILED)
+        self.assertIn('json.tool.Resource', reports[-1]['errors'][0])
+        self.assertEqual(len(list(example.User.find({'nick': 'olivia'}))), 1)
+
+    def test_job_permissions(self):
+        resp = self.app.put('/user/?nick=olivia', data=json.dumps({'firstname': 'Olivia'}))
+        response_error(resp, 401)
+
+        resp = self.app.put('/user/?nick=olivia', data=json.dumps({'firstname': 'Olivia'}),
+                            headers={'X-User': 'alan'})
+        url = resp.headers['Location']
+        # Clients need the authentication of the view which started the job
+        response_error(self.app.get(url), 401)
+        # ... and can't see the jobs of other clients
+        response_error(self.app.get(url, headers={'X-User': 'bob'}), 404)
+        response_success(self.app.get(url, headers={'X-User': 'alan'}))
+
+    def test_bulk_delete_filters(self):
+        headers = {'X-User': 'alan'}
+        # Deleting everything requires a filter
+        response_error(self.app.delete('/user/', headers=headers), 400)
+        # Unknown or misspelled filters aren't ignored
+        resp = self.app.delete('/user/?nik=olivia', headers=headers)
+        response_error(resp, 400)
+        self.assertIn('nik', resp_json(resp)['field-errors'])
+        response_error(self.app.put('/user/?nik=olivia', data=json.dumps({'firstname': 'Olivia'}),
+                                    headers=headers), 400)
+        self.assertEqual(len(list(example.User.find())), 3)
+
+        resp = self.app.delete('/user/?nick=olivia', headers=headers)
+        response_success(resp, 202)
+        self.wait_for_job(resp.headers['Location'], headers)
+        self.assertEqual(sorted(user.nick for user in example.User.find()), ['alan', 'bob'])
+
+
+class ExportResumeTestCase(unittest.TestCase):
+    """
+    Test resuming exports from their checkpoints.
+    """
+
+    def setUp(self):
+        from flask_umongorest.resources import Resource
+
+        class UserResource(Resource):
+            document = example.User
+            allowed_ordering = ['firstname']
+
+        self.resource_class = UserResource
+        example.User.collection.drop()
+        for i, firstname in enumerate(['b', None, 'a', None, 'c', 'a']):
+            user = example.User(nick='user%d' % i)
+            if firstname is not None:
+                user.firstname = firstname
+            user.commit()
+
+    def export(self, order_by, resume=None):
+        params = {'_order_by': order_by}
+        if resume:
+            params['_resume'] = resume
+        with example.app.test_request_context('/user/export/'):
+            resource = self.resource_class()
+            cursor, sort = resource.get_export_cursor(params)
+            raws = list(cursor)
+            return [raw['nick'] for raw in raws], [resource.get_checkpoint(raw, sort) for raw in raws]
+
+    def test_resume(self):
+        # Missing values sort first, and every position can be resumed
+        for order_by in ('firstname', '-firstname'):
+            nicks, checkpoints = self.export(order_by)
+            self.assertEqual(len(nicks), 6)
+            for i, checkpoint in enumerate(checkpoints):
+                self.assertEqual(self.export(order_by, checkpoint)[0], nicks[i + 1:])
+
+    def test_resume_invalid(self):
+        from flask_umongorest.exceptions import ValidationError as ResourceValidationError
+
+        nicks, checkpoints = self.export('firstname')
+        with self.assertRaises(ResourceValidationError):
+            self.export('firstname', 'garbage')
+        # The checkpoint of another ordering
+        with self.assertRaises(ResourceValidationError):
+            self.export('', checkpoints[0])
+
+    def test_unindexed_sort(self):
+        from flask_umongorest.exceptions import ValidationError as ResourceValidationError
+
+        self.resource_class.unindexed_sort_policy = 'reject'
+        with self.assertRaises(ResourceValidationError):
+            self.export('firstname')
+        # The index must also serve the _id tiebreaker
+        self.resource_class.sort_indexes = [[('firstname', 1)]]
+        with self.assertRaises(ResourceValidationError):
+            self.export('firstname')
+        self.resource_class.sort_indexes = [[('firstname', 1), ('_id', 1)]]
+        self.assertEqual(len(self.export('-firstname')[0]), 6)
+
+
 if __name__ == '__main__':
     unittest.main()
 